@@ -0,0 +1,241 @@
+"""Extracts basin-average monthly forcing series from downloaded CMIP6 files
+
+For each model grid (e.g. CESM2 gn, CNRM-CM6-1 gr), the fraction of each
+basin's area in each grid cell is computed once, by intersecting the basin
+polygons with the grid cells in an equal-area projection. The weights are
+saved as a sparse matrix (basins x cells in the basins' lat/lon window)
+under the weights directory, keyed by the grid bounds and the basins file,
+so they are reused across variables, scenarios and members.
+
+Each variable is then read lazily with dask, restricted to the lat/lon
+window, and reduced to basin averages with one sparse matrix product per
+time chunk. Cells with missing values are left out of a basin's average.
+
+Output is one netcdf file per model, member and scenario, with (basin, date)
+dimensions and one variable per CMIP6 variable, in the original units.
+
+Basin polygons are read with geopandas, e.g. the CAMELS-US
+basin_set_full_res/HCDN_nhru_final_671.shp (ids in the hru_id column).
+
+Requires geopandas, scipy, xarray and dask packages
+"""
+
+import glob
+import hashlib
+import os
+
+import click
+import geopandas as gpd
+import numpy as np
+import scipy.sparse
+from shapely.geometry import box
+import xarray as xr
+
+from manifest import filename_pattern
+
+default_weights_dir = "./weights"
+default_output_dir = "./basin_forcings"
+default_id_column = "hru_id"
+# Months per dask chunk
+default_time_chunk = 120
+
+# Cylindrical equal-area projection, for intersection areas
+equal_area_crs = "EPSG:6933"
+
+# CAMELS-US basin ids are 8 digits, but shapefiles often store them as integers
+basin_id_width = 8
+
+
+def cell_bounds(ds, name):
+    """Returns [n, 2] cell bounds of coordinate name (lat or lon), from the bounds variable or midpoints"""
+    for bounds_name in [ds[name].attrs.get("bounds"), f"{name}_bnds", f"{name}_bounds"]:
+        if bounds_name and bounds_name in ds.variables:
+            return np.asarray(ds[bounds_name].values, dtype=np.float64)
+    centers = np.asarray(ds[name].values, dtype=np.float64)
+    edges = np.concatenate([[1.5 * centers[0] - 0.5 * centers[1]],
+                            (centers[:-1] + centers[1:]) / 2,
+                            [1.5 * centers[-1] - 0.5 * centers[-2]]])
+    if name == "lat":
+        edges = np.clip(edges, -90, 90)
+    return np.stack([edges[:-1], edges[1:]], axis=1)
+
+
+def load_basins(path, id_column=default_id_column):
+    """Returns GeoDataFrame with basin_id and geometry columns, in lat/lon"""
+    basins = gpd.read_file(path)
+    if basins.crs is None:
+        basins = basins.set_crs("EPSG:4326")
+    basins = basins.to_crs("EPSG:4326")
+    ids = basins[id_column].astype(str).str.zfill(basin_id_width)
+    return gpd.GeoDataFrame(dict(basin_id=ids.values), geometry=basins.geometry.values, crs=basins.crs)
+
+
+class BasinWeights:
+    """Sparse basin x grid-cell area weights for one grid"""
+
+    def __init__(self, matrix, basin_ids, lat_window, lon_window, key):
+        self.matrix = matrix.tocsr()
+        self.basin_ids = list(basin_ids)
+        # (start, stop) index ranges of the grid that contain all basins
+        self.lat_window = tuple(int(i) for i in lat_window)
+        self.lon_window = tuple(int(i) for i in lon_window)
+        self.key = key
+
+    @classmethod
+    def compute(cls, basins, lat_bounds, lon_bounds, key=None):
+        """Computes weights of the basins (from load_basins) on a grid given by cell bounds"""
+        # CMIP6 longitudes are usually 0..360, basins are -180..180
+        lon_west = (lon_bounds[:, 0] + 180) % 360 - 180
+        lon_east = lon_west + (lon_bounds[:, 1] - lon_bounds[:, 0])
+        lat_south, lat_north = lat_bounds.min(axis=1), lat_bounds.max(axis=1)
+
+        minx, miny, maxx, maxy = basins.total_bounds
+        lat_index = np.flatnonzero((lat_north > miny) & (lat_south < maxy))
+        lon_index = np.flatnonzero((lon_east > minx) & (lon_west < maxx))
+        if len(lat_index) == 0 or len(lon_index) == 0:
+            raise ValueError("Basins are outside the grid")
+        lat_window = (lat_index.min(), lat_index.max() + 1)
+        lon_window = (lon_index.min(), lon_index.max() + 1)
+
+        # Cells of the window, numbered row-major within the window
+        n_lon = lon_window[1] - lon_window[0]
+        cells, numbers = [], []
+        for i in range(*lat_window):
+            for j in range(*lon_window):
+                cells.append(box(lon_west[j], lat_south[i], lon_east[j], lat_north[i]))
+                numbers.append((i - lat_window[0]) * n_lon + (j - lon_window[0]))
+        cells = gpd.GeoDataFrame(dict(cell=numbers), geometry=cells, crs="EPSG:4326").to_crs(equal_area_crs)
+
+        projected = basins.to_crs(equal_area_crs).reset_index(drop=True)
+        projected["row"] = np.arange(len(projected))
+        pieces = gpd.overlay(projected[["row", "geometry"]], cells, how="intersection", keep_geom_type=True)
+        areas = pieces.geometry.area.values
+        # Normalize by the intersected area, so basins at the grid edge still sum to 1
+        totals = np.bincount(pieces["row"].values, weights=areas, minlength=len(projected))
+        weights = areas / totals[pieces["row"].values]
+
+        n_cells = (lat_window[1] - lat_window[0]) * n_lon
+        matrix = scipy.sparse.csr_matrix((weights, (pieces["row"].values, pieces["cell"].values)),
+                                         shape=(len(projected), n_cells))
+        return cls(matrix, projected["basin_id"], lat_window, lon_window, key)
+
+    def save(self, path):
+        coo = self.matrix.tocoo()
+        np.savez(path, row=coo.row, col=coo.col, data=coo.data, shape=np.array(coo.shape),
+                 basin_ids=np.array(self.basin_ids), lat_window=np.array(self.lat_window),
+                 lon_window=np.array(self.lon_window), key=np.array(self.key or ""))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as npz:
+            matrix = scipy.sparse.coo_matrix((npz["data"], (npz["row"], npz["col"])), shape=tuple(npz["shape"]))
+            return cls(matrix, npz["basin_ids"].tolist(), npz["lat_window"], npz["lon_window"], str(npz["key"]))
+
+    def apply(self, da, time_chunk=default_time_chunk):
+        """Returns lazy (date, basin) basin averages of a (time, lat, lon) DataArray"""
+        window = da.isel(lat=slice(*self.lat_window), lon=slice(*self.lon_window))
+        window = window.transpose("time", "lat", "lon").chunk({"time": time_chunk, "lat": -1, "lon": -1})
+        data = window.data.reshape((window.shape[0], -1))
+        matrix = self.matrix.astype(np.float64)
+
+        def basin_means(block):
+            # block is (time, cells); missing cells are dropped from the weights
+            valid = np.isfinite(block)
+            total = matrix @ np.where(valid, block, 0.0).T
+            covered = matrix @ valid.T.astype(np.float64)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return (total / covered).T.astype(np.float32)
+
+        means = data.map_blocks(basin_means, chunks=(data.chunks[0], (len(self.basin_ids),)), dtype=np.float32)
+        return xr.DataArray(means, dims=("date", "basin"),
+                            coords=dict(date=window["time"].values, basin=self.basin_ids), attrs=da.attrs)
+
+
+def grid_key(lat_bounds, lon_bounds, basins_path, id_column):
+    """Returns cache key for a grid and basins file"""
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(lat_bounds).tobytes())
+    digest.update(np.ascontiguousarray(lon_bounds).tobytes())
+    stat = os.stat(basins_path)
+    digest.update(f"{os.path.abspath(basins_path)}:{stat.st_size}:{stat.st_mtime_ns}:{id_column}".encode())
+    return digest.hexdigest()[:16]
+
+
+def get_weights(ds, basins_path, id_column=default_id_column, weights_dir=default_weights_dir, basins=None):
+    """Returns BasinWeights for the grid of ds, loading them from weights_dir or computing and saving them"""
+    lat_bounds, lon_bounds = cell_bounds(ds, "lat"), cell_bounds(ds, "lon")
+    key = grid_key(lat_bounds, lon_bounds, basins_path, id_column)
+    grid_label = ds.attrs.get("grid_label", "grid")
+    path = os.path.join(weights_dir, f"{grid_label}_{len(lat_bounds)}x{len(lon_bounds)}_{key}.npz")
+    if os.path.exists(path):
+        return BasinWeights.load(path)
+
+    print(f"Computing basin weights for {len(lat_bounds)}x{len(lon_bounds)} {grid_label} grid")
+    if basins is None:
+        basins = load_basins(basins_path, id_column)
+    weights = BasinWeights.compute(basins, lat_bounds, lon_bounds, key=key)
+    os.makedirs(weights_dir, exist_ok=True)
+    weights.save(path)
+    print(f"Wrote {path}")
+    return weights
+
+
+def group_files(paths):
+    """Returns (model, member, scenario) => variable => sorted paths, for CMIP6 filenames"""
+    groups = {}
+    for path in paths:
+        match = filename_pattern.match(os.path.basename(path))
+        if match is None:
+            print(f"Skipping {path} (not a CMIP6 filename)")
+            continue
+        key = (match["model"], match["member"], match["scenario"])
+        groups.setdefault(key, {}).setdefault(match["variable"], []).append(path)
+    for variables in groups.values():
+        for paths in variables.values():
+            paths.sort()
+    return groups
+
+
+def extract_group(variable_paths, basins_path, id_column, weights_dir, time_chunk=default_time_chunk, basins=None):
+    """Returns (basin, date) dataset of basin averages for one model, member and scenario"""
+    data_vars = {}
+    for variable, paths in variable_paths.items():
+        ds = xr.open_mfdataset(paths, chunks={"time": time_chunk}, combine="by_coords", data_vars="minimal")
+        weights = get_weights(ds, basins_path, id_column, weights_dir, basins=basins)
+        data_vars[variable] = weights.apply(ds[variable], time_chunk).transpose("basin", "date")
+    return xr.Dataset(data_vars)
+
+
+@click.command()
+@click.argument('input_files', nargs=-1)
+@click.option('--basins', 'basins_path', required=True, type=click.Path(exists=True),
+              help='Basin polygons (shapefile, geopackage, geojson)')
+@click.option('--id_column', default=default_id_column, show_default=True, help='Basin id column')
+@click.option('--input_dir', help='Use all .nc files in this directory (e.g. download_script.py output)')
+@click.option('--output_dir', default=default_output_dir, show_default=True, help='Directory for basin series')
+@click.option('--weights_dir', default=default_weights_dir, show_default=True, help='Cache for weight matrices')
+@click.option('--time_chunk', default=default_time_chunk, show_default=True, help='Months per chunk')
+@click.option('--overwrite', is_flag=True, help='Rewrite existing output files')
+def extract_forcings(input_files, basins_path, id_column, input_dir, output_dir, weights_dir, time_chunk, overwrite):
+    paths = list(input_files)
+    if input_dir:
+        paths += sorted(glob.glob(os.path.join(input_dir, "*.nc")))
+    if not paths:
+        raise click.UsageError("No input files")
+
+    os.makedirs(output_dir, exist_ok=True)
+    basins = load_basins(basins_path, id_column)
+    print(f"Loaded {len(basins)} basins from {basins_path}")
+    for (model, member, scenario), variable_paths in sorted(group_files(paths).items()):
+        output_path = os.path.join(output_dir, f"{model}_{member}_ssp{scenario}.nc")
+        if os.path.exists(output_path) and not overwrite:
+            print(f"Skipping {output_path} (exists)")
+            continue
+        ds = extract_group(variable_paths, basins_path, id_column, weights_dir, time_chunk, basins=basins)
+        ds.attrs.update(source_id=model, variant_label=member, experiment_id=f"ssp{scenario}")
+        ds.to_netcdf(output_path)
+        print(f"Wrote {output_path} ({', '.join(variable_paths)})")
+
+
+if __name__ == '__main__':
+    extract_forcings()
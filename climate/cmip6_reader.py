@@ -0,0 +1,194 @@
+"""Lazy reader for the CMIP6 files downloaded by download_script.py
+
+Opens the files of one variable as a single dask-backed dataset per model,
+with member and scenario dimensions, e.g. tas(scenario, member, time, lat, lon).
+Only metadata is read when opening; data is read a chunk at a time when
+computed, so memory is bounded by the chunk size rather than the number of
+files. Models are kept in separate datasets because their grids differ
+(CESM2 gn is 192x288, CNRM-CM6-1 gr is 128x256).
+
+Time and region slices that are used repeatedly can be written to an
+on-disk cache (netcdf, one file per selection). Cache entries are keyed by
+the selection and the source files' sizes and mtimes, and the least
+recently used entries are deleted when the cache exceeds its size limit.
+
+Requires xarray and dask packages
+"""
+
+import glob
+import hashlib
+import json
+import os
+import time
+
+import click
+import xarray as xr
+
+from manifest import filename_pattern
+
+default_input_dir = "./outputs"
+default_cache_dir = "./cmip6_cache"
+default_cache_gb = 20.0
+# Months per dask chunk (a 192x288 float32 grid is 0.2 MB per month)
+default_time_chunk = 120
+# Files kept open by xarray at the same time
+default_max_open_files = 64
+
+
+class CMIP6Collection:
+    """The CMIP6 files in a directory, opened lazily by variable and model"""
+
+    def __init__(self, input_dir=default_input_dir, cache_dir=default_cache_dir, cache_gb=default_cache_gb,
+                 time_chunk=default_time_chunk, max_open_files=default_max_open_files):
+        self.input_dir = input_dir
+        self.cache_dir = cache_dir
+        self.cache_bytes = int(cache_gb * 1e9)
+        self.time_chunk = time_chunk
+        # Bounds open file handles no matter how many files are opened
+        xr.set_options(file_cache_maxsize=max_open_files)
+        self.files = self._scan()
+
+    def catalog(self):
+        """Returns list of dicts (model, member, scenario, variable, path), one per file"""
+        return list(self.files)
+
+    def models(self, variable=None):
+        return sorted({f["model"] for f in self.files if variable is None or f["variable"] == variable})
+
+    def open(self, variable, model, members=None, scenarios=None):
+        """Returns lazy dataset of one variable and model, with scenario and member dimensions"""
+        scenarios = [s.lower().removeprefix("ssp") for s in scenarios] if scenarios else None
+        selected = [f for f in self.files
+                    if f["variable"] == variable and f["model"] == model
+                    and (not members or f["member"] in members)
+                    and (not scenarios or f["scenario"] in scenarios)]
+        if not selected:
+            raise ValueError(f"No {variable} files for {model} in {self.input_dir}")
+
+        by_scenario = {}
+        for f in selected:
+            by_scenario.setdefault(f"ssp{f['scenario']}", {}).setdefault(f["member"], []).append(f["path"])
+
+        scenario_datasets = []
+        for scenario, by_member in sorted(by_scenario.items()):
+            member_datasets = []
+            for member, paths in sorted(by_member.items()):
+                ds = xr.open_mfdataset(sorted(paths), chunks={"time": self.time_chunk}, combine="by_coords",
+                                       data_vars="minimal", coords="minimal", compat="override")
+                # Bounds variables are the same for every file, and would need their own dimensions
+                member_datasets.append(ds[[variable]].expand_dims(member=[member]))
+            # Members or scenarios with different time ranges are padded with NaN
+            scenario_datasets.append(xr.concat(member_datasets, dim="member", join="outer")
+                                     .expand_dims(scenario=[scenario]))
+        ds = xr.concat(scenario_datasets, dim="scenario", join="outer")
+        ds.attrs.update(source_id=model, variable_id=variable)
+        return ds
+
+    def open_all(self, variable, members=None, scenarios=None):
+        """Returns model => lazy dataset, for every model with files of variable"""
+        return {model: self.open(variable, model, members, scenarios) for model in self.models(variable)}
+
+    def select(self, ds, time=None, region=None):
+        """Returns lazy selection of ds by time (start, end) and region (lon_min, lat_min, lon_max, lat_max).
+
+        Region longitudes may be -180..180; CMIP6 grids are usually 0..360.
+        """
+        if time is not None:
+            ds = ds.sel(time=slice(*time))
+        if region is not None:
+            lon_min, lat_min, lon_max, lat_max = region
+            ds = ds.sel(lat=slice(lat_min, lat_max))
+            if float(ds["lon"].max()) > 180:
+                lon_min, lon_max = lon_min % 360, lon_max % 360
+            if lon_min <= lon_max:
+                ds = ds.sel(lon=slice(lon_min, lon_max))
+            else:
+                # Region crosses the grid's longitude seam
+                ds = xr.concat([ds.sel(lon=slice(lon_min, None)), ds.sel(lon=slice(None, lon_max))], dim="lon")
+        return ds
+
+    def cached(self, variable, model, time=None, region=None, members=None, scenarios=None):
+        """Returns the selection from the on-disk cache, writing it there first if needed
+
+        The cached dataset is opened lazily, with the same chunks.
+        """
+        key = self._cache_key(variable, model, time, region, members, scenarios)
+        path = os.path.join(self.cache_dir, f"{model}_{variable}_{key}.nc")
+        if not os.path.exists(path):
+            ds = self.select(self.open(variable, model, members, scenarios), time, region)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            # Written chunk by chunk by dask
+            ds.to_netcdf(tmp_path)
+            os.replace(tmp_path, path)
+            print(f"Cached {variable} {model} selection in {path}")
+            self._evict(keep=path)
+        else:
+            # Access time for least recently used eviction
+            os.utime(path)
+        return xr.open_dataset(path, chunks={"time": self.time_chunk})
+
+    def _scan(self):
+        files = []
+        for path in sorted(glob.glob(os.path.join(self.input_dir, "*.nc"))):
+            match = filename_pattern.match(os.path.basename(path))
+            if match is not None:
+                files.append(dict(match.groupdict(), path=path))
+        return files
+
+    def _cache_key(self, variable, model, time, region, members, scenarios):
+        sources = [(f["path"], os.path.getsize(f["path"]), os.path.getmtime(f["path"]))
+                   for f in self.files if f["variable"] == variable and f["model"] == model]
+        selection = dict(time=time, region=region, members=sorted(members or []),
+                         scenarios=sorted(scenarios or []), sources=sources)
+        return hashlib.sha1(json.dumps(selection, default=str).encode()).hexdigest()[:16]
+
+    def _evict(self, keep=None):
+        """Deletes least recently used cache files until the cache fits its size limit"""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*.nc")):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.cache_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+            print(f"Removed {path} from cache")
+
+
+@click.command()
+@click.option('--input_dir', default=default_input_dir, show_default=True, help='Directory of CMIP6 files')
+@click.option('--variable', help='Variable to open (e.g. tas); lists the files if not given')
+@click.option('--model', help='Model (default is all models)')
+@click.option('--members', multiple=True, help='Only these members (e.g. r11i1p1f1)')
+@click.option('--scenarios', multiple=True, help='Only these scenarios (e.g. 585)')
+@click.option('--time', 'time_range', nargs=2, help='Start and end (e.g. 2030-01 2039-12)')
+@click.option('--region', nargs=4, type=float, help='lon_min lat_min lon_max lat_max')
+@click.option('--cache', is_flag=True, help='Write the selection to the slice cache')
+@click.option('--cache_dir', default=default_cache_dir, show_default=True, help='Slice cache directory')
+@click.option('--cache_gb', default=default_cache_gb, show_default=True, help='Slice cache size limit')
+def main(input_dir, variable, model, members, scenarios, time_range, region, cache, cache_dir, cache_gb):
+    collection = CMIP6Collection(input_dir, cache_dir=cache_dir, cache_gb=cache_gb)
+    if variable is None:
+        for f in collection.catalog():
+            print(f"{f['model']:<12} {f['member']:<10} ssp{f['scenario']} {f['variable']:<8} {f['path']}")
+        return
+
+    time_range = time_range or None
+    region = region or None
+    for name in [model] if model else collection.models(variable):
+        start = time.perf_counter()
+        if cache:
+            ds = collection.cached(variable, name, time_range, region, members, scenarios)
+        else:
+            ds = collection.select(collection.open(variable, name, members, scenarios), time_range, region)
+        print(ds)
+        print(f"{name}: {ds[variable].nbytes / 1e6:.1f} MB in {time.perf_counter() - start:.2f}s (lazy)")
+
+
+if __name__ == '__main__':
+    main()
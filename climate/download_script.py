@@ -1,9 +1,30 @@
+import concurrent.futures
+import hashlib
 import os
-import requests
+import random
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
 import click
+import requests
+from requests.adapters import HTTPAdapter
+
+from manifest import CHECKSUM_MISMATCH, SIZE_MISMATCH, Manifest, expand_entries, filter_entries, manifest_filename
 
 # Configuration
 default_output_dir = "./outputs"
+default_jobs = 4
+default_retries = 5
+default_chunk_mb = 4
+
+# Suffix for partial downloads, which are resumed on the next attempt
+partial_suffix = ".part"
+
+# Seconds to wait before the first retry, doubled on each further retry
+retry_backoff = 2.0
+# Seconds to wait for the server to connect / send data
+request_timeout = (30, 300)
 
 # Base URL patterns and filenames
 base_urls = [
@@ -32,37 +53,248 @@ base_urls = [
 variables = ["tas", "pr", "evspsbl"]
 scenarios = ["585", "245", "126"]
 
-def download_file(url, output_path, file_index, total_files):
-    try:
-        response = requests.get(url, stream=True)
+
+class DownloadError(Exception):
+    """Download failed in a way that retrying will not fix"""
+
+
+class SessionPool:
+    """One requests.Session per host, so each host's connections are reused across files"""
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+            return session
+
+    def close(self):
+        for session in self._sessions.values():
+            session.close()
+
+
+def sha256_file(path, chunk_size=default_chunk_mb * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_checksums(path):
+    """Reads sha256sum-format file ("<hash>  <filename>" per line) into filename => hash"""
+    checksums = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.strip().split()
+            if len(parts) == 2:
+                checksums[os.path.basename(parts[1].lstrip("*"))] = parts[0].lower()
+    return checksums
+
+
+def apply_mirror(url, mirror):
+    """Replaces the scheme and host of url with those of mirror (e.g. http://localhost:8000)"""
+    if not mirror:
+        return url
+    parts, mirror_parts = urlsplit(url), urlsplit(mirror)
+    return urlunsplit((mirror_parts.scheme, mirror_parts.netloc, parts.path, parts.query, ""))
+
+
+def transfer(session, url, partial_path, chunk_size):
+    """Downloads url to partial_path, resuming from its current size.
+
+    Returns expected total size in bytes (None if the server did not send one)
+    """
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    with session.get(url, headers=headers, stream=True, timeout=request_timeout) as response:
+        if response.status_code == 416:
+            # Range starts at or past the end: the partial file is already complete
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            return int(total) if total.isdigit() else offset
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise DownloadError(f"HTTP {response.status_code} for {url}")
         response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
 
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    progress = (downloaded / total_size) * 100 if total_size > 0 else 0
-                    print(f"File {file_index}/{total_files}: {output_path} - {progress:.2f}% completed", end='\r')
+        if response.status_code == 206:
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            total = int(total) if total.isdigit() else None
+            mode = "ab"
+        else:
+            # Server ignored the range request, so start over
+            length = response.headers.get("Content-Length")
+            total = int(length) if length else None
+            offset = 0
+            mode = "wb"
+
+        if offset:
+            print(f"Resuming {os.path.basename(partial_path)} at {offset / 1e6:.1f} MB")
+        with open(partial_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+    return total
+
+
+def download_file(pool, url, output_path, expected=None, retries=default_retries,
+                  chunk_size=default_chunk_mb * 1024 * 1024):
+    """Downloads url to output_path, retrying with backoff and resuming partial transfers.
+
+    The file is written to output_path + ".part" and renamed when complete
+    and verified against the expected dict (size and sha256, if not None).
+    Returns (size, sha256). Raises an exception on failure.
+    """
+    expected = expected or {}
+    partial_path = output_path + partial_suffix
+    session = pool.get(url)
+    for attempt in range(retries + 1):
+        try:
+            total = transfer(session, url, partial_path, chunk_size)
+            size = os.path.getsize(partial_path)
+            if total is not None and size != total:
+                raise requests.ConnectionError(f"incomplete transfer ({size} of {total} bytes)")
+            break
+        except requests.RequestException as e:
+            # Includes dropped connections mid-transfer (ChunkedEncodingError)
+            if attempt == retries:
+                raise
+            delay = retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            print(f"Retrying {os.path.basename(output_path)} in {delay:.0f}s ({e})")
+            time.sleep(delay)
+
+    sha256 = sha256_file(partial_path, chunk_size)
+    for key, actual in [("size", size), ("sha256", sha256)]:
+        if expected.get(key) is not None and actual != expected[key]:
+            # The bytes on disk are bad, so the next attempt must start over
+            os.remove(partial_path)
+            raise DownloadError(f"{key} mismatch for {output_path} ({actual}, expected {expected[key]})")
+    os.replace(partial_path, output_path)
+    return size, sha256
+
+
+def probe_size(pool, url):
+    """Returns Content-Length from a HEAD request, or None"""
+    try:
+        response = pool.get(url).head(url, allow_redirects=True, timeout=request_timeout)
+        if response.ok and response.headers.get("Content-Length", "").isdigit():
+            return int(response.headers["Content-Length"])
+    except requests.RequestException:
+        pass
+    return None
+
+
+def download_all(tasks, pool, jobs=default_jobs, retries=default_retries,
+                 chunk_size=default_chunk_mb * 1024 * 1024, on_complete=None):
+    """Downloads (url, output_path, expected) tasks in a pool of jobs threads.
+
+    on_complete(output_path, size, sha256) is called (in this thread) after
+    each successful download.
+
+    Returns list of (url, error message) for failed downloads
+    """
+    failed = []
+    total_files = len(tasks)
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for url, output_path, expected in tasks:
+            future = executor.submit(download_file, pool, url, output_path, expected, retries, chunk_size)
+            futures[future] = (url, output_path)
+
+        for index, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            url, output_path = futures[future]
+            try:
+                size, sha256 = future.result()
+                print(f"Downloaded: {output_path} ({size / 1e6:.1f} MB) ({index}/{total_files})")
+                if on_complete is not None:
+                    on_complete(output_path, size, sha256)
+            except Exception as e:
+                print(f"Failed to download {url}: {e} ({index}/{total_files})")
+                failed.append((url, str(e)))
+    print(f"Finished in {time.perf_counter() - start:.0f}s, {len(failed)} failed")
+    return failed
+
+
+def split_option(values):
+    """Returns list from a multiple option, also splitting comma-separated values"""
+    return [v for value in values for v in value.split(",") if v]
 
-        print(f"\nDownloaded: {output_path} ({file_index}/{total_files})")
-    except Exception as e:
-        print(f"\nFailed to download {url}: {e}")
 
 @click.command()
 @click.option('--output_dir', default=default_output_dir, help='Directory to save downloaded files')
-def download_data(output_dir):
+@click.option('--variables', 'variable_filter', multiple=True, help=f'Only these variables (repeat or comma-separate) {variables}')
+@click.option('--scenarios', 'scenario_filter', multiple=True, help=f'Only these scenarios {scenarios}')
+@click.option('--models', 'model_filter', multiple=True, help='Only these models (e.g. CESM2, CNRM-CM6-1)')
+@click.option('--manifest', 'manifest_path', help=f'Manifest file [<output_dir>/{manifest_filename}]')
+@click.option('--verify', is_flag=True, help='Check sha256 of files already present (slow the first time)')
+@click.option('--dry_run', is_flag=True, help='Only list the files that would be downloaded')
+@click.option('--jobs', '-j', default=default_jobs, show_default=True, help='Number of parallel downloads')
+@click.option('--retries', default=default_retries, show_default=True, help='Retries per file, with backoff')
+@click.option('--chunk_mb', default=default_chunk_mb, show_default=True, help='Read/write chunk size in MB')
+@click.option('--checksums', type=click.Path(exists=True),
+              help='sha256sum-format file of expected checksums, by filename (added to the manifest)')
+@click.option('--mirror', help='Use this scheme://host[:port] instead of the source hosts (e.g. for testing)')
+def download_data(output_dir, variable_filter, scenario_filter, model_filter, manifest_path, verify, dry_run,
+                  jobs, retries, chunk_mb, checksums, mirror):
     os.makedirs(output_dir, exist_ok=True)
-    file_list = [(entry, variable, scenario) for entry in base_urls for variable in variables for scenario in scenarios]
-    total_files = len(file_list)
-
-    for index, (entry, variable, scenario) in enumerate(file_list, start=1):
-        file_url = entry["url"].format(scenario=scenario, variable=variable)
-        file_name = entry["filename"].format(scenario=scenario, variable=variable)
-        output_path = os.path.join(output_dir, file_name)
-        download_file(file_url, output_path, index, total_files)
+    chunk_size = chunk_mb * 1024 * 1024
+    entries = expand_entries(base_urls, variables, scenarios)
+    entries = filter_entries(entries, split_option(variable_filter), split_option(scenario_filter),
+                             split_option(model_filter))
+    if not entries:
+        raise click.UsageError("No files match the --variables/--scenarios/--models filters")
+
+    manifest = Manifest(manifest_path or os.path.join(output_dir, manifest_filename))
+    manifest.add_entries(entries)
+    if checksums:
+        manifest.import_checksums(read_checksums(checksums))
+
+    pool = SessionPool(jobs)
+    # Expected sizes let files already on disk be checked without hashing them
+    unknown = [e for e in entries if manifest.files[e["filename"]].get("size") is None]
+    if unknown:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            sizes = executor.map(lambda e: probe_size(pool, apply_mirror(e["url"], mirror)), unknown)
+            for entry, size in zip(unknown, sizes):
+                manifest.files[entry["filename"]]["size"] = size
+
+    needed = manifest.diff(entries, output_dir, verify_checksum=verify,
+                           hash_func=lambda path: sha256_file(path, chunk_size))
+    manifest.save()
+    print(f"{len(entries)} files selected, {len(entries) - len(needed)} up to date, {len(needed)} to download")
+    for entry, reason in needed:
+        print(f"  {entry['filename']} ({reason})")
+    if dry_run or not needed:
+        pool.close()
+        return
+
+    tasks = []
+    for entry, reason in needed:
+        output_path = os.path.join(output_dir, entry["filename"])
+        if reason in (CHECKSUM_MISMATCH, SIZE_MISMATCH):
+            os.remove(output_path)
+        record = manifest.files[entry["filename"]]
+        tasks.append((apply_mirror(entry["url"], mirror), output_path, dict(size=record.get("size"),
+                                                                        sha256=record.get("sha256"))))
+
+    def on_complete(output_path, size, sha256):
+        # Saved after each file, so an interrupted sync keeps what it finished
+        manifest.record_download(os.path.basename(output_path), output_path, size, sha256)
+        manifest.save()
+
+    failed = download_all(tasks, pool, jobs=jobs, retries=retries, chunk_size=chunk_size, on_complete=on_complete)
+    pool.close()
+    if failed:
+        raise SystemExit(1)
 
 if __name__ == '__main__':
     download_data()
@@ -0,0 +1,130 @@
+"""Manifest of the CMIP6 files to download, for incremental sync
+
+The manifest lists every file expanded from the download_script.py URL
+templates (model, member, variable, scenario, url) with its expected size
+and sha256 checksum. Sizes come from the server (HEAD request) and checksums
+are recorded when a file is first downloaded, or imported from a
+sha256sum-format file. The manifest is saved as json in the output
+directory, so a later sync only fetches files that are missing or do not
+match it.
+
+Hashing multi-GB files is slow, so each file's size and mtime are recorded
+when its checksum is verified, and the check is skipped while they are
+unchanged.
+"""
+
+import json
+import os
+import re
+
+manifest_filename = "manifest.json"
+
+# e.g. tas_Amon_CESM2_ssp585_r11i1p1f1_gn_201501-206412.nc
+filename_pattern = re.compile(
+    r"(?P<variable>[^_]+)_(?P<table>[^_]+)_(?P<model>[^_]+)_ssp(?P<scenario>\d+)_(?P<member>[^_]+)_(?P<grid>[^_]+)_")
+
+# Reasons a file needs to be downloaded
+MISSING = "missing"
+PARTIAL = "partial"
+SIZE_MISMATCH = "size mismatch"
+CHECKSUM_MISMATCH = "checksum mismatch"
+
+
+def expand_entries(base_urls, variables, scenarios):
+    """Returns one entry (dict) per file in the URL templates"""
+    entries = []
+    for template in base_urls:
+        for variable in variables:
+            for scenario in scenarios:
+                filename = template["filename"].format(scenario=scenario, variable=variable)
+                entry = dict(filename=filename, url=template["url"].format(scenario=scenario, variable=variable))
+                match = filename_pattern.match(filename)
+                if match:
+                    entry.update(match.groupdict())
+                entries.append(entry)
+    return entries
+
+
+def filter_entries(entries, variables=None, scenarios=None, models=None):
+    """Returns entries matching the filters (None or empty matches everything)"""
+    scenarios = [s.lower().removeprefix("ssp") for s in scenarios] if scenarios else None
+    models = [m.lower() for m in models] if models else None
+    selected = []
+    for entry in entries:
+        if variables and entry.get("variable") not in variables:
+            continue
+        if scenarios and entry.get("scenario") not in scenarios:
+            continue
+        if models and entry.get("model", "").lower() not in models:
+            continue
+        selected.append(entry)
+    return selected
+
+
+class Manifest:
+    """Expected size and checksum of each file, saved as json"""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f).get("files", {})
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(files=self.files), f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def add_entries(self, entries):
+        """Adds or updates the url and metadata of entries, keeping recorded sizes and checksums"""
+        for entry in entries:
+            record = self.files.setdefault(entry["filename"], dict(size=None, sha256=None))
+            record.update({k: v for k, v in entry.items() if k != "filename"})
+
+    def import_checksums(self, checksums):
+        """Sets expected sha256 from filename => hash (e.g. from a sha256sum file)"""
+        for filename, sha256 in checksums.items():
+            if filename in self.files:
+                self.files[filename]["sha256"] = sha256
+
+    def record_download(self, filename, path, size, sha256):
+        """Records size and checksum of a downloaded (and verified) file"""
+        record = self.files.setdefault(filename, {})
+        record.update(size=size, sha256=sha256)
+        self._stamp(record, path)
+
+    def check_file(self, filename, path, verify_checksum=False, hash_func=None):
+        """Returns reason the file needs downloading, or None if it matches the manifest.
+
+        With verify_checksum, files are hashed (with hash_func) unless they
+        are unchanged since their checksum was last verified.
+        """
+        if not os.path.exists(path):
+            return PARTIAL if os.path.exists(f"{path}.part") else MISSING
+        record = self.files.get(filename, {})
+        stat = os.stat(path)
+        if record.get("size") is not None and stat.st_size != record["size"]:
+            return SIZE_MISMATCH
+        if verify_checksum and record.get("sha256"):
+            if record.get("verified") == [stat.st_size, stat.st_mtime_ns]:
+                return None
+            if hash_func(path) != record["sha256"]:
+                return CHECKSUM_MISMATCH
+            self._stamp(record, path)
+        return None
+
+    def diff(self, entries, output_dir, verify_checksum=False, hash_func=None):
+        """Returns (entry, reason) for each entry that needs downloading"""
+        needed = []
+        for entry in entries:
+            path = os.path.join(output_dir, entry["filename"])
+            reason = self.check_file(entry["filename"], path, verify_checksum, hash_func)
+            if reason is not None:
+                needed.append((entry, reason))
+        return needed
+
+    def _stamp(self, record, path):
+        stat = os.stat(path)
+        record["verified"] = [stat.st_size, stat.st_mtime_ns]
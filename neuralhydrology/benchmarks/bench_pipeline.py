@@ -0,0 +1,345 @@
+"""Benchmark the demo1 pipeline on synthetic CAMELS-US data
+
+Generates a dataset in CAMELS-US format (daymet, maurer and nldas forcings,
+usgs streamflow and catchment attributes) for n_basins, then times:
+* catalog - building the basin catalog of the dataset
+* validate_inputs - argument checks with the saved catalog
+* config - generating the run config from template.basin.yml and parsing it
+* train - BasinNH.run_training for one basin, on the cpu
+* test - BasinNH.run_testing (evaluation, result extraction and netcdf writing)
+* test_reuse - BasinNH.run_testing again, which reuses the evaluation results
+* write_netcdf - writing the test results dataset
+
+The phases recorded by instrument.py during training and testing (e.g.
+data_load, train_epoch, eval, read_results) are reported too. Peak MB is the
+resident memory peak of the process after each stage.
+
+Results are saved as json with --output. With --compare, each time is
+compared to a previous results file, and the script exits with status 1 if
+any is slower by more than the threshold. Compare results from the same
+machine and settings.
+
+Runs offline on the cpu. Requires numpy, pandas, xarray, torch and neuralhydrology packages
+
+    python benchmarks/bench_pipeline.py -n 50 -o baseline.json
+    python benchmarks/bench_pipeline.py -n 50 --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import json
+import os
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'demo1'))
+from args_utils import validate_inputs
+from basin_catalog import FORCING_DIRNAME, FORCING_SUFFIX, STREAMFLOW_DIRNAME, STREAMFLOW_SUFFIX, BasinCatalog
+from camels_store import STORE_DIRNAME, CamelsStore
+from checkpoints import DEFAULT_KEEP_LAST
+from instrument import get_instrument, peak_rss_mb, summarize
+
+ATTRIBUTES_DIRNAME = 'camels_attributes_v2.0'
+
+# Forcing product => (filename tag, columns after the date columns)
+FORCINGS = dict(
+    daymet=('cida', ['dayl(s)', 'prcp(mm/day)', 'srad(W/m2)', 'swe(mm)', 'tmax(C)', 'tmin(C)', 'vp(Pa)']),
+    maurer=('maurer', ['Dayl(s)', 'PRCP(mm/day)', 'SRAD(W/m2)', 'SWE(mm)', 'Tmax(C)', 'Tmin(C)', 'Vp(Pa)']),
+    nldas=('nldas', ['Dayl(s)', 'PRCP(mm/day)', 'SRAD(W/m2)', 'SWE(mm)', 'Tmax(C)', 'Tmin(C)', 'Vp(Pa)']),
+)
+
+# Covers the template.basin.yml periods (1980-2008) plus one seq_length of warmup
+START_DATE = '1979-01-01'
+END_DATE = '2008-12-31'
+
+CFS_TO_M3S = 0.0283168
+
+
+def make_camels(data_dir: pathlib.Path, n_basins: int, seed: int = 0) -> list[str]:
+    """Writes CAMELS-US format files for n_basins synthetic basins. Returns basin ids.
+
+    Precipitation is random, temperature, radiation and day length are seasonal,
+    and streamflow is precipitation routed through a linear reservoir, with
+    about 1% of days missing (-999, flag M).
+    """
+    dates = pd.date_range(START_DATE, END_DATE, freq='D')
+    n_days = len(dates)
+    season = np.sin(2 * np.pi * (dates.dayofyear.to_numpy() - 100) / 365.25)
+    date_columns = dict(Year=dates.year, Mnth=dates.month, Day=dates.day, Hr=12)
+    rng = np.random.default_rng(seed)
+
+    basin_ids, attributes = list(), list()
+    for i in range(n_basins):
+        huc = f'{i % 18 + 1:02d}'
+        basin_id = f'{huc}{i:06d}'
+        lat, lon = rng.uniform(30, 48), rng.uniform(-122, -70)
+        elevation, area_km2 = rng.uniform(50, 2500), rng.uniform(50, 2000)
+
+        prcp = rng.gamma(0.5, 6.0, n_days)
+        tmax = 15 + 12 * season - elevation / 300 + rng.normal(0, 2, n_days)
+        tmin = tmax - rng.uniform(6, 14, n_days)
+        swe = np.where(tmax < 0, prcp * 5, 0.0)
+        for product, (tag, columns) in FORCINGS.items():
+            values = [
+                43200 + 10000 * season,
+                prcp * rng.uniform(0.8, 1.2, n_days),
+                200 + 100 * season + rng.normal(0, 20, n_days),
+                swe,
+                tmax + rng.normal(0, 0.5, n_days),
+                tmin + rng.normal(0, 0.5, n_days),
+                600 + 40 * np.maximum(tmin, 0) + rng.normal(0, 50, n_days),
+            ]
+            df = pd.DataFrame(dict(date_columns, **dict(zip(columns, values))))
+            path = data_dir / FORCING_DIRNAME / product / huc / f'{basin_id}_lump_{tag}{FORCING_SUFFIX}'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w') as fp:
+                # Header is latitude, elevation (m) and area (m2)
+                fp.write(f'{lat:.4f}\n{elevation:.0f}\n{area_km2 * 1e6:.0f}\n')
+                df.to_csv(fp, sep=' ', index=False, float_format='%.2f')
+
+        runoff_ratio = rng.uniform(0.2, 0.6)
+        kernel = np.exp(-np.arange(60) / rng.uniform(2, 15))
+        runoff_mm = np.convolve(prcp, kernel / kernel.sum())[:n_days] * runoff_ratio
+        q_cfs = runoff_mm * area_km2 * 1e3 / 86400 / CFS_TO_M3S
+        missing = rng.random(n_days) < 0.01
+        q_cfs[missing] = -999.0
+        df = pd.DataFrame(dict(basin=basin_id, **date_columns, QObs=q_cfs, flag=np.where(missing, 'M', 'A')))
+        df = df.drop(columns='Hr')
+        path = data_dir / STREAMFLOW_DIRNAME / huc / f'{basin_id}{STREAMFLOW_SUFFIX}'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_csv(path, sep=' ', header=False, index=False, float_format='%.2f')
+
+        attributes.append(dict(
+            gauge_id=basin_id,
+            huc_02=huc,
+            gauge_name=f'Synthetic basin {i}',
+            gauge_lat=lat,
+            gauge_lon=lon,
+            elev_mean=elevation,
+            slope_mean=rng.uniform(1, 100),
+            area_gages2=area_km2,
+            area_geospa_fabric=area_km2,
+            p_mean=prcp.mean(),
+            pet_mean=rng.uniform(1, 5),
+            aridity=rng.uniform(0.2, 3),
+            frac_snow=float((swe > 0).mean()),
+            frac_forest=rng.uniform(0, 1),
+            lai_max=rng.uniform(0.5, 6),
+            soil_depth_pelletier=rng.uniform(0.5, 50),
+            soil_porosity=rng.uniform(0.3, 0.6),
+        ))
+        basin_ids.append(basin_id)
+
+    # Attribute groups, as in the CAMELS-US attributes (';' separated)
+    df = pd.DataFrame(attributes)
+    groups = dict(
+        name=['huc_02', 'gauge_name'],
+        topo=['gauge_lat', 'gauge_lon', 'elev_mean', 'slope_mean', 'area_gages2', 'area_geospa_fabric'],
+        clim=['p_mean', 'pet_mean', 'aridity', 'frac_snow'],
+        vege=['frac_forest', 'lai_max'],
+        soil=['soil_depth_pelletier', 'soil_porosity'],
+    )
+    attributes_dir = data_dir / ATTRIBUTES_DIRNAME
+    attributes_dir.mkdir(parents=True, exist_ok=True)
+    for group, columns in groups.items():
+        df[['gauge_id'] + columns].to_csv(attributes_dir / f'camels_{group}.txt', sep=';', index=False)
+
+    return basin_ids
+
+
+def measure(func, repeat: int = 1) -> tuple:
+    """Returns (last result, list of seconds per call, process peak RSS MB) for calling func repeat times."""
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, times, peak_rss_mb()
+
+
+def stage_row(name: str, times: list[float], peak: float) -> dict:
+    return dict(stage=name, count=len(times), mean_s=round(float(np.mean(times)), 4),
+        min_s=round(min(times), 4), max_s=round(max(times), 4), peak_rss_mb=round(peak, 1))
+
+
+def environment() -> dict:
+    """Returns versions and machine info saved with the results."""
+    env = dict(python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count())
+    for package in ['numpy', 'pandas', 'xarray', 'torch', 'neuralhydrology']:
+        module = sys.modules.get(package)
+        env[package] = getattr(module, '__version__', None)
+    return env
+
+
+def timings(results: dict) -> dict[str, float]:
+    """Returns name => seconds for comparing results: stage minimum and phase mean times."""
+    values = {row['stage']: row['min_s'] for row in results['stages']}
+    values.update({f'phase:{row["phase"]}': row['mean_s'] for row in results['phases']})
+    return values
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_diff: float) -> list[str]:
+    """Prints each time relative to the baseline.
+
+    Returns names slower by more than threshold (a fraction of the baseline)
+    and by more than min_diff seconds, so that very short stages are not
+    reported for timer noise.
+    """
+    if results['settings'] != baseline.get('settings'):
+        print(f'Warning: settings differ from baseline {baseline.get("settings")}')
+    current, previous = timings(results), timings(baseline)
+    slower = list()
+    print(f'{"name":<24} {"baseline s":>10} {"current s":>10} {"ratio":>7}')
+    for name, seconds in current.items():
+        base = previous.get(name)
+        if not base:
+            continue
+        ratio = seconds / base
+        flag = ''
+        if ratio > 1 + threshold and seconds - base > min_diff:
+            slower.append(name)
+            flag = '  SLOWER'
+        print(f'{name:<24} {base:>10.4f} {seconds:>10.4f} {ratio:>7.2f}{flag}')
+    return slower
+
+
+def run(args: argparse.Namespace, data_dir: pathlib.Path, exp_dir: pathlib.Path) -> dict:
+    """Generates the dataset, runs the pipeline stages and returns the results dictionary."""
+    stages = list()
+    # Pipeline output is discarded, unless verbose
+    output = sys.stdout if args.verbose else open(os.devnull, 'w')
+
+    def add(name, func, repeat=1):
+        with contextlib.redirect_stdout(output):
+            result, times, peak = measure(func, repeat)
+        stages.append(stage_row(name, times, peak))
+        print(f'{name:<16} {stages[-1]["mean_s"]:>10.4f} s  ({len(times)}x)')
+        return result
+
+    basin_ids = add('generate', lambda: make_camels(data_dir, args.n_basins, seed=args.seed))
+    add('catalog', lambda: BasinCatalog.load(data_dir, rebuild=True), args.repeat)
+
+    basin_id = basin_ids[0]
+    nh_args = argparse.Namespace(
+        step='train',
+        data_dir=str(data_dir),
+        experiments_dir=str(exp_dir),
+        cache_dir=None,
+        basin_id=basin_id,
+        basin_list=None,
+        run_id=None,
+        training_epochs=args.epochs,
+        device='cpu',
+        keep_checkpoints=DEFAULT_KEEP_LAST,
+        stateful=False,
+        zarr_results=False,
+        dry_run=True,
+        verbose=args.verbose,
+    )
+    add('validate_inputs', lambda: validate_inputs(nh_args), args.repeat)
+    if args.store:
+        store = CamelsStore(data_dir / STORE_DIRNAME)
+        add('build_store', lambda: store.build(data_dir, [basin_id]))
+
+    basin_nh = add('import', lambda: importlib.import_module('basin_nh'))
+    from neuralhydrology.utils.config import Config
+    nh = add('init', lambda: basin_nh.BasinNH(nh_args))
+
+    scratch_dir = exp_dir / '.scratch'
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    basin_txt_path = scratch_dir / 'bench_basin.txt'
+    basin_txt_path.write_text(f'{basin_id}\n')
+    yml_path = scratch_dir / 'bench_basin.yml'
+
+    def generate_config():
+        nh._generate_config_file(yml_path, basin_txt_path, exp_dir / basin_id / 'runs', [basin_id])
+        return Config(yml_path)
+
+    add('config', generate_config, args.repeat)
+
+    instrument = get_instrument()
+    nh_args.run_id = add('train', nh.run_training)
+    if nh_args.run_id is None:
+        raise RuntimeError('training did not return a run_id')
+    nh_args.step = 'test'
+    ds = add('test', nh.run_testing)
+    add('test_reuse', nh.run_testing, args.repeat)
+    nc_path = scratch_dir / 'bench_results.nc'
+    add('write_netcdf', lambda: ds.to_netcdf(nc_path), args.repeat)
+
+    return dict(
+        created=datetime.datetime.now().isoformat(timespec='seconds'),
+        settings=dict(n_basins=args.n_basins, epochs=args.epochs, repeat=args.repeat,
+            store=args.store, seed=args.seed),
+        environment=environment(),
+        stages=stages,
+        phases=summarize(instrument.records),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--n_basins', type=int, default=20, help='Number of basins to generate [20]')
+    parser.add_argument('-t', '--epochs', type=int, default=3, help='Training epochs [3]')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Calls to time for the faster stages [5]')
+    parser.add_argument('-s', '--store', action='store_true',
+        help='Build the columnar store (camels_store.py) and train from it, instead of the text files')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the dataset [0]')
+    parser.add_argument('-w', '--work_dir',
+        help='Directory for the dataset and experiments (must not exist) [temporary directory]')
+    parser.add_argument('-o', '--output', help='Write results to this json file')
+    parser.add_argument('-c', '--compare', help='Results json file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='Fraction slower than the comparison results to report as a regression [0.2]')
+    parser.add_argument('--min_diff', type=float, default=0.01,
+        help='Seconds slower than the comparison results to report as a regression [0.01]')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show pipeline output')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+
+    print(f'{args.n_basins} basins, {args.epochs} epochs, store {"on" if args.store else "off"}')
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = pathlib.Path(args.work_dir or tmp)
+        if args.work_dir:
+            work_dir.mkdir(parents=True, exist_ok=False)
+        results = run(args, work_dir / 'camels', work_dir / 'experiments')
+
+    print()
+    print(f'{"stage":<16} {"count":>5} {"mean s":>10} {"min s":>10} {"peak MB":>10}')
+    for row in results['stages']:
+        print(f'{row["stage"]:<16} {row["count"]:>5} {row["mean_s"]:>10.4f} {row["min_s"]:>10.4f}'
+            f' {row["peak_rss_mb"]:>10.1f}')
+    print()
+    print(f'{"phase":<16} {"count":>5} {"mean s":>10} {"total s":>10}')
+    for row in results['phases']:
+        print(f'{row["phase"]:<16} {row["count"]:>5} {row["mean_s"]:>10.4f} {row["total_s"]:>10.4f}')
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        print(f'Wrote {args.output}')
+
+    if baseline is not None:
+        print()
+        slower = compare(results, baseline, args.threshold, args.min_diff)
+        if slower:
+            print(f'{len(slower)} slower than {args.compare} by more than {args.threshold:.0%}: {" ".join(slower)}')
+            sys.exit(1)
+        print(f'No regressions compared to {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
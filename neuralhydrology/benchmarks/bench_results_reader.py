@@ -0,0 +1,101 @@
+"""Benchmark reading one basin from nh test results: full pickle vs ResultsReader
+
+Writes a synthetic test_results.p (same structure as nh writes for a regional
+model) and compares time and peak python memory (tracemalloc) for:
+* pickle - load the whole pickle and take one basin (previous BasinNH._test)
+* split - one-time conversion to per-basin files
+* reader - read one basin with ResultsReader after the split
+
+Requires numpy, pandas and xarray packages
+"""
+
+import argparse
+import pathlib
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'demo1'))
+from results_reader import ResultsReader
+
+
+def make_results(n_basins: int, n_days: int) -> dict:
+    """Returns results dictionary with nh test_results.p structure."""
+    dates = pd.date_range('1989-10-01', periods=n_days, freq='D')
+    rng = np.random.default_rng(0)
+    file_dict = dict()
+    for i in range(n_basins):
+        basin_id = f'{1000000 + i:08d}'
+        ds = xr.Dataset(
+            {
+                'QObs(mm/d)_obs': (('date', 'time_step'), rng.random((n_days, 1), dtype=np.float32)),
+                'QObs(mm/d)_sim': (('date', 'time_step'), rng.random((n_days, 1), dtype=np.float32)),
+            },
+            coords=dict(date=dates, time_step=np.array([0], dtype=np.int32)),
+        )
+        file_dict[basin_id] = {'1D': {'xr': ds, 'NSE': float(rng.random())}}
+    return file_dict
+
+def measure(func) -> tuple:
+    """Returns (result, seconds, peak MB) for calling func."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+def read_pickle(pickle_path: pathlib.Path, basin_id: str):
+    with open(pickle_path, 'rb') as fp:
+        file_dict = pickle.load(fp)
+    return file_dict[basin_id]['1D']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--n_basins', type=int, default=500, help='Number of basins [500]')
+    parser.add_argument('-d', '--n_days', type=int, default=3652, help='Days in test period [3652]')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Single-basin reads to time [5]')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_dir = pathlib.Path(tmp)
+        pickle_path = model_dir / 'test_results.p'
+        file_dict = make_results(args.n_basins, args.n_days)
+        with open(pickle_path, 'wb') as fp:
+            pickle.dump(file_dict, fp)
+        basin_ids = list(file_dict)
+        del file_dict
+        size_mb = pickle_path.stat().st_size / 1e6
+        print(f'{args.n_basins} basins, {args.n_days} days, test_results.p {size_mb:.1f} MB')
+        print()
+        print(f'{"method":<8} {"sec/read":>10} {"peak MB":>10}')
+
+        times, peaks = list(), list()
+        for basin_id in basin_ids[:args.repeat]:
+            _, elapsed, peak = measure(lambda: read_pickle(pickle_path, basin_id))
+            times.append(elapsed)
+            peaks.append(peak)
+        print(f'{"pickle":<8} {np.mean(times):>10.4f} {max(peaks):>10.1f}')
+
+        reader = ResultsReader(model_dir)
+        _, elapsed, peak = measure(reader.split)
+        print(f'{"split":<8} {elapsed:>10.4f} {peak:>10.1f}  (once per evaluation)')
+
+        times, peaks = list(), list()
+        for basin_id in basin_ids[:args.repeat]:
+            reader = ResultsReader(model_dir)
+            oned_dict, elapsed, peak = measure(lambda: reader.read(basin_id))
+            times.append(elapsed)
+            peaks.append(peak)
+            expected = read_pickle(pickle_path, basin_id)
+            assert oned_dict['xr'].equals(expected['xr']) and oned_dict['NSE'] == expected['NSE']
+        print(f'{"reader":<8} {np.mean(times):>10.4f} {max(peaks):>10.1f}')
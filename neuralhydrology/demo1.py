@@ -9,7 +9,9 @@ import pathlib
 import sys
 
 from demo1.args_utils import add_standard_arguments, validate_inputs
-from demo1.demo_run import DemoRun
+from demo1.demo_run import DEFAULT_ARTIFACTS, DemoRun
+from demo1.instrument import METRICS_FILENAME
+from demo1.scheduler import SweepScheduler
 
 # Container image constants
 #[registry-hostname]/[username/organization-name]/[image-name]:[tag]
@@ -24,7 +26,17 @@ def main():
         description=__doc__,
         epilog=f'Note: You can also put arguments in {ARGS_FILENAME} file',
         fromfile_prefix_chars='@')
-    add_standard_arguments(parser)
+    add_standard_arguments(parser, with_batch=True)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='Number of basins to run in parallel containers, used with --basin_list [1]')
+    parser.add_argument('-w', '--warm_workers', action='store_true',
+        help='run basins as jobs on persistent worker containers (use -k to keep them running)')
+    parser.add_argument('-x', '--bind_experiments', action='store_true',
+        help='mount experiments_dir in the container, instead of copying results out')
+    parser.add_argument('-z', '--zarr_results', action='store_true',
+        help='also write test results to experiments_dir/results.zarr (requires -x)')
+    parser.add_argument('-a', '--all_artifacts', action='store_true',
+        help='copy the full run directory, including weights for every epoch')
     parser.add_argument('-l', '--local_image_build', action='store_true',
         help='use locally built docker image')
     parser.add_argument('-k', '--keep_container', action='store_true',
@@ -36,6 +48,8 @@ def main():
     # print(args)
 
     try:
+        if args.zarr_results and not args.bind_experiments:
+            raise ValueError('--zarr_results requires --bind_experiments, since results.zarr is not copied out')
         validate_inputs(args)
     except Exception as e:
         print(f'Error: {e}')
@@ -43,7 +57,17 @@ def main():
         sys.exit(2)
 
     image = IMAGE_NAME if args.local_image_build else f'{IMAGE_REGISTRY_USER}/{IMAGE_NAME}'
-    runner = DemoRun(image, args.data_dir, verbose=args.verbose)
+    artifacts = None if args.all_artifacts else DEFAULT_ARTIFACTS
+    run_options = dict(
+        verbose=args.verbose,
+        bind_experiments=args.bind_experiments,
+        artifacts=artifacts,
+        cache_dir=args.cache_dir,
+        device=args.device,
+        metrics_path=pathlib.Path(args.experiments_dir) / METRICS_FILENAME,
+        zarr_results=args.zarr_results,
+    )
+    runner = DemoRun(image, args.data_dir, **run_options)
     if not runner.is_image_available():
         print()
         if args.local_image_build:
@@ -54,6 +78,30 @@ def main():
         sys.exit(1)
 
     print(f'Container image was found: {image}')
+    if args.warm_workers:
+        scheduler = SweepScheduler(image, args.data_dir, max_workers=args.jobs, **run_options)
+        manifest = getattr(args, 'manifest', None)
+        results = scheduler.run_warm(
+            args.basin_ids,
+            pathlib.Path(args.experiments_dir),
+            epochs=args.training_epochs,
+            manifest_path=None if manifest is None else pathlib.Path(manifest),
+            keep_workers=args.keep_container,
+            )
+        scheduler.print_summary(results)
+        return
+
+    if args.basin_list:
+        scheduler = SweepScheduler(image, args.data_dir, max_workers=args.jobs, **run_options)
+        results = scheduler.run(
+            args.basin_ids,
+            pathlib.Path(args.experiments_dir),
+            epochs=args.training_epochs,
+            manifest_path=pathlib.Path(args.manifest),
+            )
+        scheduler.print_summary(results)
+        return
+
     runner.execute(
         args.basin_id,
         pathlib.Path(args.experiments_dir),
@@ -7,53 +7,122 @@ import argparse
 import pathlib
 import sys
 
+# Shared by the host scripts (package imports) and the container scripts
+try:
+    from .basin_catalog import BasinCatalog
+except ImportError:
+    from basin_catalog import BasinCatalog
+
 # Optional filename for command line args
 ARGS_FILENAME = '.args.txt'
 DEFAULT_EPOCHS = 50
 
+# Batch modes: one model per basin (in a single process) or one regional model
+BATCH_MODES = ['per_basin', 'regional']
+BATCH_MANIFEST_FILENAME = 'batch_manifest.json'
+
+STEPS = ['train', 'test', 'predict']
+
 
-def add_standard_arguments(parser: argparse.ArgumentParser, with_step: bool = False):
+def add_standard_arguments(parser: argparse.ArgumentParser,
+        with_step: bool = False, with_batch: bool = False):
     """Configures standard arguments for local or container scripts."""
     if with_step:
         parser.add_argument('-s', '--step',
-            required=True, choices=['train', 'test'], help='Select train or test')
+            required=True, choices=STEPS, help='Select train, test or predict')
     parser.add_argument('-d', '--data_dir', required=True, help='Path to CAMELS-US dataset')
     parser.add_argument('-e', '--experiments_dir', required=True,
         help='Directory for saving results')
-    parser.add_argument('-b', '--basin_id', required=True, help='8-digit CAMELS-US basin id')
+    parser.add_argument('-c', '--cache_dir',
+        help='Columnar store built by camels_store.py [data_dir/nh_store, if present]')
+    if with_batch:
+        basin_group = parser.add_mutually_exclusive_group(required=True)
+        basin_group.add_argument('-b', '--basin_id', help='8-digit CAMELS-US basin id')
+        basin_group.add_argument('-B', '--basin_list',
+            help='Text file with one basin id per line, or glob pattern of basin ids (e.g. "0245*")')
+        parser.add_argument('--manifest',
+            help=f'Batch manifest file [experiments_dir/{BATCH_MANIFEST_FILENAME}]')
+    else:
+        parser.add_argument('-b', '--basin_id', required=True, help='8-digit CAMELS-US basin id')
     parser.add_argument('-r', '--run_id',
-        help='Run id for model (required for test step, not used for training)')
+        help='Run id for model (required for test and predict steps, not used for training);'
+            ' "latest" selects the most recent run')
     parser.add_argument('-t', '--training_epochs', type=int, default=f'{DEFAULT_EPOCHS}',
         help=f'Number of training epochs [{DEFAULT_EPOCHS}]')
+    parser.add_argument('--device', default='auto',
+        help='Training device: auto, cpu, cuda:N or mps (auto uses cuda:0 if available) [auto]')
     parser.add_argument('-n', '--dry-run', action='store_true',
         help='Dry run (to check input args for validity)')
     parser.add_argument('-v', '--verbose', action='store_true',
         help='Print more info to stdout')
 
+def normalize_basin_id(basin_id: str) -> str:
+    """Returns 8-digit basin id, raising ValueError if invalid."""
+    basin_id = basin_id.strip()
+    if len(basin_id) == 7:
+        print(f'Inserting 0 in front of 7-digit basin_id {basin_id}')
+        basin_id = f'0{basin_id}'
+    if len(basin_id) != 8:
+        raise ValueError(f'Invalid basin id {basin_id} - must be 8 digits')
+    return basin_id
+
+def read_basin_list(basin_list: str,
+        camels_path: pathlib.Path,
+        catalog: BasinCatalog|None = None) -> list[str]:
+    """Returns basin ids from a list file, or matching a glob pattern.
+
+    List files have one basin id per line; blank lines and # comments are ignored.
+    Otherwise basin_list is matched against the basin ids in the CAMELS dataset.
+    """
+    list_path = pathlib.Path(basin_list)
+    if list_path.is_file():
+        basin_ids = list()
+        with open(list_path) as fp:
+            for line in fp:
+                text = line.split('#')[0].strip()
+                if text:
+                    basin_ids.append(normalize_basin_id(text))
+    else:
+        if catalog is None:
+            catalog = BasinCatalog.load(camels_path)
+        basin_ids = catalog.match(basin_list)
+
+    # Remove duplicates but preserve order
+    basin_ids = list(dict.fromkeys(basin_ids))
+    if not basin_ids:
+        raise ValueError(f'No basins found for basin_list {basin_list}')
+    return basin_ids
+
 def validate_inputs(args: argparse.Namespace) -> None:
-    """"""
-        # Check that data_dir exists
+    """Checks input arguments and sets args.basin_ids to the list of basins to run."""
+    # Check that data_dir exists
     camels_path = pathlib.Path(args.data_dir)
     if not camels_path.exists():
         raise FileNotFoundError(f'data_dir not found: {camels_path}')
 
-    # Check for valid basin_id
-    if len(args.basin_id) == 7:
-        print('Inserting 0 in front of 7-digit basid_id {args.basin_id}')
-        args.basin_id = f'0{args.basin_id}'
-    if len(args.basin_id) != 8:
-        raise ValueError(f'Invalid basin id {args.basin_id} - must be 8 digits')
+    cache_dir = getattr(args, 'cache_dir', None)
+    if cache_dir is not None and not pathlib.Path(cache_dir).exists():
+        raise FileNotFoundError(f'cache_dir not found: {cache_dir}')
+
+    # Index of basins in camels (data_dir), which is saved after the first run
+    catalog = BasinCatalog.load(camels_path)
 
-    if 'step' in args and args.step == 'test' and args.run_id is None:
-        raise ValueError('No run_id argument. Must be provided for test step')
+    # Check for valid basin_id or basin_list
+    basin_list = getattr(args, 'basin_list', None)
+    if basin_list:
+        args.basin_ids = read_basin_list(basin_list, camels_path, catalog)
+        print(f'Basin list contains {len(args.basin_ids)} basins')
+    else:
+        args.basin_id = normalize_basin_id(args.basin_id)
+        args.basin_ids = [args.basin_id]
 
-    # Check for basin_id in camels (data_dir); streamflow file should be sufficient
-    pattern = f'usgs_streamflow/*/{args.basin_id}*.txt'
-    matches = camels_path.glob(pattern)
-    try:
-        first_match = next(matches)
-    except StopIteration:
-        raise FileNotFoundError(f'Unable to find base {args.basin_id} in CAMELS data')
+    if 'step' in args and args.step in ['test', 'predict'] and args.run_id is None and not basin_list:
+        raise ValueError(f'No run_id argument. Must be provided for {args.step} step')
+
+    # Check for basin_ids in camels (data_dir); streamflow file should be sufficient
+    missing = catalog.missing(args.basin_ids)
+    if missing:
+        raise FileNotFoundError(f'Unable to find {len(missing)} basins in CAMELS data: {" ".join(missing)}')
 
     # Make sure experiments_dir exists
     exp_dir = pathlib.Path(args.experiments_dir)
@@ -68,3 +137,10 @@ def validate_inputs(args: argparse.Namespace) -> None:
         print(f'Creating {exp_dir}')
         # Create .scratch folder too
         scratch_dir.mkdir(parents=True, exist_ok=True)
+
+    # Batch test and predict steps read run ids from the training manifest
+    if basin_list and getattr(args, 'manifest', None) is None:
+        args.manifest = str(exp_dir / BATCH_MANIFEST_FILENAME)
+    if basin_list and 'step' in args and args.step in ['test', 'predict']:
+        if not pathlib.Path(args.manifest).exists():
+            raise FileNotFoundError(f'Batch manifest not found: {args.manifest}')
@@ -0,0 +1,165 @@
+"""
+This module provides a BasinCatalog class, an index of the basins in a CAMELS-US dataset.
+
+The catalog maps each basin id to its HUC, its streamflow file and its forcing
+files. It is built by listing the dataset directories once, then saved as a
+json file in the data directory (or in the user cache directory, if the data
+directory is read-only). The saved catalog is rebuilt when the modification
+time of any indexed directory changes, so lookups do not list the dataset.
+"""
+
+import fnmatch
+import hashlib
+import json
+import os
+import pathlib
+
+CATALOG_FILENAME = 'basin_catalog.json'
+CATALOG_VERSION = 1
+CACHE_DIR = pathlib.Path.home() / '.cache' / 'demo1'
+
+STREAMFLOW_DIRNAME = 'usgs_streamflow'
+FORCING_DIRNAME = 'basin_mean_forcing'
+STREAMFLOW_SUFFIX = '_streamflow_qc.txt'
+FORCING_SUFFIX = '_forcing_leap.txt'
+
+
+class BasinCatalog:
+    """Index of basin id => HUC and data files for one CAMELS-US dataset.
+    """
+    def __init__(self, data_dir: str|pathlib.Path, catalog: dict):
+        """Use BasinCatalog.load() to create a catalog."""
+        self.data_dir = pathlib.Path(data_dir)
+        self.catalog = catalog
+        self.basins = catalog['basins']
+
+    @classmethod
+    def load(cls, data_dir: str|pathlib.Path, rebuild: bool = False) -> 'BasinCatalog':
+        """Returns catalog for data_dir, reading the saved catalog if it is current."""
+        data_dir = pathlib.Path(data_dir)
+        if not rebuild:
+            for path in _catalog_paths(data_dir):
+                catalog = _read_catalog(path)
+                if catalog is not None and _is_current(data_dir, catalog):
+                    return cls(data_dir, catalog)
+
+        catalog = _build_catalog(data_dir)
+        _save_catalog(data_dir, catalog)
+        return cls(data_dir, catalog)
+
+    def __contains__(self, basin_id: str) -> bool:
+        return basin_id in self.basins
+
+    def __len__(self) -> int:
+        return len(self.basins)
+
+    def get(self, basin_id: str) -> dict|None:
+        """Returns entry with huc, streamflow path and forcing paths, or None if not found.
+
+        Paths are relative to data_dir.
+        """
+        return self.basins.get(basin_id)
+
+    def basin_ids(self) -> list[str]:
+        """Returns sorted list of all basin ids."""
+        return sorted(self.basins)
+
+    def match(self, pattern: str) -> list[str]:
+        """Returns sorted basin ids matching glob pattern."""
+        return sorted(fnmatch.filter(self.basins, pattern))
+
+    def missing(self, basin_ids: list[str], forcings: list[str]|None = None) -> list[str]:
+        """Returns the input basins that are not in the catalog, or lack any of the forcings."""
+        missing = list()
+        for basin_id in basin_ids:
+            entry = self.basins.get(basin_id)
+            if entry is None or any(f not in entry['forcings'] for f in forcings or []):
+                missing.append(basin_id)
+        return missing
+
+
+def _catalog_paths(data_dir: pathlib.Path) -> list[pathlib.Path]:
+    """Returns catalog locations in the data directory and the user cache."""
+    key = hashlib.sha1(str(data_dir.resolve()).encode()).hexdigest()[:12]
+    return [data_dir / CATALOG_FILENAME, CACHE_DIR / f'basin_catalog_{key}.json']
+
+def _read_catalog(path: pathlib.Path) -> dict|None:
+    """Returns saved catalog, or None if missing or unreadable."""
+    try:
+        with open(path) as fp:
+            catalog = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if catalog.get('version') != CATALOG_VERSION:
+        return None
+    return catalog
+
+def _save_catalog(data_dir: pathlib.Path, catalog: dict) -> None:
+    """Writes catalog to the first writable location."""
+    for path in _catalog_paths(data_dir):
+        tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'w') as fp:
+                json.dump(catalog, fp)
+            os.replace(tmp_path, path)
+            return
+        except OSError:
+            continue
+    print('Warning: unable to save basin catalog')
+
+def _indexed_dirs(data_dir: pathlib.Path) -> list[pathlib.Path]:
+    """Returns directories whose contents are indexed (and whose mtimes are checked)."""
+    dirs = list()
+    for top in [data_dir / STREAMFLOW_DIRNAME, data_dir / FORCING_DIRNAME]:
+        if top.is_dir():
+            dirs.append(top)
+    streamflow_dir = data_dir / STREAMFLOW_DIRNAME
+    if streamflow_dir.is_dir():
+        dirs += sorted(p for p in streamflow_dir.iterdir() if p.is_dir())
+    forcing_dir = data_dir / FORCING_DIRNAME
+    if forcing_dir.is_dir():
+        for product_dir in sorted(p for p in forcing_dir.iterdir() if p.is_dir()):
+            dirs.append(product_dir)
+            dirs += sorted(p for p in product_dir.iterdir() if p.is_dir())
+    return dirs
+
+def _is_current(data_dir: pathlib.Path, catalog: dict) -> bool:
+    """Checks the saved directory mtimes against the dataset."""
+    for rel_path, mtime in catalog['mtimes'].items():
+        try:
+            if os.stat(data_dir / rel_path).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+def _build_catalog(data_dir: pathlib.Path) -> dict:
+    """Lists the dataset directories and returns catalog dictionary."""
+    dirs = _indexed_dirs(data_dir)
+    mtimes = {str(p.relative_to(data_dir)): p.stat().st_mtime_ns for p in dirs}
+
+    basins = dict()
+    streamflow_dir = data_dir / STREAMFLOW_DIRNAME
+    for huc_dir in (p for p in dirs if p.parent == streamflow_dir):
+        for name in os.listdir(huc_dir):
+            if not name.endswith(STREAMFLOW_SUFFIX):
+                continue
+            basin_id = name[:8]
+            basins[basin_id] = dict(
+                huc=huc_dir.name,
+                streamflow=str((huc_dir / name).relative_to(data_dir)),
+                forcings=dict(),
+            )
+
+    # Forcing files are in <product>/<huc>/<basin>_lump_<source>_forcing_leap.txt
+    forcing_dir = data_dir / FORCING_DIRNAME
+    for huc_dir in (p for p in dirs if p.parent.parent == forcing_dir):
+        product = huc_dir.parent.name
+        for name in os.listdir(huc_dir):
+            entry = basins.get(name[:8])
+            if entry is None or not name.endswith(FORCING_SUFFIX):
+                continue
+            entry['forcings'][product] = str((huc_dir / name).relative_to(data_dir))
+
+    return dict(version=CATALOG_VERSION, mtimes=mtimes, basins=basins)
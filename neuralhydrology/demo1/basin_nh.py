@@ -9,15 +9,91 @@ in the input arguments.
 """
 
 import argparse
+import datetime
+import json
+import logging
+import logging.handlers
 import os
 import pathlib
-import pickle
+import shutil
 import string
+import sys
+import tempfile
+import time
 
 import xarray as xr
 
 from neuralhydrology import nh_run
-from constants import RUN_ID_FILENAME
+from neuralhydrology.evaluation.metrics import AllNaNError, calculate_metrics
+from neuralhydrology.training.basetrainer import BaseTrainer
+from neuralhydrology.utils.config import Config
+from args_utils import BATCH_MANIFEST_FILENAME
+from camels_store import STORE_DIRNAME, CamelsStore
+from checkpoints import DEFAULT_KEEP_LAST, CheckpointPruner, CheckpointRetention, read_best_epoch
+from device_profile import AUTO_DEVICE, detect_profile
+from instrument import get_instrument
+from predictor import STATEFUL_CHECK_DAYS, STATEFUL_TOLERANCE, get_predictor
+from constants import LATEST_RUN_ID, REGIONAL_DIRNAME
+from results_reader import ResultsReader
+from results_store import RESULTS_STORE_DIRNAME, ResultsStore
+from run_index import RunIndex
+
+# Number of tries to create a new run directory
+RUN_DIR_ATTEMPTS = 5
+# Basin list file kept in each run directory
+BASIN_FILENAME = 'basins.txt'
+# nh log file in each run directory, and its format
+LOG_FILENAME = 'output.log'
+NH_LOG_FORMAT = '%(asctime)s: %(message)s'
+# Log records kept while the trainer creates the run directory
+MAX_EARLY_LOG_RECORDS = 10000
+
+
+def start_nh_logging(log_path: pathlib.Path|None = None) -> None:
+    """Sets up logging to stdout and log_path for one nh run, replacing the previous run's handlers.
+
+    nh sets up logging to the run's output.log with logging.basicConfig, which
+    does nothing once the root logger has handlers, so every later run in the
+    process (batch training, workers, sweep trials) would log to the first
+    run's output.log. Without log_path, records are held in memory until
+    set_run_log(), since the trainer logs while it creates the run directory.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, (logging.FileHandler, logging.handlers.MemoryHandler)) or \
+                (isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout):
+            root.removeHandler(handler)
+            handler.close()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_path is None:
+        handlers.append(logging.handlers.MemoryHandler(MAX_EARLY_LOG_RECORDS, flushLevel=logging.CRITICAL + 1))
+    else:
+        handlers.append(logging.FileHandler(log_path))
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(NH_LOG_FORMAT))
+        root.addHandler(handler)
+    if root.getEffectiveLevel() > logging.INFO:
+        root.setLevel(logging.INFO)
+
+
+def set_run_log(log_path: pathlib.Path) -> None:
+    """Writes the records held since start_nh_logging() to log_path, and logs there from now on."""
+    root = logging.getLogger()
+    file_handler = logging.FileHandler(log_path)
+    file_handler.setFormatter(logging.Formatter(NH_LOG_FORMAT))
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.MemoryHandler):
+            root.removeHandler(handler)
+            handler.setTarget(file_handler)
+            handler.close()
+    root.addHandler(file_handler)
+
+
+class StopTraining(Exception):
+    """Raised by an epoch hook to end training before epoch, keeping the epochs trained so far."""
+    def __init__(self, message: str, epoch: int):
+        super().__init__(message)
+        self.epoch = epoch
 
 class BasinNH:
     """A class for running Google neural hydrology code for a single basin.
@@ -30,100 +106,516 @@ class BasinNH:
         * data_dir - the root of the CAMELS-US dataset
         * experiments_dir - which must already exist
         * basin_id - 8 digit id of one entry in CAMELS-US
+          (batch methods use basin_ids, the list of basins to run, instead)
         * run_id - folder where model is stored (only required for testing steps)
+        * cache_dir - (optional) columnar store built by camels_store.py
+        * zarr_results - (optional) also write test results to experiments_dir/results.zarr
+        * device - (optional) training device, default auto
+        * keep_checkpoints - (optional) number of most recent epochs' weights to keep
+        * stateful - (optional) test and predict by carrying LSTM state through the period
+          instead of evaluating one seq_length window per day (see predictor.py)
+        * reevaluate - (optional) rerun nh evaluation when testing, instead of reusing
+          test results that are newer than the model weights and run config
 
         Note: The calling code responsible for argument checking.
         """
         self.args = args
         self.scratch_dir = pathlib.Path(self.args.experiments_dir) / '.scratch'
 
+        # Size torch threads and DataLoader workers to the cores available
+        self.profile = detect_profile(getattr(self.args, 'device', None) or AUTO_DEVICE)
+        self.profile.apply()
+        print(f'Using device {self.profile.device} with {self.profile.cpus} cores'
+            f' ({self.profile.torch_threads} torch threads, {self.profile.num_workers} data workers)')
+
     def run_training(self) -> str:
         """Runs training based on passed in configuration.
 
         Returns run_id (or None)
         """
-        # Set up experiment directory as cwd
         basin_dir = pathlib.Path(self.args.experiments_dir) / self.args.basin_id
-        basin_dir.mkdir(exist_ok=True)
-        os.chdir(basin_dir)
-
-        # Generate basin.txt file
-        txt_path = self.scratch_dir / 'basin.txt'
-        with open(txt_path, 'w') as fp:
-            fp.write(self.args.basin_id)
-
-        # Generate basin.yml
-        yml_path = self.scratch_dir / 'basin.yml'
-        self._generate_config_file(yml_path)
-
-        # Because nh generates the run directory internally, we don't have access to
-        # the directory name used for the run. For now, we will infer the run_id by
-        # finding the latest run directory in the basin directory.
-        # We do this before and after training, to make sure that a new run directory
-        # was in fact created.
-        parent_dir = basin_dir / 'runs'
-        last_run_id = self._get_latest_run_id(parent_dir)
-
-        # Call start_run() which does training and validation
-        nh_run.start_run(yml_path)
-
-        # Get latest run_id which *should* be different than last_run_id
-        next_run_id = self._get_latest_run_id(parent_dir)
-        run_id = next_run_id if next_run_id != last_run_id else None
-
-        # Write run_id to file in scratch directory
-        path = self.scratch_dir / RUN_ID_FILENAME
-        with open(path, 'w') as fp:
-            text = 'missing' if run_id is None else run_id
-            fp.write(text)
+        return self._train([self.args.basin_id], basin_dir)
 
-        return run_id
+    def run_trial(self,
+            basin_ids: list[str],
+            trial_dir: pathlib.Path,
+            config_overrides: dict|None = None,
+            epoch_hook=None) -> str | None:
+        """Trains one model for the basins with config overrides, storing runs in trial_dir.
+
+        config_overrides replace template settings (e.g. hidden_size, learning_rate).
+        epoch_hook(epoch, run_dir) is called before each training epoch, and can
+        raise StopTraining to end training early (see sweep.py).
+
+        Returns run_id (or None)
+        """
+        return self._train(basin_ids, trial_dir, config_overrides=config_overrides, epoch_hook=epoch_hook)
+
+    def run_batch_training(self,
+            basin_ids: list[str],
+            regional: bool = False,
+            manifest_path: pathlib.Path | None = None) -> dict:
+        """Trains models for a list of basins in this process.
+
+        If regional is True, trains one model on all basins. Otherwise
+        trains one model per basin, reusing the imported packages.
+        The manifest (basin_id => run info) is written after each run
+        so that partial results are recorded.
+
+        Returns the manifest dictionary.
+        """
+        exp_dir = pathlib.Path(self.args.experiments_dir)
+        manifest = dict(
+            mode='regional' if regional else 'per_basin',
+            training_epochs=self.args.training_epochs,
+            runs=dict(),
+        )
+        runs = manifest['runs']
+
+        if regional:
+            basin_dir = exp_dir / REGIONAL_DIRNAME
+            run_id = self._train(basin_ids, basin_dir)
+            for basin_id in basin_ids:
+                runs[basin_id] = self._manifest_entry(REGIONAL_DIRNAME, run_id)
+            self.write_manifest(manifest, manifest_path)
+            return manifest
+
+        for i, basin_id in enumerate(basin_ids, start=1):
+            print(f'Training basin {basin_id} ({i}/{len(basin_ids)})')
+            try:
+                run_id = self._train([basin_id], exp_dir / basin_id)
+            except Exception as e:
+                print(f'Error: training failed for basin {basin_id}: {e}')
+                run_id = None
+            runs[basin_id] = self._manifest_entry(basin_id, run_id)
+            self.write_manifest(manifest, manifest_path)
+
+        return manifest
 
     def run_testing(self, write_nc: bool = True) -> xr.Dataset:
-        """"""
+        """Tests the model in run_id for the basin_id in the input args.
+
+        Returns the results dataset (or None)
+        """
+        run_dir = self._basin_run_dir()
+        results = self._test([self.args.basin_id], run_dir, write_nc=write_nc)
+        return results.get(self.args.basin_id)
+
+    def run_batch_testing(self, manifest: dict, write_nc: bool = True) -> dict:
+        """Tests the models listed in a batch manifest.
+
+        Each run directory is evaluated once, so regional models are
+        evaluated a single time for all of their basins.
+
+        Returns dictionary of basin_id => results dataset (or None)
+        """
         exp_dir = pathlib.Path(self.args.experiments_dir)
-        run_dir = exp_dir / self.args.basin_id / 'runs' / self.args.run_id
-        # print(f'{run_dir=}')
-        nh_run.eval_run(run_dir, 'test')
+        results = dict()
+        for run_dir, basin_ids in self._basins_by_run(manifest).items():
+            print(f'Testing {run_dir} ({len(basin_ids)} basins)')
+            try:
+                results.update(self._test(basin_ids, exp_dir / run_dir, write_nc=write_nc))
+            except Exception as e:
+                print(f'Error: testing failed for {run_dir}: {e}')
+        return results
+
+    def run_prediction(self, start_date: str, end_date: str, manifest: dict|None = None) -> xr.Dataset:
+        """Predicts for the basins in the input args between start and end dates.
+
+        Without a manifest, uses the run_id in the input args for basin_id.
+        With a batch manifest, each run's model predicts all of its basins at once.
+
+        Returns dataset with basin and date dimensions
+        """
+        if manifest is None:
+            return self.predict([self.args.basin_id], start_date, end_date, self._basin_run_dir())
 
-        # Find the latest results directory
-        test_dir = run_dir / 'test'
-        model_dir = self._get_latest_dir(test_dir, 'model_epoch')
-        # print(f'{model_dir=}')
+        exp_dir = pathlib.Path(self.args.experiments_dir)
+        parts = list()
+        for run_dir, basin_ids in self._basins_by_run(manifest).items():
+            print(f'Predicting {run_dir} ({len(basin_ids)} basins)')
+            parts.append(self.predict(basin_ids, start_date, end_date, exp_dir / run_dir))
+        if not parts:
+            raise ValueError('No runs in manifest for the selected basins')
+        return xr.concat(parts, dim='basin', combine_attrs='drop')
+
+    def predict(self,
+            basin_ids: list[str],
+            start_date: str,
+            end_date: str,
+            run_dir: pathlib.Path) -> xr.Dataset:
+        """Runs the model in run_dir for the basins between start and end dates.
+
+        The model, scalers and basin datasets stay cached in this process,
+        so repeated calls only run the forward pass.
+
+        Returns dataset with basin and date dimensions
+        """
+        epoch = read_best_epoch(run_dir) or Config(run_dir / 'config.yml').epochs
+        with get_instrument().phase('predict', basins=len(basin_ids)):
+            predictor = get_predictor(run_dir, epoch, device=self.profile.device)
+            return predictor.predict(basin_ids, start_date, end_date,
+                stateful=getattr(self.args, 'stateful', False))
+
+    def write_manifest(self, manifest: dict, manifest_path: pathlib.Path | None = None) -> None:
+        """Writes batch manifest as json file."""
+        if manifest_path is None:
+            manifest_path = pathlib.Path(self.args.experiments_dir) / BATCH_MANIFEST_FILENAME
+        with open(manifest_path, 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+
+    @staticmethod
+    def read_manifest(manifest_path: pathlib.Path | str) -> dict:
+        """Reads batch manifest written by run_batch_training()."""
+        with open(manifest_path) as fp:
+            return json.load(fp)
+
+    def _basin_run_dir(self) -> pathlib.Path:
+        """Returns run directory for basin_id and run_id in the input args, resolving "latest"."""
+        runs_dir = pathlib.Path(self.args.experiments_dir) / self.args.basin_id / 'runs'
+        if self.args.run_id == LATEST_RUN_ID:
+            entry = RunIndex(runs_dir).latest()
+            if entry is None:
+                raise FileNotFoundError(f'No runs in index for basin {self.args.basin_id}')
+            self.args.run_id = entry['run_id']
+            print(f'Using latest run {self.args.run_id}')
+        return runs_dir / self.args.run_id
+
+    def _basins_by_run(self, manifest: dict) -> dict:
+        """Returns run_dir => basin ids, for the selected basins in a batch manifest."""
+        selected = set(self.args.basin_ids)
+        basins_by_run = dict()
+        for basin_id, entry in manifest['runs'].items():
+            if basin_id not in selected:
+                continue
+            if entry.get('run_id') is None:
+                print(f'Skipping basin {basin_id} (no run_id in manifest)')
+                continue
+            basins_by_run.setdefault(entry['run_dir'], []).append(basin_id)
+        return basins_by_run
+
+    def _manifest_entry(self, group_dir: str, run_id: str | None) -> dict:
+        """Returns manifest entry for one basin."""
+        run_dir = None if run_id is None else f'{group_dir}/runs/{run_id}'
+        return dict(run_id=run_id, run_dir=run_dir)
+
+    def _train(self,
+            basin_ids: list[str],
+            basin_dir: pathlib.Path,
+            config_overrides: dict|None = None,
+            epoch_hook=None) -> str | None:
+        """Trains one model for the input basins, storing runs in basin_dir.
 
-        # Get epoch count from the directory name
-        epochs = self._get_epoch_count(model_dir.name)
-
-        # Get the results file and return dataset
-        results_path = model_dir / 'test_results.p'
-        with open(results_path, 'rb') as fp:
-            file_dict = pickle.load(fp)
-            basin_dict = file_dict.get(self.args.basin_id, {})
-            oned_dict = basin_dict.get('1D', {})
-
-        # Sanity check
-        if not oned_dict:
-            return None
-
-        # Add NSE as attribute on xaray
-        xr_dataset = oned_dict.get('xr')
-        nse = oned_dict.get('NSE')
-        atts = dict(
-            NSE=nse,
-            basin=self.args.basin_id,
-            run=self.args.run_id,
-            epochs=epochs,
+        Returns run_id (or None)
+        """
+        runs_dir = basin_dir / 'runs'
+        runs_dir.mkdir(parents=True, exist_ok=True)
+
+        # Use a separate scratch folder for each training, because the
+        # experiments directory can be shared by concurrent containers.
+        # It is removed once the run directory has the basin file and config.
+        self.scratch_dir.mkdir(parents=True, exist_ok=True)
+        instrument = get_instrument()
+        with tempfile.TemporaryDirectory(prefix='train_', dir=self.scratch_dir) as tmp_dir:
+            train_scratch_dir = pathlib.Path(tmp_dir)
+            with instrument.phase('config'):
+                # Generate basin.txt file
+                txt_path = train_scratch_dir / 'basin.txt'
+                with open(txt_path, 'w') as fp:
+                    fp.write('\n'.join(basin_ids))
+
+                # Generate basin.yml, which sets runs_dir as the parent of the run directory
+                yml_path = train_scratch_dir / 'basin.yml'
+                self._generate_config_file(yml_path, txt_path, runs_dir, basin_ids)
+
+            # The trainer appends the run name (with a timestamp) to config.run_dir,
+            # so read the run directory back from the config instead of searching for it
+            with instrument.phase('data_load', basins=len(basin_ids)):
+                trainer, config = self._create_trainer(yml_path, config_overrides)
+                trainer.initialize_training()
+            self._move_basin_file(config, txt_path)
+        self._instrument_trainer(trainer)
+        if epoch_hook is not None:
+            self._add_epoch_hook(trainer, epoch_hook, config.run_dir)
+
+        # Delete checkpoints that are neither recent nor best while training
+        keep_last = getattr(self.args, 'keep_checkpoints', None) or DEFAULT_KEEP_LAST
+        retention = CheckpointRetention(config.run_dir, keep_last=keep_last,
+            validate_every=config.validate_every)
+        pruner = CheckpointPruner(retention)
+        pruner.start()
+        stopped_epoch = None
+        try:
+            with instrument.phase('train', epochs=config.epochs):
+                trainer.train_and_validate()
+        except StopTraining as e:
+            stopped_epoch = e.epoch
+            print(f'Training stopped before epoch {e.epoch}: {e}')
+        finally:
+            checkpoints = pruner.stop()
+        print(f'Best epoch {checkpoints["best_epoch"]}, kept weights for epochs {checkpoints["kept_epochs"]}')
+
+        run_id = config.run_dir.name
+        entry = dict(
+            run_id=run_id,
+            basins=basin_ids,
+            epochs=config.epochs,
+            best_epoch=checkpoints['best_epoch'],
+            created=datetime.datetime.now().isoformat(timespec='seconds'),
         )
-        ds = xr_dataset.assign_attrs(atts)
+        if stopped_epoch is not None:
+            entry['stopped_epoch'] = stopped_epoch
+        RunIndex(runs_dir).append(entry)
+        return run_id
+
+    def _move_basin_file(self, config: Config, txt_path: pathlib.Path) -> None:
+        """Copies the basin file to the run directory and points the run's config.yml at it.
+
+        nh reads the basin files again when testing, after the scratch folder is removed.
+        """
+        basin_path = config.run_dir / BASIN_FILENAME
+        shutil.copy2(txt_path, basin_path)
+        config.update_config({f'{period}_basin_file': basin_path for period in ['train', 'validation', 'test']})
+        # nh's dump_config does not overwrite, so replace config.yml with a new dump
+        tmp_name = 'config.yml.tmp'
+        config.dump_config(config.run_dir, filename=tmp_name)
+        os.replace(config.run_dir / tmp_name, config.run_dir / 'config.yml')
+
+    def _instrument_trainer(self, trainer: BaseTrainer) -> None:
+        """Records each training epoch and validation as instrument phases."""
+        instrument = get_instrument()
+        train_epoch = trainer._train_epoch
+
+        def timed_train_epoch(epoch: int):
+            with instrument.phase('train_epoch', epoch=epoch):
+                train_epoch(epoch=epoch)
+
+        trainer._train_epoch = timed_train_epoch
+        if trainer.validator is None:
+            return
+        evaluate = trainer.validator.evaluate
+
+        def timed_evaluate(*args, **kwargs):
+            with instrument.phase('validation', epoch=kwargs.get('epoch')):
+                return evaluate(*args, **kwargs)
+
+        trainer.validator.evaluate = timed_evaluate
+
+    def _add_epoch_hook(self, trainer: BaseTrainer, epoch_hook, run_dir: pathlib.Path) -> None:
+        """Calls epoch_hook(epoch, run_dir) before the trainer runs each epoch."""
+        train_epoch = trainer._train_epoch
+
+        def hooked_train_epoch(epoch: int):
+            epoch_hook(epoch, run_dir)
+            train_epoch(epoch=epoch)
+
+        trainer._train_epoch = hooked_train_epoch
+
+    def _create_trainer(self, yml_path: pathlib.Path, config_overrides: dict|None = None) -> tuple:
+        """Returns nh trainer and its config, with config_overrides applied.
+
+        Run names have a 1-second resolution, so a training started in the
+        same second in the same runs directory fails to create its folder;
+        in that case wait and retry.
+        """
+        for attempt in range(RUN_DIR_ATTEMPTS):
+            config = Config(yml_path)
+            if config_overrides:
+                config.update_config(config_overrides)
+            start_nh_logging()
+            try:
+                trainer = BaseTrainer(cfg=config)
+                set_run_log(config.run_dir / LOG_FILENAME)
+                return trainer, config
+            except RuntimeError as e:
+                if 'already a folder' not in str(e) or attempt == RUN_DIR_ATTEMPTS - 1:
+                    raise
+                print(f'Run directory {config.run_dir} exists, retrying')
+                time.sleep(1.0)
+
+    def _test(self,
+            basin_ids: list[str],
+            run_dir: pathlib.Path,
+            write_nc: bool = True) -> dict:
+        """Evaluates the model in run_dir and extracts results for the input basins.
+
+        Returns dictionary of basin_id => results dataset (or None)
+        """
+        # print(f'{run_dir=}')
+        # Evaluate the best epoch (by validation metric), or the final epoch
+        # if there is none, explicitly so that the results directory is known
+        epochs = Config(run_dir / 'config.yml').epochs
+        epoch = read_best_epoch(run_dir) or epochs
+        model_dir = run_dir / 'test' / f'model_epoch{epoch:03d}'
+        # print(f'{model_dir=}')
 
-        if write_nc:
-            nc_path = model_dir / 'test_results.nc'
-            ds.to_netcdf(nc_path)
-            print(f' Wrote {nc_path}')
+        stateful = getattr(self.args, 'stateful', False)
+        instrument = get_instrument()
+        with instrument.phase('eval', epoch=epoch, basins=len(basin_ids), stateful=stateful) as phase_attrs:
+            if stateful:
+                print(f'Simulating epoch {epoch} (stateful)')
+                read_results = self._stateful_results(basin_ids, run_dir, epoch).get
+                model_dir.mkdir(parents=True, exist_ok=True)
+            else:
+                # A regional model is evaluated for all of its basins at once, so results
+                # newer than the weights are reused when testing its basins one at a time
+                reader = ResultsReader(model_dir)
+                weights_path = run_dir / f'model_epoch{epoch:03d}.pt'
+                phase_attrs['reused'] = not getattr(self.args, 'reevaluate', False) and \
+                    self._has_current_results(reader, weights_path, run_dir / 'config.yml')
+                if phase_attrs['reused']:
+                    print(f'Using existing test results in {model_dir}')
+                else:
+                    print(f'Evaluating epoch {epoch}')
+                    start_nh_logging(run_dir / LOG_FILENAME)
+                    nh_run.eval_run(run_dir, 'test', epoch=epoch, gpu=self._eval_gpu())
+                    # Split the results file once, then read one basin at a time
+                    reader.split()
+                read_results = reader.read
+
+        store = None
+        if getattr(self.args, 'zarr_results', False):
+            store = ResultsStore(pathlib.Path(self.args.experiments_dir) / RESULTS_STORE_DIRNAME)
+
+        results = dict()
+        for basin_id in basin_ids:
+            with instrument.phase('read_results', basin=basin_id):
+                oned_dict = read_results(basin_id)
+
+            # Sanity check
+            if not oned_dict:
+                results[basin_id] = None
+                continue
+
+            # Add NSE as attribute on xaray
+            xr_dataset = oned_dict.get('xr')
+            nse = oned_dict.get('NSE')
+            atts = dict(
+                NSE=nse,
+                basin=basin_id,
+                run=run_dir.name,
+                epoch=epoch,
+                epochs=epochs,
+                simulation='stateful' if stateful else 'windowed',
+            )
+            ds = xr_dataset.assign_attrs(atts)
+
+            if write_nc:
+                # Single-basin runs keep the original filename
+                prefix = 'test_results_stateful' if stateful else 'test_results'
+                filename = f'{prefix}.nc' if len(basin_ids) == 1 else f'{prefix}_{basin_id}.nc'
+                nc_path = model_dir / filename
+                with instrument.phase('write_results', basin=basin_id, format='netcdf'):
+                    ds.to_netcdf(nc_path)
+                print(f' Wrote {nc_path}')
+            if store is not None:
+                with instrument.phase('write_results', basin=basin_id, format='zarr'):
+                    group = store.write(ds)
+                print(f' Wrote {group} to {store.store_path}')
+
+            results[basin_id] = ds
+
+        return results
+
+    def _stateful_results(self, basin_ids: list[str], run_dir: pathlib.Path, epoch: int) -> dict:
+        """Simulates the test period with carried LSTM state.
+
+        Stateful predictions can differ from nh's windowed ones, so each
+        basin's largest difference over the last STATEFUL_CHECK_DAYS of the
+        period is stored as the stateful_difference attribute (in normalized
+        target units), with a warning if it is above STATEFUL_TOLERANCE.
+
+        Returns basin_id => results, in the format nh stores per basin in
+        test_results.p (the 'xr' dataset plus one entry per metric)
+        """
+        cfg = Config(run_dir / 'config.yml')
+        predictor = get_predictor(run_dir, epoch, device=self.profile.device)
+        ds = predictor.predict(basin_ids, cfg.test_start_date, cfg.test_end_date, stateful=True)
+        with get_instrument().phase('stateful_check', days=STATEFUL_CHECK_DAYS):
+            differences = predictor.windowed_difference(ds)
+
+        results = dict()
+        for basin_id in ds['basin'].values:
+            difference = differences.get(str(basin_id))
+            if difference is None or difference > STATEFUL_TOLERANCE:
+                print(f'Warning: basin {basin_id} stateful predictions differ from windowed (nh) by'
+                    f' {"missing values" if difference is None else f"{difference:.3g}"} (normalized units),'
+                    f' above the tolerance {STATEFUL_TOLERANCE}, so its stateful metrics are not nh test metrics')
+            # Same layout as nh test results, with a time_step dimension
+            basin_ds = ds.sel(basin=basin_id).drop_vars(['basin', 'run']).expand_dims(time_step=[0], axis=-1)
+            basin_ds.attrs['stateful_difference'] = float('nan') if difference is None else difference
+            oned_dict = dict(xr=basin_ds)
+            for target in cfg.target_variables:
+                # As in nh test results, the stored predictions are clipped to zero
+                # for clip_targets_to_zero (by predict()), and metrics use them
+                obs = basin_ds[f'{target}_obs'].isel(time_step=0)
+                sim = basin_ds[f'{target}_sim'].isel(time_step=0)
+                try:
+                    values = calculate_metrics(obs, sim, metrics=cfg.metrics, resolution=ds.attrs['frequency'])
+                except AllNaNError as e:
+                    print(f'Warning: basin {basin_id} {e}')
+                    values = {metric: float('nan') for metric in cfg.metrics}
+                if len(cfg.target_variables) > 1:
+                    values = {f'{target}_{key}': value for key, value in values.items()}
+                oned_dict.update(values)
+            results[str(basin_id)] = oned_dict
+        return results
+
+    def _dataset_settings(self, basin_ids: list[str]) -> tuple[str, pathlib.Path]:
+        """Returns nh dataset name and data directory for the input basins.
+
+        Uses the columnar store when it contains all of the basins,
+        otherwise the CAMELS-US text files.
+        """
+        data_dir = pathlib.Path(self.args.data_dir).resolve()
+        cache_dir = getattr(self.args, 'cache_dir', None)
+        store = CamelsStore(cache_dir or data_dir / STORE_DIRNAME)
+        if not store.exists():
+            if cache_dir is not None:
+                raise FileNotFoundError(f'Store not found: {cache_dir}')
+            return 'camels_us', data_dir
+
+        missing = store.missing_basins(basin_ids)
+        if missing:
+            if cache_dir is not None:
+                raise FileNotFoundError(f'Basins missing from store {cache_dir}: {" ".join(missing)}')
+            print(f'{len(missing)} basins not in {store.store_dir}, reading CAMELS-US text files')
+            return 'camels_us', data_dir
+
+        print(f'Reading time series from {store.store_dir}')
+        return 'generic', store.store_dir.resolve()
+
+    def _eval_gpu(self) -> int|None:
+        """Returns nh eval_run gpu argument for this machine's device.
+
+        Runs may be tested on a different machine than they were trained on.
+        """
+        device = self.profile.device
+        if device == 'cpu':
+            return -1
+        if device.startswith('cuda'):
+            return int(device.split(':')[-1]) if ':' in device else 0
+        return None  # use the config device, e.g. mps
 
-        return ds
+    def _has_current_results(self,
+            reader: ResultsReader,
+            weights_path: pathlib.Path,
+            config_path: pathlib.Path) -> bool:
+        """Checks for test results written after the model weights and the run config.
 
-    def _generate_config_file(self, yml_path: pathlib.Path) -> None:
+        Changes to the test data are not detected (use the reevaluate option).
+        """
+        if not reader.pickle_path.exists() or not weights_path.exists():
+            return False
+        results_mtime = reader.pickle_path.stat().st_mtime_ns
+        return all(results_mtime >= path.stat().st_mtime_ns for path in [weights_path, config_path]
+            if path.exists())
+
+    def _generate_config_file(self,
+            yml_path: pathlib.Path,
+            basin_txt_path: pathlib.Path,
+            runs_dir: pathlib.Path,
+            basin_ids: list[str]) -> None:
         """Generates basin.yml from template"""
         # Load the template file
         this_dir = pathlib.Path(__file__).parent
@@ -135,52 +627,20 @@ class BasinNH:
             template = string.Template(template_string)
         if template is None:
             raise RuntimeError(f'Failed to read yml tempalte {template_path}')
-        basin_txt_path = self.scratch_dir / 'basin.txt'
 
-        data_dir = pathlib.Path(self.args.data_dir).resolve()
+        dataset, data_dir = self._dataset_settings(basin_ids)
         template_dict = dict(
             basin_txt_file=basin_txt_path.resolve(),
+            dataset=dataset,
             data_dir=data_dir,
+            device=self.profile.device,
+            num_workers=self.profile.num_workers,
+            runs_dir=runs_dir.resolve(),
             training_epochs=self.args.training_epochs,
+            validate_basins=len(basin_ids),
             )
         yml = template.substitute(template_dict)
 
         # Write basin.yml to scratch folder
         with open(yml_path, 'wt') as fp:
             fp.write(yml)
-
-    def _get_latest_run_id(self, parent_dir: pathlib.Path) -> str | None:
-        """Returns the most recent run_id in parent_dir."""
-        latest_dir = self._get_latest_dir(parent_dir, 'run_')
-        return None if latest_dir is None else latest_dir.name
-
-    def _get_latest_dir(self, parent_dir: pathlib.Path, prefix: str) -> pathlib.Path | None:
-        """Returns the most recent subdirectory with given prefix."""
-        if not parent_dir.is_dir():
-            return None
-
-        child_dirs = \
-            [d for d in parent_dir.iterdir() if d.is_dir() and d.name.startswith(prefix)]
-        if not child_dirs:
-            return None
-
-        latest_dir = max(child_dirs, key=os.path.getctime)
-        return latest_dir
-
-    def _get_epoch_count(self, dirname: str) -> int:
-        """Extract epoch count from test directory name.
-
-        Expected format is model_epoch050 e.g.
-        """
-        pattern = 'model_epoch'
-        if not dirname.startswith(pattern):
-            return -1  # unknown
-
-        pos = len(pattern)
-        try:
-            epochs = int(dirname[pos:])
-        except ValueError:
-            print(f'Error: cannot extract epochs from directory name {dirname}')
-            return -1
-
-        return epochs
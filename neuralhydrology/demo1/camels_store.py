@@ -0,0 +1,190 @@
+"""
+This script converts the CAMELS-US text files into a columnar store for neuralhydrology.
+
+The CAMELS-US forcing and streamflow files are whitespace-delimited text, which
+neuralhydrology parses (for every forcing) each time a dataset is loaded. This
+script parses them once and writes one NetCDF file per basin, in the layout of
+the neuralhydrology "generic" dataset:
+
+    <store_dir>/
+        store.json              (forcings and basins in the store)
+        time_series/<basin>.nc  (forcings + QObs(mm/d), indexed by date)
+        attributes/camels_attributes.csv  (if CAMELS attributes are present)
+
+Column names match the camels_us dataset, so the dynamic inputs in
+template.basin.yml are unchanged. The files are written in NetCDF3 format,
+which xarray reads with memory mapping.
+
+The default store location is <data_dir>/nh_store, which BasinNH uses
+automatically when it exists.
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+STORE_DIRNAME = 'nh_store'
+STORE_INFO_FILENAME = 'store.json'
+TIME_SERIES_DIRNAME = 'time_series'
+ATTRIBUTES_DIRNAME = 'attributes'
+
+# Must match the forcings in template.basin.yml
+STORE_FORCINGS = ['maurer', 'daymet', 'nldas']
+
+# scipy writes NetCDF3, which allows '/' in variable names, e.g. prcp(mm/day)
+NC_ENGINE = 'scipy'
+
+
+class CamelsStore:
+    """A per-basin columnar copy of the CAMELS-US time series.
+    """
+    def __init__(self, store_dir: str|pathlib.Path):
+        self.store_dir = pathlib.Path(store_dir)
+        self.time_series_dir = self.store_dir / TIME_SERIES_DIRNAME
+        self.info_path = self.store_dir / STORE_INFO_FILENAME
+
+    def exists(self) -> bool:
+        """Returns True if the store has been built."""
+        return self.info_path.exists()
+
+    def read_info(self) -> dict:
+        """Returns store info, which lists forcings and basins."""
+        with open(self.info_path) as fp:
+            return json.load(fp)
+
+    def basin_path(self, basin_id: str) -> pathlib.Path:
+        """Returns path to the time series file for one basin."""
+        return self.time_series_dir / f'{basin_id}.nc'
+
+    def missing_basins(self, basin_ids: list[str]) -> list[str]:
+        """Returns the input basins that are not in the store."""
+        return [b for b in basin_ids if not self.basin_path(b).exists()]
+
+    def build(self,
+            camels_dir: str|pathlib.Path,
+            basin_ids: list[str],
+            forcings: list[str] = STORE_FORCINGS,
+            overwrite: bool = False) -> list[str]:
+        """Converts CAMELS-US text files for the input basins.
+
+        Basins already in the store are skipped unless overwrite is set.
+
+        Returns list of basins that failed to convert
+        """
+        # Import here, so that the store can be queried without neuralhydrology
+        from neuralhydrology.datasetzoo.camelsus import (
+            load_camels_us_attributes, load_camels_us_discharge, load_camels_us_forcings)
+
+        camels_dir = pathlib.Path(camels_dir)
+        if self.exists():
+            info = self.read_info()
+            if info['forcings'] != forcings:
+                raise ValueError(f'Store {self.store_dir} has forcings {info["forcings"]}, not {forcings}')
+            stored = set(info['basins'])
+        else:
+            stored = set()
+        self.time_series_dir.mkdir(parents=True, exist_ok=True)
+
+        failed = list()
+        for i, basin_id in enumerate(basin_ids, start=1):
+            path = self.basin_path(basin_id)
+            if path.exists() and not overwrite:
+                stored.add(basin_id)
+                continue
+            print(f'Converting basin {basin_id} ({i}/{len(basin_ids)})')
+            try:
+                df = self._load_basin(camels_dir, basin_id, forcings,
+                    load_camels_us_forcings, load_camels_us_discharge)
+                self._write_basin(df, basin_id, path)
+            except Exception as e:
+                print(f'Error: conversion failed for basin {basin_id}: {e}')
+                failed.append(basin_id)
+                continue
+            stored.add(basin_id)
+
+        attributes_path = camels_dir / 'camels_attributes_v2.0'
+        if attributes_path.exists():
+            df = load_camels_us_attributes(camels_dir, basins=sorted(stored))
+            out_dir = self.store_dir / ATTRIBUTES_DIRNAME
+            out_dir.mkdir(exist_ok=True)
+            df.to_csv(out_dir / 'camels_attributes.csv', index_label='gauge_id')
+
+        info = dict(
+            forcings=forcings,
+            basins=sorted(stored),
+            source=str(camels_dir.resolve()),
+            created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        )
+        with open(self.info_path, 'w') as fp:
+            json.dump(info, fp, indent=2)
+        return failed
+
+    def _load_basin(self,
+            camels_dir: pathlib.Path,
+            basin_id: str,
+            forcings: list[str],
+            load_forcings,
+            load_discharge) -> pd.DataFrame:
+        """Returns forcings and discharge for one basin, as the camels_us dataset loads them."""
+        dfs = list()
+        for forcing in forcings:
+            df, area = load_forcings(camels_dir, basin_id, forcing)
+            if len(forcings) > 1:
+                df = df.rename(columns={col: f'{col}_{forcing}' for col in df.columns})
+            dfs.append(df)
+        df = pd.concat(dfs, axis=1)
+
+        qobs = load_discharge(camels_dir, basin_id, area)
+        df['QObs(mm/d)'] = qobs.where(qobs >= 0, np.nan)
+        return df
+
+    def _write_basin(self, df: pd.DataFrame, basin_id: str, path: pathlib.Path) -> None:
+        """Writes basin dataframe as NetCDF, replacing any existing file atomically."""
+        df.index.name = 'date'
+        ds = xr.Dataset.from_dataframe(df)
+        ds = ds.assign_attrs(basin=basin_id)
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        ds.to_netcdf(tmp_path, engine=NC_ENGINE)
+        tmp_path.replace(path)
+
+
+def main():
+    # Import here, because args_utils is in the same folder
+    from args_utils import read_basin_list
+
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--data_dir', required=True, help='Path to CAMELS-US dataset')
+    parser.add_argument('-o', '--output_dir',
+        help=f'Store directory [data_dir/{STORE_DIRNAME}]')
+    parser.add_argument('-B', '--basin_list', default='*',
+        help='Text file with one basin id per line, or glob pattern of basin ids [*]')
+    parser.add_argument('--overwrite', action='store_true',
+        help='Convert basins that are already in the store')
+    args = parser.parse_args()
+
+    camels_path = pathlib.Path(args.data_dir)
+    if not camels_path.exists():
+        print(f'Error: data_dir not found: {camels_path}')
+        sys.exit(2)
+    store_dir = args.output_dir or camels_path / STORE_DIRNAME
+    basin_ids = read_basin_list(args.basin_list, camels_path)
+
+    start = time.perf_counter()
+    store = CamelsStore(store_dir)
+    failed = store.build(camels_path, basin_ids, overwrite=args.overwrite)
+    elapsed = time.perf_counter() - start
+    print(f'Converted {len(basin_ids) - len(failed)} basins to {store_dir} in {elapsed:.1f} sec')
+    if failed:
+        print(f'{len(failed)} basins failed: {" ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+This module provides classes for pruning model checkpoints in a nh run directory.
+
+nh saves model (and optimizer) weights every save_weights_every epochs. The
+CheckpointRetention policy keeps the weights of the last keep_last epochs plus
+the best epoch by validation metric (median over the validation basins, read
+from validation/model_epochNNN/validation_metrics.csv), and deletes the rest.
+Epochs are only compared if they were validated on the same basins (nh picks
+validate_n_random_basins at random for each validation); otherwise there is
+no best epoch, and testing uses the last one.
+Optimizer state is only kept for the latest epoch, which is all that is needed
+to continue training. CheckpointPruner applies the policy in a background
+thread while training runs, so disk usage stays bounded.
+
+After training, the best epoch is written to checkpoints.json in the run
+directory, which testing reads to select the epoch to evaluate.
+"""
+
+import csv
+import json
+import math
+import pathlib
+import re
+import statistics
+import threading
+
+CHECKPOINTS_FILENAME = 'checkpoints.json'
+DEFAULT_KEEP_LAST = 2
+DEFAULT_METRIC = 'NSE'
+
+WEIGHTS_PATTERN = re.compile(r'model_epoch(\d+)\.pt$')
+OPTIMIZER_PATTERN = re.compile(r'optimizer_state_epoch(\d+)\.pt$')
+
+# Metrics where lower is better; all others are maximized
+MINIMIZED_METRICS = ['MSE', 'RMSE', 'Alpha-NSE', 'Beta-NSE', 'Peak-Timing', 'Missed-Peaks']
+
+
+class CheckpointRetention:
+    """Retention policy for the checkpoints in one run directory.
+    """
+    def __init__(self,
+            run_dir: str|pathlib.Path,
+            keep_last: int = DEFAULT_KEEP_LAST,
+            metric: str = DEFAULT_METRIC,
+            validate_every: int|None = None):
+        """
+        Initializes a CheckpointRetention object.
+
+        validate_every (from the run config) identifies epochs whose validation
+        metrics are still pending; their weights are not deleted until the
+        metrics are written.
+        """
+        self.run_dir = pathlib.Path(run_dir)
+        self.keep_last = max(1, keep_last)
+        self.metric = metric
+        self.validate_every = validate_every
+
+    def weight_epochs(self) -> list[int]:
+        """Returns sorted list of epochs with saved model weights."""
+        return self._epochs(WEIGHTS_PATTERN)
+
+    def validation_scores(self) -> dict[int, float]:
+        """Returns epoch => median validation metric, for epochs with validation metrics."""
+        return {epoch: score for epoch, (score, _) in self._validations().items()}
+
+    def best_epoch(self) -> int|None:
+        """Returns epoch with the best validation metric and saved weights, or None.
+
+        None also if the validations scored different basins, since their
+        scores are not comparable.
+        """
+        validations = self._validations()
+        if len({basins for _, basins in validations.values()}) > 1:
+            return None
+        weights = set(self.weight_epochs())
+        scores = {e: score for e, (score, _) in validations.items() if e in weights}
+        if not scores:
+            return None
+        if self.metric in MINIMIZED_METRICS:
+            return min(scores, key=lambda e: (scores[e], -e))
+        return max(scores, key=lambda e: (scores[e], e))
+
+    def prune(self, final: bool = False) -> list[int]:
+        """Deletes weights not kept by the policy.
+
+        Set final after training, when no validation metrics are pending.
+
+        Returns epochs whose weights were deleted
+        """
+        epochs = self.weight_epochs()
+        keep = set(epochs[-self.keep_last:])
+        best = self.best_epoch()
+        if best is not None:
+            keep.add(best)
+        if not final and self.validate_every:
+            scored = set(self.validation_scores())
+            keep.update(e for e in epochs if e % self.validate_every == 0 and e not in scored)
+
+        removed = list()
+        for epoch in epochs:
+            if epoch in keep:
+                continue
+            (self.run_dir / f'model_epoch{epoch:03d}.pt').unlink(missing_ok=True)
+            removed.append(epoch)
+
+        optimizer_epochs = self._epochs(OPTIMIZER_PATTERN)
+        for epoch in optimizer_epochs[:-1]:
+            (self.run_dir / f'optimizer_state_epoch{epoch:03d}.pt').unlink(missing_ok=True)
+        return removed
+
+    def write_summary(self) -> dict:
+        """Writes checkpoints.json with the best epoch and kept weights, and returns it."""
+        best = self.best_epoch()
+        scores = self.validation_scores()
+        summary = dict(
+            metric=self.metric,
+            best_epoch=best,
+            best_score=scores.get(best),
+            kept_epochs=self.weight_epochs(),
+            keep_last=self.keep_last,
+        )
+        with open(self.run_dir / CHECKPOINTS_FILENAME, 'w') as fp:
+            json.dump(summary, fp, indent=2)
+        return summary
+
+    def _epochs(self, pattern: re.Pattern) -> list[int]:
+        """Returns sorted epochs of the run directory files matching pattern."""
+        epochs = list()
+        for path in self.run_dir.iterdir():
+            match = pattern.match(path.name)
+            if match is not None:
+                epochs.append(int(match.group(1)))
+        return sorted(epochs)
+
+    def _validations(self) -> dict[int, tuple[float, frozenset[str]]]:
+        """Returns epoch => (median validation metric, validation basins), for epochs with validation metrics."""
+        validations = dict()
+        for csv_path in self.run_dir.glob('validation/model_epoch*/validation_metrics.csv'):
+            match = re.match(r'model_epoch(\d+)$', csv_path.parent.name)
+            if match is None:
+                continue
+            score, basins = self._read_score(csv_path)
+            if score is not None:
+                validations[int(match.group(1))] = (score, basins)
+        return validations
+
+    def _read_score(self, csv_path: pathlib.Path) -> tuple[float|None, frozenset[str]]:
+        """Returns median of the metric column over basins (ignoring NaN), and the basins."""
+        try:
+            with open(csv_path, newline='') as fp:
+                rows = list(csv.DictReader(fp))
+        except OSError:
+            return None, frozenset()
+        basins = frozenset(row.get('basin') for row in rows)
+        values = list()
+        for row in rows:
+            for column, text in row.items():
+                # Multi-target runs prefix metrics with the target name
+                if column == self.metric or column.endswith(f'_{self.metric}'):
+                    try:
+                        value = float(text)
+                    except (TypeError, ValueError):
+                        continue
+                    if not math.isnan(value):
+                        values.append(value)
+        return (statistics.median(values) if values else None), basins
+
+
+def read_best_epoch(run_dir: str|pathlib.Path) -> int|None:
+    """Returns best epoch recorded in the run directory, or None."""
+    path = pathlib.Path(run_dir) / CHECKPOINTS_FILENAME
+    if not path.exists():
+        return None
+    with open(path) as fp:
+        return json.load(fp).get('best_epoch')
+
+
+class CheckpointPruner:
+    """Applies a CheckpointRetention policy in a background thread during training.
+    """
+    def __init__(self, retention: CheckpointRetention, interval: float = 5.0):
+        self.retention = retention
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='checkpoint-pruner', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> dict:
+        """Stops the thread, prunes with no pending validations, and writes the summary.
+
+        Returns summary dictionary
+        """
+        self._stop_event.set()
+        self._thread.join()
+        self.retention.prune(final=True)
+        return self.retention.write_summary()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.retention.prune()
+            except Exception as e:
+                # Training must not fail because of pruning
+                print(f'Warning: checkpoint pruning failed: {e}')
@@ -1,3 +1,10 @@
 """For constants shared both in docker container and out"""
 
-RUN_ID_FILENAME = 'last_run_id'
+# Prefix for the line of json that local_main.py writes to stdout with step results
+RESULT_PREFIX = 'NH_RESULT '
+
+# Experiments subdirectory for regional (multi-basin) models
+REGIONAL_DIRNAME = 'regional'
+
+# Run id argument that selects the most recent run in the basin's run index
+LATEST_RUN_ID = 'latest'
@@ -4,14 +4,34 @@ This module provides a DemoRun class for performing neural hydrology modeling.
 Uses container operations.
 """
 
+import json
+import os
 import pathlib
 import subprocess
-import tempfile
+import tarfile
 
-from .constants import RUN_ID_FILENAME
+from .constants import RESULT_PREFIX
+from .device_profile import AUTO_DEVICE, host_has_gpu
+from .instrument import METRICS_PREFIX, Instrument
 
 CONTAINER_NAME = 'demo1.run'
+WORKER_NAME = 'demo1.worker'
 DEFAULT_ENGINE = 'docker'
+QUEUE_MOUNT = '/queue'
+CACHE_MOUNT = '/cache'
+
+# Run directory files copied to the host by default; training keeps only the
+# last and best epochs' weights (see checkpoints.py), which are enough to rerun
+# testing. Patterns are relative to the run directory, and may use {epochs}.
+DEFAULT_ARTIFACTS = [
+    'config.yml',
+    'basins.txt',
+    'output.log',
+    'checkpoints.json',
+    'train_data/*',
+    'model_epoch*.pt',
+    'test/*',
+]
 
 class DemoRun:
     """A class for performing container-based hydrology operations.
@@ -21,11 +41,58 @@ class DemoRun:
             data_directory: str|pathlib.Path,
             engine: str=DEFAULT_ENGINE,
             verbose: bool=False,
+            container_name: str=CONTAINER_NAME,
+            log_path: pathlib.Path|None=None,
+            bind_experiments: bool=False,
+            artifacts: list[str]|None=DEFAULT_ARTIFACTS,
+            cache_dir: str|pathlib.Path|None=None,
+            device: str=AUTO_DEVICE,
+            cpus: float|None=None,
+            metrics_path: pathlib.Path|None=None,
+            zarr_results: bool=False,
             ):
+        """
+        Initializes a DemoRun object.
+
+        Use a unique container_name for each concurrent DemoRun on the same host.
+        If log_path is set, progress and container output are written to that
+        file instead of stdout.
+
+        If bind_experiments is set, the host experiments directory is mounted
+        at /experiments, so results are written directly to the host and
+        nothing is copied. Otherwise the artifacts (patterns relative to the
+        run directory) are copied from the container; None copies the whole
+        run directory.
+
+        If cache_dir (a store built by camels_store.py) is set, it is mounted
+        at /cache; otherwise the container uses data_dir/nh_store if present.
+
+        The container gets the host GPUs unless device is cpu or (for auto)
+        the host has no GPU. If cpus is set, it limits the cores the
+        container can use, and training sizes its threads to match.
+
+        If zarr_results is set, testing also writes results to
+        <experiments_dir>/results.zarr; use it with bind_experiments, since
+        the store is not copied from the container.
+
+        Timing of the container operations, and the metrics records of the
+        commands run in the container, are appended to metrics_path if set
+        (see instrument.py); they are also kept in self.instrument.records.
+        """
         self.data_dir = data_directory
         self.image_name = image_name
         self.engine = engine
         self.verbose = verbose
+        self.container_name = container_name
+        self.log_path = log_path
+        self.bind_experiments = bind_experiments
+        self.artifacts = artifacts
+        self.cache_dir = cache_dir
+        self.device = device
+        self.cpus = cpus
+        self.use_gpus = device != 'cpu' and (device != AUTO_DEVICE or host_has_gpu())
+        self.instrument = Instrument(metrics_path, container=container_name)
+        self.zarr_results = zarr_results
 
     def is_image_available(self) -> bool|None:
         """Checks if image is in the container-engine store.
@@ -61,7 +128,7 @@ class DemoRun:
             basin_id: str,
             host_experiments_dir: pathlib.Path | str,
             epochs: int|None = None,
-            keep_container=False) -> None:
+            keep_container=False) -> str|None:
         """"
         Carries out full model train & test:
         * Check for image
@@ -72,121 +139,214 @@ class DemoRun:
         * Copy results
         * Stop the container
 
+        Returns run_id (or None)
+
         Note: caller is responsible for making image available
         """
         # Future: ?check for image and pull if needed
-        try:
-            self._check_for_container()
-            self._start_container()
+        self.instrument.configure(basin_id=basin_id)
+        with self.instrument.phase('execute') as phase_attrs:
+            try:
+                self._check_for_container()
+                self._start_container(mounts=self._experiments_mounts(host_experiments_dir))
+
+                train_result = self._run_training(basin_id, epochs=epochs)
+                run_id = train_result.get('run_id')
+                if run_id is None:
+                    raise RuntimeError('Error: training did not return a run_id')
+                phase_attrs['run_id'] = run_id
+                self._run_testing(basin_id, run_id)
+                self.copy_run_directory(basin_id, run_id, host_experiments_dir,
+                    epochs=train_result.get('epochs'))
+            except Exception:
+                raise
+            finally:
+                if keep_container:
+                    self._print(f'Leaving container {self.container_name} running')
+                else:
+                    self._stop_container()
 
-            self._run_training(basin_id, epochs=epochs)
-            run_id = self._get_run_id()
-            self._run_testing(basin_id, run_id)
-            self._copy_run_directory(basin_id, run_id, host_experiments_dir)
-        except Exception:
-            raise
-        finally:
-            if keep_container:
-                print(f'Leaving container {CONTAINER_NAME} running')
-            else:
-                self._stop_container()
+        return run_id
+
+    def start_worker(self,
+            host_queue_dir: pathlib.Path,
+            host_experiments_dir: pathlib.Path|None = None) -> None:
+        """Starts container running worker.py, unless it is already running.
+
+        The worker keeps BasinNH and torch imported and runs jobs submitted
+        to the JobQueue in host_queue_dir. host_experiments_dir is required
+        if bind_experiments is set.
+        """
+        if self.is_container_running():
+            self._print(f'Using running worker "{self.container_name}"')
+            return
+
+        self._check_for_container()
+        worker_command = 'python worker.py' + \
+            f' --queue_dir {QUEUE_MOUNT} --data_dir /data --experiments_dir /experiments' + \
+            f' --worker_name {self.container_name}' + \
+            (f' --cache_dir {CACHE_MOUNT}' if self.cache_dir else '') + \
+            (f' --device {self.device}' if self.device != AUTO_DEVICE else '') + \
+            (' --zarr_results' if self.zarr_results else '')
+        mounts = [f'type=bind,src={host_queue_dir},dst={QUEUE_MOUNT}']
+        if self.bind_experiments:
+            mounts += self._experiments_mounts(host_experiments_dir)
+        self._start_container(
+            mounts=mounts,
+            container_command=worker_command,
+            restart='on-failure',
+            )
+
+    def stop_worker(self) -> None:
+        """Stops worker container; any queued jobs remain for other workers."""
+        self._stop_container()
+
+    def is_container_running(self) -> bool:
+        """Checks if container is running."""
+        command = f'{self.engine} ps -f name=^{self.container_name}$ -f status=running -q'
+        result = self._run_command(command)
+        return bool(result.stdout.strip())
 
     def _check_for_container(self):
         """Checks for running container and stops it if found."""
-        print(f'Checking for extant "{CONTAINER_NAME}" container')
+        self._print(f'Checking for extant "{self.container_name}" container')
 
-        command = f'{self.engine} ps -a -f name={CONTAINER_NAME} -q'
+        # Anchor the name filter, which otherwise matches substrings
+        command = f'{self.engine} ps -a -f name=^{self.container_name}$ -q'
         result = self._run_command(command)
 
         if result.stdout:
-            print(f'Found running "{CONTAINER_NAME}" container => shutting down ')
+            self._print(f'Found running "{self.container_name}" container => shutting down ')
             self._stop_container()
 
-    def _start_container(self):
+    def _start_container(self,
+            mounts: list[str]|None = None,
+            container_command: str = 'tail -f /dev/null',
+            restart: str = 'always'):
         """Runs container in detached mode."""
-        print('Starting container...')
-        command = f'{self.engine} run --gpus all --detach --restart always' + \
-            f' --name {CONTAINER_NAME}' + \
-            f' --mount type=bind,src={self.data_dir},dst=/data,readonly {self.image_name}' + \
-            ' tail -f /dev/null'
-        _result = self._run_command(command)
-
-    def _run_training(self, basin_id: str, epochs: int = None):
-        """Invokes the BasinNH.run_training method in the container."""
-        print('Begin training sequence...')
-
+        self._print('Starting container...')
+        mounts = list(mounts or [])
+        if self.cache_dir:
+            cache_path = pathlib.Path(self.cache_dir).resolve()
+            mounts.append(f'type=bind,src={cache_path},dst={CACHE_MOUNT},readonly')
+        mount_args = ''.join(f' --mount {mount}' for mount in mounts)
+        # Files written to a bind-mounted experiments dir should belong to the host user
+        user_args = ''
+        if self.bind_experiments and hasattr(os, 'getuid'):
+            user_args = f' --user {os.getuid()}:{os.getgid()}'
+        resource_args = ' --gpus all' if self.use_gpus else ''
+        if self.cpus:
+            resource_args += f' --cpus {self.cpus}'
+        command = f'{self.engine} run{resource_args} --detach --restart {restart}' + \
+            f' --name {self.container_name}' + user_args + \
+            f' --mount type=bind,src={self.data_dir},dst=/data,readonly' + mount_args + \
+            f' {self.image_name} {container_command}'
+        with self.instrument.phase('docker_start'):
+            _result = self._run_command(command)
+
+    def _run_training(self, basin_id: str, epochs: int = None) -> dict:
+        """Invokes the BasinNH.run_training method in the container.
+
+        Returns result dictionary written by local_main.py
+        """
+        self._print('Begin training sequence...')
         command = self._create_nh_command('train', basin_id, epochs=epochs)
-        if self.verbose:
-            print(f'{command=}')
-
-        rc = self._run_command_with_output(command)
-        if rc != 0:
-            raise RuntimeError(f'Error: return code {rc}')
+        return self._run_nh_command(command, 'train')
 
-    def _get_run_id(self) -> str|None:
-        """Gets run_id from from container file designated for this.
+    def _run_testing(self, basin_id: str, run_id: str) -> dict:
+        """Invokes the BasinNH.run_testing method in the container.
 
-        This code hinges on the BasinNH.run_training() code in the container
-        writing a file to the /experiments/.scratch directory. We should
-        probably using a shared config file to keep the host and container
-        in sync.
+        Returns result dictionary written by local_main.py
         """
-        print('Retrieving last run_id from container...')
-
-        # Training code in container writes run_id to file in scratch directory
-        with tempfile.TemporaryDirectory() as temp_dir:
-            src_file = f'/experiments/.scratch/{RUN_ID_FILENAME}'
-            command = f'{self.engine} cp {CONTAINER_NAME}:{src_file} {temp_dir}'
-            result = self._run_command(command)
-            if result.returncode != 0:
-                raise RuntimeError('Error: failed to retrieve run_id from container')
-
-            run_id = None
-            dst_path = pathlib.Path(temp_dir) / RUN_ID_FILENAME
-            with open(dst_path) as fp:
-                content = fp.read()
-                if content.startswith('run_'):
-                    run_id = content
-
-        return run_id
-
-    def _run_testing(self, basin_id: str, run_id: str):
-        """Invokes the BasinNH.run_testing method in the container."""
-        print(f'Begin testing sequence, {basin_id=}, {run_id=}...')
-
+        self._print(f'Begin testing sequence, {basin_id=}, {run_id=}...')
         command = self._create_nh_command('test', basin_id, run_id=run_id)
+        return self._run_nh_command(command, 'test')
+
+    def _run_nh_command(self, command: list, step: str) -> dict:
+        """Runs local_main.py in the container and returns its json result."""
         if self.verbose:
-            print(f'{command=}')
+            self._print(f'{command=}')
 
-        rc = self._run_command_with_output(command)
+        with self.instrument.phase('docker_exec', step=step):
+            rc, result = self._run_command_with_output(command)
         if rc != 0:
             raise RuntimeError(f'Error: return code {rc}')
+        if result is None:
+            raise RuntimeError('Error: no result returned from container')
+        return result
 
-    def _copy_run_directory(self,
+    def copy_run_directory(self,
                 basin_id: str,
                 run_id: str,
-                host_experiments_dir: pathlib.Path):
-        """Copies run directory to from container to host."""
-        print(f'Copying run directory to host...')
+                host_experiments_dir: pathlib.Path,
+                epochs: int|None = None):
+        """Copies run directory (or the selected artifacts) from container to host.
 
-        # Make sure runs dir is on host machine
+        Nothing is copied when the experiments directory is bind mounted.
+        """
         host_dir = host_experiments_dir / f'{basin_id}/runs'
-        host_dir.mkdir(parents=True, exist_ok=True)
+        host_run_dir = host_dir / run_id
+        if self.bind_experiments:
+            self._print(f'Results written to {host_run_dir}')
+            return
 
+        # Make sure runs dir is on host machine
+        host_dir.mkdir(parents=True, exist_ok=True)
         run_dir = f'/experiments/{basin_id}/runs/{run_id}'
-        command = f'{self.engine} cp {CONTAINER_NAME}:{run_dir} {str(host_dir)}'
-        _result = self._run_command(command)
 
-        host_run_dir = host_dir / run_id
-        print(f'Wrote {host_run_dir}')
+        with self.instrument.phase('docker_cp', all_files=self.artifacts is None or epochs is None):
+            if self.artifacts is None or epochs is None:
+                self._print(f'Copying run directory to host...')
+                command = f'{self.engine} cp {self.container_name}:{run_dir} {str(host_dir)}'
+                _result = self._run_command(command)
+            else:
+                self._print('Copying selected artifacts to host...')
+                self._copy_artifacts(run_dir, host_run_dir, epochs)
+
+        self._print(f'Wrote {host_run_dir}')
+
+    def _copy_artifacts(self, run_dir: str, host_run_dir: pathlib.Path, epochs: int):
+        """Streams the selected artifacts from container to host as a tar archive."""
+        patterns = ' '.join(a.format(epochs=epochs) for a in self.artifacts)
+        # Patterns are expanded by the container shell; missing files are skipped
+        tar_command = f'cd {run_dir} && tar cf - --ignore-failed-read {patterns}'
+        command = [self.engine, 'exec', self.container_name, 'sh', '-c', tar_command]
+        if self.verbose:
+            self._print(f'{command=}')
+
+        host_run_dir.mkdir(parents=True, exist_ok=True)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(host_run_dir, filter='data')
+                else:
+                    tar.extractall(host_run_dir)
+        finally:
+            # Still running if extraction failed part way
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            rc = process.wait()
+        if rc != 0:
+            raise RuntimeError(f'Error: copying artifacts failed with return code {rc}')
+
+    def _experiments_mounts(self, host_experiments_dir: pathlib.Path) -> list[str]:
+        """Returns mount for the host experiments directory, if bind_experiments is set."""
+        if not self.bind_experiments:
+            return []
+        host_dir = pathlib.Path(host_experiments_dir).resolve()
+        (host_dir / '.scratch').mkdir(parents=True, exist_ok=True)
+        return [f'type=bind,src={host_dir},dst=/experiments']
 
     def _stop_container(self):
         """Stops container."""
-        print('Stopping container...')
-        command = f'{self.engine} stop -t 5 {CONTAINER_NAME}'
-        _result = self._run_command(command)
-        command = f'{self.engine} rm {CONTAINER_NAME}'
-        _result = self._run_command(command)
+        self._print('Stopping container...')
+        with self.instrument.phase('docker_stop'):
+            command = f'{self.engine} stop -t 5 {self.container_name}'
+            _result = self._run_command(command)
+            command = f'{self.engine} rm {self.container_name}'
+            _result = self._run_command(command)
 
     def _run_command(self, command: str|list) -> subprocess.CompletedProcess:
         """"""
@@ -202,26 +362,53 @@ class DemoRun:
             raise
 
         if self.verbose:
-            print(f'{result=}')
+            self._print(f'{result=}')
         return result
 
-    def _run_command_with_output(self, command: str | list) -> int:
+    def _run_command_with_output(self, command: str | list) -> tuple[int, dict|None]:
+        """Runs command, printing its output as it runs.
+
+        Returns the return code and the result dictionary, if the command
+        wrote a line starting with RESULT_PREFIX. Lines starting with
+        METRICS_PREFIX are added to the instrument records instead of printed.
+        """
         cmd = command.split() if isinstance(command, str) else command
         # Run process and capture live messages
+        # Merge stderr into stdout, so that neither pipe can fill up and block
         process = subprocess.Popen(
             command,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
             text=True
         )
+        result = None
         while True:
             output = process.stdout.readline()
             if output == '' and process.poll() is not None:
                 break
+            if output.startswith(RESULT_PREFIX):
+                result = json.loads(output[len(RESULT_PREFIX):])
+            if output.startswith(METRICS_PREFIX):
+                try:
+                    record = json.loads(output[len(METRICS_PREFIX):])
+                except ValueError:
+                    record = None
+                if record is not None:
+                    self.instrument.record(dict(record, source='container'))
+                    if not self.verbose:
+                        continue
             if output:
-                print(output.strip())
+                self._print(output.strip())
         rc = process.poll()
-        return rc
+        return rc, result
+
+    def _print(self, message: str) -> None:
+        """Prints message to stdout or appends it to the log file."""
+        if self.log_path is None:
+            print(message)
+            return
+        with open(self.log_path, 'a') as fp:
+            fp.write(f'{message}\n')
 
     def _create_nh_command(self,
                 step: str, basin_id: str, run_id: str = None, epochs: int = None) -> list:
@@ -232,11 +419,18 @@ class DemoRun:
             '--data_dir', '/data',
             '--experiments_dir', '/experiments',
             '--basin_id', basin_id,
+            '--echo_metrics',
         ]
         if epochs:
             python_command += ['--training_epochs', str(epochs)]
         if run_id:
             python_command += ['--run_id', run_id]
-
-        run_command = [self.engine, 'exec','-t', CONTAINER_NAME]
+        if self.cache_dir:
+            python_command += ['--cache_dir', CACHE_MOUNT]
+        if self.device != AUTO_DEVICE:
+            python_command += ['--device', self.device]
+        if self.zarr_results and step == 'test':
+            python_command += ['--zarr_results']
+
+        run_command = [self.engine, 'exec','-t', self.container_name]
         return run_command + python_command
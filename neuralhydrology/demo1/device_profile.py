@@ -0,0 +1,103 @@
+"""
+This module selects the training device and thread/worker counts for the current machine.
+
+The number of usable cores is the smaller of the CPU affinity mask and the
+cgroup CPU quota, which is how docker --cpus limits a container. On a CPU
+device, torch intra-op threads do the training work, so most cores go to
+them and DataLoader workers are only used on larger machines. On a GPU
+device, DataLoader workers keep the GPU fed.
+"""
+
+from dataclasses import dataclass
+import functools
+import math
+import os
+import pathlib
+import shutil
+import subprocess
+
+AUTO_DEVICE = 'auto'
+
+# DataLoader workers for GPU training (the previous template setting)
+GPU_NUM_WORKERS = 8
+
+CGROUP_V2_CPU_MAX = pathlib.Path('/sys/fs/cgroup/cpu.max')
+CGROUP_V1_QUOTA = pathlib.Path('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+CGROUP_V1_PERIOD = pathlib.Path('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+
+
+@dataclass
+class DeviceProfile:
+    """Device and parallelism settings for training"""
+    device: str
+    num_workers: int
+    torch_threads: int
+    cpus: int
+
+    def apply(self) -> None:
+        """Sets the torch thread counts for this process."""
+        import torch
+        torch.set_num_threads(self.torch_threads)
+        try:
+            # Can only be set before any inter-op parallel work has started
+            torch.set_num_interop_threads(max(1, min(4, self.torch_threads)))
+        except RuntimeError:
+            pass
+
+
+def cgroup_cpu_limit() -> float|None:
+    """Returns the cgroup CPU quota in cores, or None if there is no quota."""
+    try:
+        if CGROUP_V2_CPU_MAX.exists():
+            quota, period = CGROUP_V2_CPU_MAX.read_text().split()[:2]
+            if quota == 'max':
+                return None
+            return int(quota) / int(period)
+        if CGROUP_V1_QUOTA.exists():
+            quota = int(CGROUP_V1_QUOTA.read_text())
+            if quota <= 0:
+                return None
+            return quota / int(CGROUP_V1_PERIOD.read_text())
+    except (OSError, ValueError):
+        pass
+    return None
+
+def available_cpus() -> int:
+    """Returns number of cores this process can use."""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, math.ceil(limit))
+    return max(1, cpus)
+
+@functools.cache
+def host_has_gpu() -> bool:
+    """Checks for an NVIDIA GPU on the host (for the docker --gpus option)."""
+    if shutil.which('nvidia-smi') is None:
+        return False
+    try:
+        result = subprocess.run(['nvidia-smi', '-L'], capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0 and 'GPU' in result.stdout
+
+def detect_profile(device: str|None = AUTO_DEVICE) -> DeviceProfile:
+    """Returns settings for the requested device ('auto' selects cuda:0 if available)."""
+    import torch
+
+    if device is None or device == AUTO_DEVICE:
+        device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+
+    cpus = available_cpus()
+    if device.startswith('cuda'):
+        num_workers = min(GPU_NUM_WORKERS, cpus)
+        torch_threads = cpus
+    else:
+        # Batches are sliced from in-memory arrays, which is cheap compared to
+        # the LSTM, so workers only pay off when there are cores to spare
+        num_workers = 0 if cpus <= 4 else min(4, cpus // 4)
+        torch_threads = max(1, cpus - num_workers)
+    return DeviceProfile(device, num_workers, torch_threads, cpus)
@@ -0,0 +1,310 @@
+"""
+This module records timing and resource use of the phases of a run, as json lines.
+
+Each phase (argument validation, imports, config generation, data load, each
+training epoch and validation, evaluation, result writing, and on the host the
+container start, exec, copy and stop) is timed with Instrument.phase(). When
+it ends, one json record is written with:
+* phase, start (iso time), wall_s
+* cpu_s - process cpu time (user + system), and cpu_util = cpu_s / wall_s (cores)
+* rss_mb, peak_rss_mb - current and peak resident memory of the process
+* gpu_peak_mb, gpu_util - peak torch cuda memory, and mean utilization (percent)
+  sampled during the phase, when cuda is in use
+* parent - enclosing phase, and any attributes passed to phase() (e.g. epoch)
+* the instrument context (e.g. step, basin_id, run_id, host, pid)
+
+Records are appended to a metrics file (default <experiments_dir>/metrics.jsonl),
+with a file lock (except on Windows) so concurrent runs can share it. With echo
+set, records are also printed with METRICS_PREFIX, which DemoRun reads from
+container output and adds to the host metrics file.
+
+To summarize metrics files (e.g. of a sweep), run this module:
+
+    python demo1/instrument.py <experiments_dir>/metrics.jsonl --by basin_id
+"""
+
+import argparse
+import collections
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import socket
+import sys
+import threading
+import time
+
+# Not available on Windows, where the host scripts (demo_run.py) also import this module
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Prefix for lines of json with metrics records, in container output
+METRICS_PREFIX = 'NH_METRICS '
+METRICS_FILENAME = 'metrics.jsonl'
+
+# Seconds between gpu utilization samples
+GPU_SAMPLE_INTERVAL = 1.0
+# Records kept in memory, e.g. by a long-lived worker (the metrics file has all of them)
+MAX_RECORDS = 10000
+
+
+def rss_mb() -> float|None:
+    """Returns current resident memory of this process in MB (Linux only)."""
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+
+def peak_rss_mb() -> float|None:
+    """Returns peak resident memory of this process in MB (None on Windows)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KB on Linux, bytes on macOS
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def cpu_seconds() -> float:
+    """Returns user + system cpu time of this process."""
+    times = os.times()
+    return times.user + times.system
+
+
+def _cuda():
+    """Returns torch.cuda if torch is imported and cuda is available, else None."""
+    torch = sys.modules.get('torch')
+    if torch is None:
+        return None
+    try:
+        return torch.cuda if torch.cuda.is_available() and torch.cuda.is_initialized() else None
+    except Exception:
+        return None
+
+
+class GpuSampler:
+    """Samples gpu utilization in a background thread while cuda is in use.
+    """
+    def __init__(self, interval: float = GPU_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.deque(maxlen=100000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Starts sampling, if it is not running."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='gpu-sampler', daemon=True)
+                self._thread.start()
+
+    def mean(self, start: float, end: float) -> float|None:
+        """Returns mean utilization of the samples between start and end (perf_counter times)."""
+        values = [value for t, value in list(self.samples) if start <= t <= end]
+        return sum(values) / len(values) if values else None
+
+    def _run(self) -> None:
+        while True:
+            cuda = _cuda()
+            if cuda is not None:
+                try:
+                    # Requires the pynvml package
+                    self.samples.append((time.perf_counter(), float(cuda.utilization())))
+                except Exception:
+                    return
+            time.sleep(self.interval)
+
+
+class Instrument:
+    """Records phases of a run as json lines.
+    """
+    def __init__(self, path: str|pathlib.Path|None = None, echo: bool = False, **context):
+        """
+        Initializes an Instrument object.
+
+        path - metrics file to append records to (None keeps records in memory only)
+        echo - also print records with METRICS_PREFIX to stdout
+        context - added to every record (e.g. step, basin_id)
+
+        The last MAX_RECORDS records are kept in self.records.
+        """
+        self.path = None if path is None else pathlib.Path(path)
+        self.echo = echo
+        self.context = dict(host=socket.gethostname(), pid=os.getpid())
+        self.context.update(context)
+        self.records = collections.deque(maxlen=MAX_RECORDS)
+        # Records made before a metrics file is configured, written when it is
+        # (unless they were echoed, which makes stdout their destination)
+        self._unwritten = collections.deque(maxlen=MAX_RECORDS)
+        self._stack = list()
+        self._lock = threading.Lock()
+        self._gpu = GpuSampler()
+
+    def configure(self, path: str|pathlib.Path|None = None, echo: bool|None = None, **context) -> None:
+        """Sets the metrics file, echo option and context values."""
+        if path is not None:
+            self.path = pathlib.Path(path)
+            unwritten, self._unwritten = self._unwritten, collections.deque(maxlen=MAX_RECORDS)
+            for record in unwritten:
+                self._write(record)
+        if echo is not None:
+            self.echo = echo
+        self.context.update(context)
+
+    @contextlib.contextmanager
+    def phase(self, name: str, **attrs):
+        """Context manager that records the enclosed phase."""
+        if _cuda() is not None:
+            self._gpu.start()
+        parent = self._stack[-1] if self._stack else None
+        self._stack.append(name)
+        started = datetime.datetime.now().isoformat(timespec='milliseconds')
+        start = time.perf_counter()
+        start_cpu = cpu_seconds()
+        status = 'ok'
+        try:
+            yield attrs
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            wall = time.perf_counter() - start
+            cpu = cpu_seconds() - start_cpu
+            self._stack.pop()
+            record = dict(
+                phase=name,
+                parent=parent,
+                status=status,
+                start=started,
+                wall_s=round(wall, 4),
+                cpu_s=round(cpu, 4),
+                cpu_util=round(cpu / wall, 3) if wall > 0 else None,
+                rss_mb=rss_mb(),
+                peak_rss_mb=peak_rss_mb(),
+            )
+            cuda = _cuda()
+            if cuda is not None:
+                record['gpu_peak_mb'] = cuda.max_memory_allocated() / 1e6
+                record['gpu_util'] = self._gpu.mean(start, start + wall)
+            record.update(attrs)
+            self.record(record)
+
+    def record(self, record: dict) -> dict:
+        """Adds the context to record (without replacing its values), then stores and writes it."""
+        record = dict(self.context, **record)
+        with self._lock:
+            self.records.append(record)
+        if self.echo:
+            print(f'{METRICS_PREFIX}{json.dumps(record, default=str)}', flush=True)
+        if self.path is not None:
+            self._write(record)
+        elif not self.echo:
+            self._unwritten.append(record)
+        return record
+
+    def _write(self, record: dict) -> None:
+        """Appends record to the metrics file."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as fp:
+            if fcntl is None:
+                # No file lock on Windows; records are single appended lines
+                fp.write(json.dumps(record, default=str) + '\n')
+                return
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                fp.write(json.dumps(record, default=str) + '\n')
+                fp.flush()
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def totals(self) -> dict[str, float]:
+        """Returns phase => total wall seconds, for the records in memory (the last MAX_RECORDS)."""
+        totals = collections.defaultdict(float)
+        for record in self.records:
+            totals[record['phase']] += record.get('wall_s') or 0.0
+        return dict(totals)
+
+
+# Instrument shared by the modules of this process
+_instrument = Instrument()
+
+
+def get_instrument() -> Instrument:
+    """Returns the instrument for this process (configure it to write a metrics file)."""
+    return _instrument
+
+
+def read_metrics(paths: list[str|pathlib.Path]) -> list[dict]:
+    """Returns records from metrics files, skipping lines that are not json."""
+    records = list()
+    for path in paths:
+        with open(path) as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def summarize(records: list[dict], by: list[str]|None = None) -> list[dict]:
+    """Returns one row per phase (and by keys), with count, total and mean wall time, cpu and memory."""
+    by = by or list()
+    groups = collections.defaultdict(list)
+    for record in records:
+        key = tuple(str(record.get(k)) for k in by) + (record.get('phase'),)
+        groups[key].append(record)
+
+    rows = list()
+    for key, group in sorted(groups.items()):
+        wall = [r.get('wall_s') or 0.0 for r in group]
+        cpu = [r.get('cpu_s') or 0.0 for r in group]
+        peak = [r['peak_rss_mb'] for r in group if r.get('peak_rss_mb') is not None]
+        row = dict(zip(by + ['phase'], key))
+        row.update(
+            count=len(group),
+            total_s=round(sum(wall), 3),
+            mean_s=round(sum(wall) / len(group), 3),
+            max_s=round(max(wall), 3),
+            cpu_util=round(sum(cpu) / sum(wall), 2) if sum(wall) > 0 else None,
+            peak_rss_mb=round(max(peak), 1) if peak else None,
+        )
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize metrics files by phase')
+    parser.add_argument('metrics_files', nargs='+', help='Metrics files (json lines)')
+    parser.add_argument('--by', nargs='+', default=[],
+        help='Record fields to group by as well as phase (e.g. basin_id step)')
+    parser.add_argument('-o', '--output', help='Write summary as json lines to this file')
+    args = parser.parse_args()
+
+    rows = summarize(read_metrics(args.metrics_files), args.by)
+    if not rows:
+        print('No records found')
+        return
+    columns = list(rows[0])
+    table = [columns] + [['-' if row[c] is None else str(row[c]) for c in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    for line in table:
+        print('  '.join(text.ljust(width) for text, width in zip(line, widths)).rstrip())
+    if args.output:
+        with open(args.output, 'w') as fp:
+            for row in rows:
+                fp.write(json.dumps(row) + '\n')
+        print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
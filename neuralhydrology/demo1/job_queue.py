@@ -0,0 +1,126 @@
+"""
+This module provides a JobQueue class for passing jobs between host and container.
+
+The queue is a directory (bind mounted into the container) with pending,
+running and done subdirectories. Each job is a json file. Jobs are claimed
+by renaming them from pending to running, which is atomic, so any number
+of workers can share one queue. A job's result stays in done until the
+submitter reads it, so done only holds results that are not yet collected.
+"""
+
+import json
+import os
+import pathlib
+import time
+import uuid
+
+PENDING_DIRNAME = 'pending'
+RUNNING_DIRNAME = 'running'
+DONE_DIRNAME = 'done'
+
+
+class JobQueue:
+    """A file-based job queue.
+    """
+    def __init__(self, queue_dir: str|pathlib.Path):
+        self.queue_dir = pathlib.Path(queue_dir)
+        self.pending_dir = self.queue_dir / PENDING_DIRNAME
+        self.running_dir = self.queue_dir / RUNNING_DIRNAME
+        self.done_dir = self.queue_dir / DONE_DIRNAME
+        for path in [self.pending_dir, self.running_dir, self.done_dir]:
+            path.mkdir(parents=True, exist_ok=True)
+
+    def submit(self, job: dict) -> str:
+        """Adds job to the queue.
+
+        Returns job_id
+        """
+        # Job ids sort in submission order
+        job_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+        job = dict(job, job_id=job_id)
+        self._write_json(self.pending_dir / f'{job_id}.json', job)
+        return job_id
+
+    def claim(self) -> dict|None:
+        """Moves the oldest pending job to running.
+
+        Returns the job, or None if no jobs are pending
+        """
+        for path in sorted(self.pending_dir.glob('*.json')):
+            running_path = self.running_dir / path.name
+            try:
+                os.rename(path, running_path)
+            except FileNotFoundError:
+                continue  # claimed by another worker
+            with open(running_path) as fp:
+                return json.load(fp)
+        return None
+
+    def cancel(self, job_id: str) -> bool:
+        """Removes job from pending.
+
+        Returns True if the job was pending, False if it was already claimed
+        """
+        try:
+            (self.pending_dir / f'{job_id}.json').unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def clear(self) -> int:
+        """Removes all jobs and results, e.g. those left by an interrupted run.
+
+        Only call this when no workers or submitters are using the queue.
+        Returns number of pending and running jobs removed
+        """
+        count = 0
+        for path in list(self.pending_dir.glob('*.json')) + list(self.running_dir.glob('*.json')):
+            path.unlink(missing_ok=True)
+            count += 1
+        for path in self.done_dir.glob('*.json'):
+            path.unlink(missing_ok=True)
+        return count
+
+    def complete(self, job_id: str, result: dict|None) -> None:
+        """Writes job result and removes job from running.
+
+        Set result to None for jobs whose result nobody reads (e.g. shutdown).
+        """
+        if result is not None:
+            self._write_json(self.done_dir / f'{job_id}.json', dict(result, job_id=job_id))
+        (self.running_dir / f'{job_id}.json').unlink(missing_ok=True)
+
+    def result(self, job_id: str) -> dict|None:
+        """Returns job result and removes it from the queue, or None if job is not done.
+
+        A result can only be read once.
+        """
+        path = self.done_dir / f'{job_id}.json'
+        try:
+            with open(path) as fp:
+                result = json.load(fp)
+        except FileNotFoundError:
+            return None
+        path.unlink(missing_ok=True)
+        return result
+
+    def wait(self, job_id: str, poll_interval: float = 1.0, timeout: float|None = None) -> dict:
+        """Waits for job to be done.
+
+        Returns job result (removed from the queue, as by result()). Raises TimeoutError if timeout (seconds) expires.
+        """
+        start = time.monotonic()
+        while True:
+            result = self.result(job_id)
+            if result is not None:
+                return result
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f'Timed out waiting for job {job_id}')
+            time.sleep(poll_interval)
+
+    def _write_json(self, path: pathlib.Path, data: dict) -> None:
+        """Writes json file atomically, so readers never see partial contents."""
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        with open(tmp_path, 'w') as fp:
+            json.dump(data, fp, indent=2)
+        os.rename(tmp_path, path)
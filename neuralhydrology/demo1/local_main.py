@@ -3,32 +3,66 @@ This script uses the BasinNH class to train and test neuralhyrology models.
 """
 
 import argparse
+import json
 import pathlib
 import sys
 
 # Optional filename for command line args
 ARGS_FILENAME = '.args.txt'
 
-from args_utils import add_standard_arguments, validate_inputs
+from args_utils import BATCH_MODES, add_standard_arguments, validate_inputs
+from checkpoints import DEFAULT_KEEP_LAST
+from constants import RESULT_PREFIX
+from instrument import METRICS_FILENAME, get_instrument
 
 def main():
     parser = argparse.ArgumentParser(
         description=__doc__,
         epilog=f'Note: You can also put arguments in {ARGS_FILENAME} file',
         fromfile_prefix_chars='@')
-    add_standard_arguments(parser, with_step=True)
+    add_standard_arguments(parser, with_step=True, with_batch=True)
+    parser.add_argument('-m', '--batch_mode', choices=BATCH_MODES, default=BATCH_MODES[0],
+        help=f'Batch training mode, used with --basin_list [{BATCH_MODES[0]}]')
+    parser.add_argument('-z', '--zarr_results', action='store_true',
+        help='Also write test results to experiments_dir/results.zarr')
+    parser.add_argument('--start_date', help='First date for predict step (YYYY-MM-DD)')
+    parser.add_argument('--end_date', help='Last date for predict step (YYYY-MM-DD)')
+    parser.add_argument('-o', '--output',
+        help='NetCDF file for predict step [experiments_dir/predictions/<basin>_<start>_<end>.nc]')
+    parser.add_argument('--stateful', action='store_true',
+        help='Test and predict by carrying LSTM state through the period, instead of one window per day'
+            ' (results can differ from the windowed test, see predictor.py)')
+    parser.add_argument('--reevaluate', action='store_true',
+        help='Rerun evaluation in the test step, instead of reusing test results newer than the weights and config')
+    parser.add_argument('--keep_checkpoints', type=int, default=DEFAULT_KEEP_LAST,
+        help=f'Number of most recent epochs to keep weights for, besides the best [{DEFAULT_KEEP_LAST}]')
+    parser.add_argument('--metrics_file',
+        help=f'File to append timing and resource records to [experiments_dir/{METRICS_FILENAME}]')
+    parser.add_argument('--echo_metrics', action='store_true',
+        help='Print metrics records to stdout for the host (DemoRun), instead of writing metrics_file')
 
     # Include ARGS_FILENAME if present
     file_args = [f'@{ARGS_FILENAME}'] if pathlib.Path(ARGS_FILENAME).exists() else []
     args = parser.parse_args(sys.argv[1:] + file_args)
     # print(args)
 
+    instrument = get_instrument()
+    instrument.configure(echo=args.echo_metrics, step=args.step, run_id=args.run_id)
     try:
-        validate_inputs(args)
+        with instrument.phase('validate_args'):
+            validate_inputs(args)
+            # After validation, which zero pads basin_id, so records match the run index
+            instrument.configure(basin_id=args.basin_id or args.basin_list)
+            if args.step == 'predict' and (args.start_date is None or args.end_date is None):
+                raise ValueError('start_date and end_date are required for predict step')
     except Exception as e:
         print(f'Error: {e}')
         print('Exiting')
         sys.exit(2)
+    metrics_file = args.metrics_file
+    if metrics_file is None and not args.echo_metrics:
+        metrics_file = pathlib.Path(args.experiments_dir) / METRICS_FILENAME
+    instrument.configure(path=metrics_file)
 
     # Check dry run option
     if args.dry_run:
@@ -38,16 +72,94 @@ def main():
 
     # Import BasinNH here, just so that we run argparse without the delay
     print('Importing BasinNH')
-    from basin_nh import BasinNH
+    with instrument.phase('import'):
+        from basin_nh import BasinNH
 
-    nh = BasinNH(args)
-    if args.step == 'train':
+    with instrument.phase('run') as phase_attrs:
+        nh = BasinNH(args)
+        run_step(nh, args)
+        phase_attrs['slowest_phases'] = slowest_phases(instrument.totals())
+
+
+def slowest_phases(totals: dict[str, float], count: int = 3) -> dict[str, float]:
+    """Returns the phases with the most wall time."""
+    ordered = sorted(totals.items(), key=lambda item: -item[1])
+    return {phase: round(seconds, 3) for phase, seconds in ordered[:count]}
+
+
+def run_step(nh, args: argparse.Namespace):
+    """Runs train, test or predict step."""
+    if args.basin_list:
+        run_batch(nh, args)
+    elif args.step == 'train':
         run_id: str = nh.run_training()
+        get_instrument().configure(run_id=run_id)
         print(f'Training returned {run_id=}')
+        run_dir = None if run_id is None else f'{args.basin_id}/runs/{run_id}'
+        print_result(dict(step='train', basin_id=args.basin_id, run_id=run_id,
+            run_dir=run_dir, epochs=args.training_epochs))
     elif args.step == 'test':
         results_ds = nh.run_testing()
         print('Testing returned dataset:')
         print(results_ds)
+        result = dict(step='test', basin_id=args.basin_id, run_id=args.run_id)
+        if results_ds is not None:
+            result['NSE'] = float(results_ds.attrs['NSE'])
+            result['epochs'] = int(results_ds.attrs['epochs'])
+            result['epoch'] = int(results_ds.attrs['epoch'])
+            result['simulation'] = results_ds.attrs['simulation']
+        print_result(result)
+    elif args.step == 'predict':
+        ds = nh.run_prediction(args.start_date, args.end_date)
+        write_prediction(ds, args, args.basin_id)
+    else:
+        print(f'Unrecognized step argument {args.step}')
+
+
+def write_prediction(ds, args: argparse.Namespace, name: str):
+    """Writes predict step dataset to netcdf and prints result."""
+    print(ds)
+    if args.output is None:
+        output_dir = pathlib.Path(args.experiments_dir) / 'predictions'
+        output_dir.mkdir(parents=True, exist_ok=True)
+        output_path = output_dir / f'{name}_{args.start_date}_{args.end_date}.nc'
+    else:
+        output_path = pathlib.Path(args.output)
+    # scipy (netCDF3) allows '/' in variable names, e.g. QObs(mm/d)_sim
+    with get_instrument().phase('write_results', path=str(output_path)):
+        ds.to_netcdf(output_path, engine='scipy')
+    print(f'Wrote {output_path}')
+    print_result(dict(step='predict', basins=[str(b) for b in ds['basin'].values],
+        runs=sorted(set(str(r) for r in ds['run'].values)), output=str(output_path)))
+
+
+def print_result(result: dict):
+    """Writes step result to stdout as one line of json, for the host to parse."""
+    print(f'{RESULT_PREFIX}{json.dumps(result)}', flush=True)
+
+
+def run_batch(nh, args: argparse.Namespace):
+    """Runs train, test or predict step for all basins in args.basin_ids."""
+    manifest_path = pathlib.Path(args.manifest)
+    if args.step == 'train':
+        regional = args.batch_mode == 'regional'
+        manifest = nh.run_batch_training(args.basin_ids, regional=regional, manifest_path=manifest_path)
+        failed = [b for b, entry in manifest['runs'].items() if entry['run_id'] is None]
+        print(f'Batch training finished, {len(failed)} failed')
+        print(f'Wrote {manifest_path}')
+        print_result(dict(step='train', manifest=str(manifest_path), runs=manifest['runs']))
+    elif args.step == 'test':
+        manifest = nh.read_manifest(manifest_path)
+        results = nh.run_batch_testing(manifest)
+        print(f'Batch testing returned {len(results)} datasets')
+        for basin_id, ds in results.items():
+            nse = None if ds is None else ds.attrs.get('NSE')
+            simulation = '' if ds is None else f' ({ds.attrs.get("simulation")})'
+            print(f'  {basin_id}  NSE {nse}{simulation}')
+    elif args.step == 'predict':
+        manifest = nh.read_manifest(manifest_path)
+        ds = nh.run_prediction(args.start_date, args.end_date, manifest=manifest)
+        write_prediction(ds, args, 'batch')
     else:
         print(f'Unrecognized step argument {args.step}')
 
@@ -0,0 +1,387 @@
+"""
+This module provides a Predictor class, for running a trained nh model on arbitrary dates.
+
+nh_run.eval_run loads the config, scalers and weights on every call, and only
+evaluates the configured test period. A Predictor loads them once, keeps the
+per-basin datasets it builds, and runs one batched forward pass over all of
+the requested basins. Predictors are cached by run directory and epoch, so
+repeated calls in the same process skip loading entirely.
+
+In stateful mode, each basin's input series runs through the model as one
+sequence, so the LSTM state carries forward from day to day instead of
+being rebuilt from seq_length days of inputs for every prediction. The
+first prediction sees exactly the same seq_length inputs as in windowed
+mode; later ones also see older inputs, through the carried state. How much
+that changes the predictions depends on the model: it can be negligible, or
+grow over the period well beyond STATEFUL_TOLERANCE (in normalized target
+units, i.e. fractions of the training-period standard deviation), so
+stateful output is a different quantity from nh's windowed output.
+windowed_difference() compares it with windowed predictions for the last
+STATEFUL_CHECK_DAYS of the period, and verify() over the whole test period.
+Missing inputs restart the sequence, so predictions are NaN exactly where
+nh's windowed predictions are.
+
+The stateful series is joined from the dataset's samples (its __getitem__),
+which in nh 1.11 have x_d as one [time, features] tensor.
+
+Only single-frequency regression models (as in template.basin.yml) are
+supported, and stateful mode needs a model with a recurrent state over the
+whole input sequence (cudalstm).
+
+To check predictions against nh's test results for a tested run:
+
+    python predictor.py <run_dir> [-e epoch] [-b basin_id ...]
+"""
+
+import argparse
+from collections import OrderedDict
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import ConcatDataset, DataLoader
+import xarray as xr
+
+from neuralhydrology.datasetzoo import get_dataset
+from neuralhydrology.datautils.utils import load_scaler
+from neuralhydrology.evaluation.utils import load_basin_id_encoding
+from neuralhydrology.modelzoo import get_model
+from neuralhydrology.utils.config import Config
+from checkpoints import read_best_epoch
+from results_reader import ResultsReader
+
+# Number of models and (per model) basin datasets kept in memory
+MAX_CACHED_PREDICTORS = 4
+MAX_CACHED_DATASETS = 64
+
+# Largest |stateful - windowed| simulation (normalized target units) accepted as the same
+STATEFUL_TOLERANCE = 1e-3
+# Days at the end of the period that windowed_difference() predicts windowed
+STATEFUL_CHECK_DAYS = 365
+# Largest difference (normalized target units) accepted by verify() from nh's test results
+WINDOWED_TOLERANCE = 1e-5
+STATEFUL_MODELS = ['cudalstm']
+
+# nh config date format
+NH_DATE_FORMAT = '%d/%m/%Y'
+
+_predictors = OrderedDict()
+
+
+class Predictor:
+    """Runs the model of one nh run directory, with config, scalers and weights loaded once.
+    """
+    def __init__(self, run_dir: str|pathlib.Path, epoch: int, device: str|None = None):
+        """
+        Initializes a Predictor object.
+
+        device overrides the config device, since runs may be scored on a
+        different machine than they were trained on.
+        """
+        self.run_dir = pathlib.Path(run_dir)
+        self.epoch = epoch
+        self.cfg = Config(self.run_dir / 'config.yml')
+        if device is not None:
+            self.cfg.device = device
+        if len(self.cfg.use_frequencies) > 1:
+            raise NotImplementedError('Predictor does not support multi-frequency models')
+        self.device = torch.device(self.cfg.device or 'cpu')
+
+        self.scaler = load_scaler(self.run_dir)
+        self.id_to_int = load_basin_id_encoding(self.run_dir) if self.cfg.use_basin_id_encoding else {}
+
+        weight_path = self.run_dir / f'model_epoch{epoch:03d}.pt'
+        self.model = get_model(self.cfg).to(self.device)
+        self.model.load_state_dict(torch.load(weight_path, map_location=self.device))
+        self.model.eval()
+
+        targets = self.cfg.target_variables
+        self.target_scale = self.scaler['xarray_feature_scale'][targets].to_array().values
+        self.target_center = self.scaler['xarray_feature_center'][targets].to_array().values
+        self._datasets = OrderedDict()
+
+    def predict(self,
+            basin_ids: list[str],
+            start_date: str|pd.Timestamp,
+            end_date: str|pd.Timestamp,
+            batch_size: int|None = None,
+            stateful: bool = False) -> xr.Dataset:
+        """Returns simulated (and observed) targets for the basins between start and end dates.
+
+        The dataset has basin and date dimensions and one <target>_sim and
+        <target>_obs variable per target, in the units of the training data.
+        Targets in the config's clip_targets_to_zero are clipped, as nh does.
+        Basins with no input data for the period are left out. Set stateful
+        to carry the LSTM state through the period (see module docstring).
+        """
+        start_date = pd.Timestamp(start_date)
+        end_date = pd.Timestamp(end_date)
+
+        datasets, used_basins = list(), list()
+        for basin_id in basin_ids:
+            ds = self._dataset(basin_id, start_date, end_date)
+            if ds is not None:
+                datasets.append(ds)
+                used_basins.append(basin_id)
+        if not datasets:
+            raise ValueError(f'No input data for any basin between {start_date.date()} and {end_date.date()}')
+
+        date_index = pd.date_range(start_date, end_date, freq=datasets[0].frequencies[0], name='date')
+        if stateful:
+            sim, obs = self._simulate(datasets, used_basins, date_index)
+        else:
+            sim, obs = self._predict_windows(datasets, date_index, batch_size)
+
+        # As in nh testing, clip the configured targets (NaN stays NaN)
+        for i, target in enumerate(self.cfg.target_variables):
+            if target in self.cfg.clip_targets_to_zero:
+                sim[:, :, i] = np.where(sim[:, :, i] < 0, 0, sim[:, :, i])
+
+        simulation = 'stateful' if stateful else 'windowed'
+        data_vars = dict()
+        for i, target in enumerate(self.cfg.target_variables):
+            data_vars[f'{target}_obs'] = (('basin', 'date'), obs[:, :, i])
+            data_vars[f'{target}_sim'] = (('basin', 'date'), sim[:, :, i], dict(simulation=simulation))
+        return xr.Dataset(
+            data_vars,
+            coords=dict(
+                basin=used_basins,
+                date=date_index,
+                run=('basin', [self.run_dir.name] * len(used_basins)),
+            ),
+            attrs=dict(
+                run=self.run_dir.name,
+                epoch=self.epoch,
+                frequency=datasets[0].frequencies[0],
+                simulation=simulation,
+            ),
+        )
+
+    def windowed_difference(self, ds: xr.Dataset, days: int = STATEFUL_CHECK_DAYS) -> dict[str, float|None]:
+        """Compares stateful predictions (from predict()) with windowed ones for the last days.
+
+        State differences accumulate over the period, so its end is where they
+        are largest. Returns basin_id => largest absolute difference over the
+        targets, in normalized target units, or None if the predictions are
+        missing (NaN) at different dates
+        """
+        end_date = pd.Timestamp(ds['date'].values[-1])
+        start_date = max(pd.Timestamp(ds['date'].values[0]), end_date - pd.Timedelta(days=days - 1))
+        windowed = self.predict(list(ds['basin'].values), start_date, end_date)
+        stateful = ds.sel(date=windowed['date'], basin=windowed['basin'])
+
+        differences = dict()
+        for basin_id in windowed['basin'].values:
+            basin_differences = list()
+            for i, target in enumerate(self.cfg.target_variables):
+                basin_differences.append(max_difference(
+                    stateful[f'{target}_sim'].sel(basin=basin_id).values / self.target_scale[i],
+                    windowed[f'{target}_sim'].sel(basin=basin_id).values / self.target_scale[i]))
+            differences[str(basin_id)] = None if None in basin_differences else max(basin_differences)
+        return differences
+
+    def _predict_windows(self, datasets: list, date_index: pd.DatetimeIndex, batch_size: int|None) -> tuple:
+        """Returns (sim, obs) [basin, date, target] from one seq_length window per date, as nh evaluates."""
+        # One loader over all basins, so small basins share batches
+        loader = DataLoader(ConcatDataset(datasets), batch_size=batch_size or self.cfg.batch_size,
+            num_workers=0, collate_fn=datasets[0].collate_fn)
+        y_hat, y, dates = list(), list(), list()
+        with torch.no_grad():
+            for data in loader:
+                # As in nh's tester
+                for key in data:
+                    if not key.startswith('date'):
+                        data[key] = data[key].to(self.device)
+                data = self.model.pre_model_hook(data, is_train=False)
+                predictions = self.model(data)
+                y_hat.append(predictions['y_hat'][:, -1, :].cpu().numpy())
+                y.append(data['y'][:, -1, :].cpu().numpy())
+                dates.append(data['date'][:, -1])
+        y_hat = np.concatenate(y_hat) * self.target_scale + self.target_center
+        y = np.concatenate(y) * self.target_scale + self.target_center
+        dates = np.concatenate(dates)
+
+        # Samples are in basin order, so split them by dataset length
+        sim = np.full((len(datasets), len(date_index), len(self.cfg.target_variables)), np.nan, dtype=np.float32)
+        obs = np.full_like(sim, np.nan)
+        offset = 0
+        for i, ds in enumerate(datasets):
+            rows = slice(offset, offset + len(ds))
+            positions = date_index.get_indexer(pd.DatetimeIndex(dates[rows]))
+            sim[i, positions] = y_hat[rows]
+            obs[i, positions] = y[rows]
+            offset += len(ds)
+        return sim, obs
+
+    def _simulate(self, datasets: list, basin_ids: list[str], date_index: pd.DatetimeIndex) -> tuple:
+        """Returns (sim, obs) [basin, date, target] from one pass over each basin's full input series."""
+        if self.cfg.model not in STATEFUL_MODELS:
+            raise NotImplementedError(f'Stateful simulation is not supported for {self.cfg.model} models')
+        seq_length = self.cfg.seq_length
+        sim = np.full((len(datasets), len(date_index), len(self.cfg.target_variables)), np.nan, dtype=np.float32)
+        obs = np.full_like(sim, np.nan)
+        with torch.no_grad():
+            for i, ds in enumerate(datasets):
+                for series in _sample_series(ds):
+                    positions = date_index.get_indexer(pd.DatetimeIndex(series['date']))
+                    y = series['y'].numpy() * self.target_scale + self.target_center
+                    obs[i, positions[positions >= 0]] = y[positions >= 0]
+
+                    # Missing inputs would propagate through the state, so each run
+                    # of complete inputs is simulated separately
+                    x_d = series['x_d']
+                    missing = x_d.isnan().any(dim=-1).numpy()
+                    for start, end in _complete_runs(missing):
+                        if end - start < seq_length:
+                            continue
+                        data = {'x_d': x_d[None, start:end].to(self.device)}
+                        data.update({k: v[None].to(self.device) for k, v in series['static'].items()})
+                        data = self.model.pre_model_hook(data, is_train=False)
+                        y_hat = self.model(data)['y_hat'][0].cpu().numpy() * self.target_scale + self.target_center
+                        # Steps before a full seq_length of inputs are warmup
+                        run_positions = positions[start + seq_length - 1:end]
+                        valid = run_positions >= 0
+                        sim[i, run_positions[valid]] = y_hat[seq_length - 1:][valid]
+        return sim, obs
+
+    def _dataset(self, basin_id: str, start_date: pd.Timestamp, end_date: pd.Timestamp):
+        """Returns cached nh dataset for one basin and period, or None if there is no data."""
+        key = (basin_id, start_date, end_date)
+        if key in self._datasets:
+            self._datasets.move_to_end(key)
+            return self._datasets[key]
+
+        # nh builds evaluation datasets from the period dates in the config
+        self.cfg.update_config(dict(
+            test_start_date=start_date.strftime(NH_DATE_FORMAT),
+            test_end_date=end_date.strftime(NH_DATE_FORMAT),
+        ))
+        try:
+            ds = get_dataset(self.cfg, is_train=False, period='test', basin=basin_id,
+                id_to_int=self.id_to_int, scaler=self.scaler)
+        except Exception as e:
+            # nh raises NoEvaluationDataError (and others) when inputs are missing
+            print(f'Warning: no prediction data for basin {basin_id}: {e}')
+            ds = None
+        if ds is not None and len(ds) == 0:
+            ds = None
+
+        self._datasets[key] = ds
+        if len(self._datasets) > MAX_CACHED_DATASETS:
+            self._datasets.popitem(last=False)
+        return ds
+
+
+def _sample_series(ds) -> list[dict]:
+    """Returns the samples of a single-basin nh dataset, joined into continuous series.
+
+    Each evaluation sample is the seq_length window ending at one date (x_d is
+    a [time, features] tensor, as in nh 1.11), so a sample that follows the
+    previous one adds only its last step. Each series has x_d, y and date for
+    a run of consecutive samples, and the static inputs of the basin.
+    """
+    series = list()
+    current = None
+    for item in range(len(ds)):
+        sample = ds[item]
+        dates = np.asarray(sample['date'])
+        if current is not None and len(dates) > 1 and dates[-2] == current['date'][-1][-1]:
+            for key in ['x_d', 'y', 'date']:
+                current[key].append(sample[key][-1:])
+            continue
+        current = {key: [sample[key]] for key in ['x_d', 'y', 'date']}
+        current['static'] = {key: sample[key] for key in ['x_s', 'x_one_hot'] if key in sample}
+        series.append(current)
+
+    for current in series:
+        current['x_d'] = torch.cat(current['x_d'])
+        current['y'] = torch.cat(current['y'])
+        current['date'] = np.concatenate(current['date'])
+    return series
+
+def _complete_runs(missing: np.ndarray) -> list[tuple[int, int]]:
+    """Returns (start, end) of each run of False values in missing."""
+    edges = np.diff(np.concatenate([[True], missing, [True]]).astype(np.int8))
+    return list(zip(np.flatnonzero(edges == -1), np.flatnonzero(edges == 1)))
+
+def max_difference(a: np.ndarray, b: np.ndarray) -> float|None:
+    """Returns largest absolute difference, or None if a and b are missing (NaN) at different places."""
+    if not np.array_equal(np.isnan(a), np.isnan(b)):
+        return None
+    return float(np.nanmax(np.abs(a - b), initial=0.0))
+
+def verify(run_dir: str|pathlib.Path,
+        epoch: int,
+        basin_ids: list[str]|None = None,
+        device: str|None = None) -> bool:
+    """Compares predict() with nh's test results (test_results.p) over the test period.
+
+    The run must have been tested at epoch (local_main.py -s test). Prints the
+    largest difference per basin and target, in normalized target units, and
+    returns True if all are within WINDOWED_TOLERANCE.
+
+    Also compares stateful with windowed predictions, which must agree within
+    STATEFUL_TOLERANCE.
+    """
+    run_dir = pathlib.Path(run_dir)
+    reader = ResultsReader(run_dir / 'test' / f'model_epoch{epoch:03d}')
+    if not reader.pickle_path.exists():
+        raise FileNotFoundError(f'No test results in {reader.model_dir} (run the test step first)')
+    cfg = Config(run_dir / 'config.yml')
+    predictor = get_predictor(run_dir, epoch, device=device)
+    basin_ids = basin_ids or reader.basin_ids()
+    windowed = predictor.predict(basin_ids, cfg.test_start_date, cfg.test_end_date)
+    stateful = predictor.predict(basin_ids, cfg.test_start_date, cfg.test_end_date, stateful=True)
+
+    ok = True
+    for basin_id in windowed['basin'].values:
+        nh_ds = reader.read(str(basin_id))['xr']
+        for i, target in enumerate(cfg.target_variables):
+            expected = nh_ds[f'{target}_sim'].isel(time_step=-1).reindex(date=windowed['date']).values
+            sim = windowed[f'{target}_sim'].sel(basin=basin_id).values
+            diff = max_difference(sim / predictor.target_scale[i], expected / predictor.target_scale[i])
+            if diff is None:
+                print(f'{basin_id} {target}: missing predictions differ from nh')
+                ok = False
+                continue
+            print(f'{basin_id} {target}: max abs difference from nh (normalized units): {diff:.3g}')
+            ok = ok and diff <= WINDOWED_TOLERANCE
+
+            sim_stateful = stateful[f'{target}_sim'].sel(basin=basin_id).values
+            diff = max_difference(sim_stateful / predictor.target_scale[i], sim / predictor.target_scale[i])
+            if diff is None:
+                print(f'{basin_id} {target}: missing stateful predictions differ from windowed')
+                ok = False
+                continue
+            print(f'{basin_id} {target}: max abs stateful difference from windowed (normalized units): {diff:.3g}')
+            ok = ok and diff <= STATEFUL_TOLERANCE
+    return ok
+
+def get_predictor(run_dir: str|pathlib.Path, epoch: int, device: str|None = None) -> Predictor:
+    """Returns cached Predictor for the run directory and epoch, creating it if needed."""
+    key = (str(pathlib.Path(run_dir).resolve()), epoch, device)
+    predictor = _predictors.get(key)
+    if predictor is None:
+        predictor = Predictor(run_dir, epoch, device=device)
+        _predictors[key] = predictor
+        if len(_predictors) > MAX_CACHED_PREDICTORS:
+            _predictors.popitem(last=False)
+    else:
+        _predictors.move_to_end(key)
+    return predictor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare Predictor output (windowed and stateful) with nh test results for a run')
+    parser.add_argument('run_dir', help='nh run directory, tested with local_main.py -s test')
+    parser.add_argument('-e', '--epoch', type=int, help='Epoch [best epoch, or the last]')
+    parser.add_argument('-b', '--basin_ids', nargs='+', help='Basins to compare [all tested basins]')
+    parser.add_argument('--device', default='cpu', help='Torch device [cpu]')
+    args = parser.parse_args()
+
+    epoch = args.epoch or read_best_epoch(args.run_dir) or Config(pathlib.Path(args.run_dir) / 'config.yml').epochs
+    ok = verify(args.run_dir, epoch, basin_ids=args.basin_ids, device=args.device)
+    print('OK' if ok else f'FAILED (tolerance {WINDOWED_TOLERANCE}, stateful {STATEFUL_TOLERANCE})')
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,109 @@
+"""
+This module provides a ResultsReader class, for reading one basin from nh test results.
+
+neuralhydrology writes the test results of all basins in a run to a single
+pickle file (test_results.p), so reading one basin deserializes every basin.
+ResultsReader splits the pickle once into one file per basin, with an index,
+in a folder next to it. Later reads load only the requested basin. The split
+is redone if the pickle changes.
+"""
+
+import json
+import os
+import pathlib
+import pickle
+import shutil
+
+RESULTS_PICKLE_FILENAME = 'test_results.p'
+BASINS_DIRNAME = 'test_results_basins'
+INDEX_FILENAME = 'index.json'
+
+
+class ResultsReader:
+    """Per-basin reader for the test results in one nh model directory.
+    """
+    def __init__(self, model_dir: str|pathlib.Path, filename: str = RESULTS_PICKLE_FILENAME):
+        """model_dir is the folder nh writes results to, e.g. <run_dir>/test/model_epoch050"""
+        self.model_dir = pathlib.Path(model_dir)
+        self.pickle_path = self.model_dir / filename
+        self.basins_dir = self.model_dir / BASINS_DIRNAME
+        self._index = None
+
+    def index(self) -> dict:
+        """Returns index of basin_id => {filename, metrics}, splitting the pickle if needed."""
+        if self._index is None:
+            self._index = self._read_index()
+        if self._index is None:
+            self._index = self.split()
+        return self._index
+
+    def basin_ids(self) -> list[str]:
+        """Returns basins in the results."""
+        return list(self.index()['basins'])
+
+    def read(self, basin_id: str) -> dict|None:
+        """Returns results for one basin, or None if not found.
+
+        The results are the '1D' dictionary nh stores for the basin:
+        the 'xr' dataset and one entry per metric.
+        """
+        entry = self.index()['basins'].get(basin_id)
+        if entry is None:
+            return None
+        with open(self.basins_dir / entry['filename'], 'rb') as fp:
+            return pickle.load(fp)
+
+    def split(self, file_dict: dict|None = None) -> dict:
+        """Writes one file per basin from the results pickle and returns the index.
+
+        Pass file_dict if the pickle has already been loaded.
+        """
+        stat = self.pickle_path.stat()
+        if file_dict is None:
+            with open(self.pickle_path, 'rb') as fp:
+                file_dict = pickle.load(fp)
+
+        # Write to a temporary folder, then rename it into place
+        tmp_dir = self.basins_dir.with_name(f'.{BASINS_DIRNAME}.{os.getpid()}.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+
+        basins = dict()
+        for basin_id, basin_dict in file_dict.items():
+            oned_dict = basin_dict.get('1D')
+            if not oned_dict:
+                continue
+            filename = f'{basin_id}.p'
+            with open(tmp_dir / filename, 'wb') as fp:
+                pickle.dump(oned_dict, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            metrics = {k: float(v) for k, v in oned_dict.items() if k != 'xr'}
+            basins[basin_id] = dict(filename=filename, metrics=metrics)
+
+        index = dict(
+            source_mtime_ns=stat.st_mtime_ns,
+            source_size=stat.st_size,
+            basins=basins,
+        )
+        with open(tmp_dir / INDEX_FILENAME, 'w') as fp:
+            json.dump(index, fp, indent=2)
+
+        shutil.rmtree(self.basins_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, self.basins_dir)
+        except OSError:
+            # Another process split the same pickle first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._index = index
+        return index
+
+    def _read_index(self) -> dict|None:
+        """Returns the saved index if it matches the pickle, otherwise None."""
+        index_path = self.basins_dir / INDEX_FILENAME
+        if not index_path.exists():
+            return None
+        with open(index_path) as fp:
+            index = json.load(fp)
+        stat = self.pickle_path.stat()
+        if index.get('source_mtime_ns') != stat.st_mtime_ns or index.get('source_size') != stat.st_size:
+            return None
+        return index
@@ -0,0 +1,268 @@
+"""
+This module provides a ResultsStore class, a Zarr store for test results of many basins.
+
+Each basin's test results dataset (observed and simulated discharge, with NSE,
+basin, run, epochs and simulation attributes) is written to its own group,
+<basin>/<run> for nh's windowed test and <basin>/<run>.stateful for a stateful
+test (see predictor.py), and recorded in an index file next to the store.
+Groups are written to a temporary name and renamed into place, and index
+appends are serialized with a file lock, so concurrent trainings can write to
+the same store.
+
+Reading many basins from their own groups opens each group's metadata. To
+read them in one open instead, combine() copies the latest results of every
+basin into one group (combined/<simulation>) with a basin dimension, which
+open_basins() uses while no results have been written since.
+
+Requires the zarr package. The store can also be filled from existing
+test_results*.nc files, and then combined:
+
+    python results_store.py <experiments_dir> --combine
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import pathlib
+import shutil
+
+import xarray as xr
+
+RESULTS_STORE_DIRNAME = 'results.zarr'
+RESULTS_INDEX_SUFFIX = '_index.jsonl'
+# Group with the latest results of all basins, per simulation
+COMBINED_GROUP = 'combined'
+# Test results of nh's evaluation (one seq_length window per date)
+WINDOWED = 'windowed'
+
+# Zarr uses '/' as the group separator, so it is escaped in variable names,
+# e.g. QObs(mm/d)_obs
+SLASH_ESCAPE = '%2F'
+
+
+class ResultsStore:
+    """Zarr store of test results, indexed by basin and run.
+    """
+    def __init__(self, store_path: str|pathlib.Path):
+        self.store_path = pathlib.Path(store_path)
+        # Outside of the store, which zarr expects to contain only zarr objects
+        self.index_path = self.store_path.with_name(f'{self.store_path.stem}{RESULTS_INDEX_SUFFIX}')
+
+    def write(self, ds: xr.Dataset) -> str:
+        """Writes results dataset, replacing any previous results for the same basin and run.
+
+        The basin, run and simulation (default windowed) are read from the
+        dataset attributes.
+
+        Returns group name
+        """
+        basin_id = str(ds.attrs['basin'])
+        run_id = str(ds.attrs['run'])
+        simulation = str(ds.attrs.get('simulation', WINDOWED))
+        group = self._group(basin_id, run_id, simulation)
+        self._write_group(ds.assign_attrs(simulation=simulation), group)
+
+        entry = dict(basin=basin_id, run=run_id, simulation=simulation, group=group)
+        for key in ['NSE', 'epochs']:
+            if key in ds.attrs:
+                entry[key] = self._json_value(ds.attrs[key])
+        self._append_index(entry)
+        return group
+
+    def read_index(self) -> list[dict]:
+        """Returns index entries, keeping the last entry for each group."""
+        entries = dict()
+        for entry in self._read_index_lines():
+            # Keep entries in the order they were last written
+            entries.pop(entry['group'], None)
+            entries[entry['group']] = entry
+        return list(entries.values())
+
+    def basin_ids(self) -> list[str]:
+        """Returns sorted list of basins in the store."""
+        return sorted({entry['basin'] for entry in self.read_index()})
+
+    def open(self, basin_id: str, run_id: str|None = None, simulation: str = WINDOWED) -> xr.Dataset:
+        """Opens results for one basin lazily.
+
+        If run_id is None, opens the most recently written run for the basin.
+        """
+        if run_id is None:
+            runs = [e['run'] for e in self.read_index()
+                if e['basin'] == basin_id and e.get('simulation', WINDOWED) == simulation]
+            if not runs:
+                raise KeyError(f'No {simulation} results for basin {basin_id} in {self.store_path}')
+            run_id = runs[-1]
+        return self._open_group(self._group(basin_id, run_id, simulation))
+
+    def open_basins(self, basin_ids: list[str]|None = None, simulation: str = WINDOWED) -> xr.Dataset:
+        """Opens the most recent results for many basins, along a basin dimension.
+
+        Data are read when accessed. NSE, run and epochs are basin coordinates.
+        Reads the combined group if it is current, else opens each basin's group.
+        """
+        entries = self._read_index_lines()
+        latest = self._latest(entries, simulation)
+        if basin_ids is None:
+            basin_ids = sorted(latest)
+        missing = [b for b in basin_ids if b not in latest]
+        if missing:
+            raise KeyError(f'No {simulation} results for basins {" ".join(missing)} in {self.store_path}')
+
+        combined_path = self.store_path / COMBINED_GROUP / simulation
+        if combined_path.exists():
+            ds = self._open_group(f'{COMBINED_GROUP}/{simulation}')
+            if ds.attrs.get('index_entries') == len(entries):
+                return ds.sel(basin=basin_ids)
+        return self._concat_basins(basin_ids, latest, simulation)
+
+    def combine(self, simulation: str = WINDOWED) -> str|None:
+        """Writes the latest results of all basins to one group, with a basin dimension.
+
+        Not safe to run while results are being written to the store.
+
+        Returns group name, or None if there are no results
+        """
+        entries = self._read_index_lines()
+        latest = self._latest(entries, simulation)
+        if not latest:
+            return None
+        ds = self._concat_basins(sorted(latest), latest, simulation).load()
+        # Zarr cannot store missing values in object arrays
+        ds = ds.assign_coords(
+            NSE=ds['NSE'].astype(float),
+            epochs=ds['epochs'].astype(float),
+        )
+        group = f'{COMBINED_GROUP}/{simulation}'
+        self._write_group(ds.assign_attrs(simulation=simulation, index_entries=len(entries)), group)
+        return group
+
+    def import_results(self, experiments_dir: str|pathlib.Path) -> int:
+        """Writes test_results*.nc files found in experiments_dir to the store.
+
+        Returns number of datasets written
+        """
+        experiments_dir = pathlib.Path(experiments_dir)
+        count = 0
+        for nc_path in sorted(experiments_dir.glob('*/runs/*/test/*/test_results*.nc')):
+            with xr.open_dataset(nc_path) as ds:
+                if 'basin' not in ds.attrs or 'run' not in ds.attrs:
+                    print(f'Skipping {nc_path} (no basin/run attributes)')
+                    continue
+                if 'simulation' not in ds.attrs:
+                    # Written before results had a simulation attribute
+                    ds.attrs['simulation'] = 'stateful' if nc_path.name.startswith('test_results_stateful') \
+                        else WINDOWED
+                group = self.write(ds.load())
+            print(f'Wrote {group}')
+            count += 1
+        return count
+
+    def _group(self, basin_id: str, run_id: str, simulation: str) -> str:
+        """Returns group name of results."""
+        return f'{basin_id}/{run_id}' if simulation == WINDOWED else f'{basin_id}/{run_id}.{simulation}'
+
+    def _latest(self, entries: list[dict], simulation: str) -> dict[str, dict]:
+        """Returns basin_id => last index entry for the simulation."""
+        latest = dict()
+        for entry in entries:
+            if entry.get('simulation', WINDOWED) == simulation:
+                latest[entry['basin']] = entry
+        return latest
+
+    def _concat_basins(self, basin_ids: list[str], latest: dict[str, dict], simulation: str) -> xr.Dataset:
+        """Opens the groups of latest[basin_id] and concatenates them along a basin dimension."""
+        datasets = [self._open_group(latest[basin_id]['group']) for basin_id in basin_ids]
+        ds = xr.concat(datasets, dim='basin', join='outer', combine_attrs='drop')
+        return ds.assign_coords(
+            basin=basin_ids,
+            run=('basin', [latest[b]['run'] for b in basin_ids]),
+            NSE=('basin', [latest[b].get('NSE') for b in basin_ids]),
+            epochs=('basin', [latest[b].get('epochs') for b in basin_ids]),
+        ).assign_attrs(simulation=simulation)
+
+    def _open_group(self, group: str) -> xr.Dataset:
+        """Opens group lazily, with the original variable names."""
+        ds = xr.open_zarr(self.store_path, group=group, consolidated=False)
+        return ds.rename({name: self._unescape(name) for name in ds.variables if SLASH_ESCAPE in name})
+
+    def _write_group(self, ds: xr.Dataset, group: str) -> None:
+        """Writes dataset to group, replacing it, through a temporary group renamed into place."""
+        self._ensure_root()
+        group_path = self.store_path / group
+        group_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = group_path.with_name(f'.{group_path.name}.{os.getpid()}.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        ds = ds.rename({name: self._escape(name) for name in ds.variables if '/' in name})
+        ds = ds.assign_attrs({k: self._json_value(v) for k, v in ds.attrs.items()})
+        # Consolidated metadata would list the temporary group name, so it is not used
+        tmp_group = str(tmp_path.relative_to(self.store_path))
+        ds.to_zarr(self.store_path, group=tmp_group, mode='w', consolidated=False)
+
+        # Groups are directories, so they can be renamed into place
+        if group_path.exists():
+            shutil.rmtree(group_path)
+        os.rename(tmp_path, group_path)
+
+    def _read_index_lines(self) -> list[dict]:
+        """Returns all index entries, in the order they were written."""
+        if not self.index_path.exists():
+            return list()
+        with open(self.index_path) as fp:
+            return [json.loads(line) for line in fp if line.strip()]
+
+    def _ensure_root(self) -> None:
+        """Creates the root group, which concurrent writers may race to create."""
+        if (self.store_path / 'zarr.json').exists() or (self.store_path / '.zgroup').exists():
+            return
+        try:
+            xr.Dataset().to_zarr(self.store_path, mode='a', consolidated=False)
+        except Exception:
+            # Another writer created it
+            if not self.store_path.exists():
+                raise
+
+    def _append_index(self, entry: dict) -> None:
+        """Appends entry to the index, holding a file lock."""
+        line = json.dumps(entry) + '\n'
+        with open(self.index_path, 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                fp.write(line)
+                fp.flush()
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _escape(self, name: str) -> str:
+        return name.replace('/', SLASH_ESCAPE)
+
+    def _unescape(self, name: str) -> str:
+        return name.replace(SLASH_ESCAPE, '/')
+
+    def _json_value(self, value):
+        """Converts numpy scalars in attributes to python types."""
+        return value.item() if hasattr(value, 'item') else value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('experiments_dir', help='Directory with <basin>/runs/<run> results')
+    parser.add_argument('-o', '--output',
+        help=f'Results store [experiments_dir/{RESULTS_STORE_DIRNAME}]')
+    parser.add_argument('--combine', action='store_true',
+        help='Also combine the latest results of all basins into one group per simulation')
+    args = parser.parse_args()
+
+    experiments_dir = pathlib.Path(args.experiments_dir)
+    store = ResultsStore(args.output or experiments_dir / RESULTS_STORE_DIRNAME)
+    count = store.import_results(experiments_dir)
+    print(f'Wrote {count} results to {store.store_path}')
+    if args.combine:
+        for simulation in sorted({e.get('simulation', WINDOWED) for e in store.read_index()}):
+            print(f'Wrote {store.combine(simulation)}')
+
+
+if __name__ == '__main__':
+    main()
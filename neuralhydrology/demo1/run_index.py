@@ -0,0 +1,79 @@
+"""
+This module provides a RunIndex class, an append-only record of the runs in a runs directory.
+
+Each line of the index file is a json object for one run. Appends are
+serialized with a file lock, so concurrent trainings can share a runs
+directory. The latest run is read from the end of the file, without
+listing or stat-ing the run directories.
+"""
+
+import fcntl
+import json
+import os
+import pathlib
+
+RUN_INDEX_FILENAME = 'run_index.jsonl'
+
+# Read size when searching backwards for the last line
+TAIL_BLOCK_SIZE = 4096
+
+
+class RunIndex:
+    """Append-only run index for one runs directory.
+    """
+    def __init__(self, runs_dir: str|pathlib.Path):
+        self.runs_dir = pathlib.Path(runs_dir)
+        self.path = self.runs_dir / RUN_INDEX_FILENAME
+
+    def append(self, entry: dict) -> None:
+        """Adds entry (which must include run_id) to the index."""
+        if 'run_id' not in entry:
+            raise ValueError('Run index entry must include run_id')
+        line = json.dumps(entry) + '\n'
+        self.runs_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                fp.write(line)
+                fp.flush()
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def latest(self) -> dict|None:
+        """Returns the most recently appended entry, or None if the index is empty."""
+        if not self.path.exists():
+            return None
+
+        with open(self.path, 'rb') as fp:
+            fp.seek(0, os.SEEK_END)
+            end = fp.tell()
+            pos = end
+            tail = b''
+            # Read backwards until tail holds a complete last line
+            while pos > 0:
+                size = min(TAIL_BLOCK_SIZE, pos)
+                pos -= size
+                fp.seek(pos)
+                tail = fp.read(size) + tail
+                if tail.rstrip(b'\n').count(b'\n') > 0:
+                    break
+
+        lines = tail.rstrip(b'\n').split(b'\n')
+        if not lines or not lines[-1]:
+            return None
+        return json.loads(lines[-1])
+
+    def get(self, run_id: str) -> dict|None:
+        """Returns the last entry for run_id, or None if not found."""
+        if not self.path.exists():
+            return None
+
+        found = None
+        with open(self.path) as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get('run_id') == run_id:
+                    found = entry
+        return found
@@ -0,0 +1,287 @@
+"""
+This module provides a SweepScheduler class for running DemoRun for many basins.
+
+By default, each basin runs in its own, uniquely named container, and a bounded
+thread pool limits the number of containers running at the same time.
+Alternatively, a fixed pool of warm worker containers runs the basins as jobs
+from a shared JobQueue.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+import json
+import os
+import pathlib
+import time
+
+from .args_utils import BATCH_MANIFEST_FILENAME
+from .demo_run import CONTAINER_NAME, DEFAULT_ARTIFACTS, DEFAULT_ENGINE, WORKER_NAME, DemoRun
+from .device_profile import AUTO_DEVICE, available_cpus, host_has_gpu
+from .job_queue import JobQueue
+
+LOG_DIRNAME = 'logs'
+QUEUE_DIRNAME = '.queue'
+
+
+@dataclass
+class BasinResult:
+    """Outcome of train & test for one basin"""
+    basin_id: str
+    status: str
+    run_id: str | None
+    elapsed: float
+    log_path: pathlib.Path | str
+    error: str = ''
+
+
+class SweepScheduler:
+    """A class for running train & test for many basins in parallel containers.
+    """
+    def __init__(self,
+            image_name: str,
+            data_directory: str|pathlib.Path,
+            max_workers: int = 2,
+            engine: str = DEFAULT_ENGINE,
+            verbose: bool = False,
+            bind_experiments: bool = False,
+            artifacts: list[str]|None = DEFAULT_ARTIFACTS,
+            cache_dir: str|pathlib.Path|None = None,
+            device: str = AUTO_DEVICE,
+            metrics_path: pathlib.Path|None = None,
+            zarr_results: bool = False,
+            ):
+        """
+        Initializes a SweepScheduler object.
+
+        bind_experiments, artifacts, cache_dir, device, metrics_path and zarr_results
+        are passed to each DemoRun.
+        Without a GPU, each container is limited to its share of the host cores.
+        """
+        self.image_name = image_name
+        self.data_dir = data_directory
+        self.max_workers = max_workers
+        self.engine = engine
+        self.verbose = verbose
+        self.bind_experiments = bind_experiments
+        self.artifacts = artifacts
+        self.cache_dir = cache_dir
+        self.device = device
+        self.metrics_path = metrics_path
+        self.zarr_results = zarr_results
+        self.cpus = None
+        if device == 'cpu' or (device == AUTO_DEVICE and not host_has_gpu()):
+            self.cpus = max(1, available_cpus() // max_workers)
+
+    def run(self,
+            basin_ids: list[str],
+            host_experiments_dir: pathlib.Path,
+            epochs: int|None = None,
+            manifest_path: pathlib.Path|None = None) -> list[BasinResult]:
+        """Runs train & test for each basin, at most max_workers at a time.
+
+        Output for each basin is written to a log file in the experiments
+        logs directory. Run ids are written to a batch manifest, in the same
+        format as local_main.py batch mode.
+
+        Returns list of BasinResult, in the same order as basin_ids
+        """
+        log_dir = host_experiments_dir / LOG_DIRNAME
+        log_dir.mkdir(parents=True, exist_ok=True)
+        if manifest_path is None:
+            manifest_path = host_experiments_dir / BATCH_MANIFEST_FILENAME
+
+        print(f'Running {len(basin_ids)} basins, {self.max_workers} at a time')
+        if self.cpus is not None:
+            print(f'No GPU, limiting each container to {self.cpus} cores')
+        print(f'Writing logs to {log_dir}')
+        results = dict()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._run_basin, basin_id, host_experiments_dir, log_dir, epochs): basin_id
+                for basin_id in basin_ids
+            }
+            for future in as_completed(futures):
+                result = future.result()
+                results[result.basin_id] = result
+                print(f'Finished {result.basin_id}: {result.status} ({len(results)}/{len(basin_ids)})')
+
+        ordered = [results[basin_id] for basin_id in basin_ids]
+        self._write_manifest(ordered, manifest_path, epochs)
+        print(f'Wrote {manifest_path}')
+        return ordered
+
+    def run_warm(self,
+            basin_ids: list[str],
+            host_experiments_dir: pathlib.Path,
+            epochs: int|None = None,
+            manifest_path: pathlib.Path|None = None,
+            keep_workers: bool = False,
+            poll_interval: float = 2.0) -> list[BasinResult]:
+        """Runs train & test for each basin as jobs on max_workers warm worker containers.
+
+        Worker containers that are already running (from a previous call with
+        keep_workers) are reused, so they skip the container start and imports.
+        If none are running, jobs and results left on the queue by an
+        interrupted call are removed, so new workers do not run them. If this call is interrupted,
+        its pending jobs are removed from the queue.
+        Worker output is in the container logs (`docker logs demo1.worker.N`).
+
+        Returns list of BasinResult, in the same order as basin_ids
+        """
+        queue = JobQueue(host_experiments_dir / QUEUE_DIRNAME)
+        if manifest_path is None:
+            manifest_path = host_experiments_dir / BATCH_MANIFEST_FILENAME
+
+        runners = dict()
+        for i in range(self.max_workers):
+            name = f'{WORKER_NAME}.{i}'
+            runners[name] = DemoRun(
+                self.image_name,
+                self.data_dir,
+                engine=self.engine,
+                verbose=self.verbose,
+                container_name=name,
+                bind_experiments=self.bind_experiments,
+                artifacts=self.artifacts,
+                cache_dir=self.cache_dir,
+                device=self.device,
+                cpus=self.cpus,
+                metrics_path=self.metrics_path,
+                zarr_results=self.zarr_results,
+                )
+
+        results = dict()
+        job_ids = dict()
+        if not any(r.is_container_running() for r in runners.values()):
+            cleared = queue.clear()
+            if cleared:
+                print(f'Removed {cleared} jobs left on {queue.queue_dir}')
+        try:
+            for runner in runners.values():
+                runner.start_worker(queue.queue_dir.resolve(), host_experiments_dir)
+
+            for basin_id in basin_ids:
+                job = dict(step='train_test', basin_id=basin_id, training_epochs=epochs)
+                job_ids[basin_id] = queue.submit(job)
+            print(f'Submitted {len(job_ids)} jobs to {len(runners)} workers')
+
+            while job_ids:
+                finished = 0
+                for basin_id, job_id in list(job_ids.items()):
+                    job_result = queue.result(job_id)
+                    if job_result is None:
+                        continue
+                    del job_ids[basin_id]
+                    finished += 1
+                    result = self._warm_result(basin_id, job_result, runners, host_experiments_dir)
+                    results[basin_id] = result
+                    print(f'Finished {basin_id}: {result.status} ({len(results)}/{len(basin_ids)})')
+                if not job_ids:
+                    break
+                if not finished and not any(r.is_container_running() for r in runners.values()):
+                    raise RuntimeError('No worker containers are running')
+                time.sleep(poll_interval)
+        finally:
+            cancelled = sum(queue.cancel(job_id) for job_id in job_ids.values())
+            if cancelled:
+                print(f'Cancelled {cancelled} pending jobs')
+            if keep_workers:
+                print(f'Leaving {len(runners)} workers running')
+            else:
+                for runner in runners.values():
+                    runner.stop_worker()
+
+        ordered = [results[basin_id] for basin_id in basin_ids]
+        self._write_manifest(ordered, manifest_path, epochs)
+        print(f'Wrote {manifest_path}')
+        return ordered
+
+    def print_summary(self, results: list[BasinResult]) -> None:
+        """Prints table of results."""
+        print()
+        print(f'{"basin":<10} {"status":<8} {"run_id":<18} {"minutes":>8}  log')
+        for r in results:
+            run_id = r.run_id or '-'
+            print(f'{r.basin_id:<10} {r.status:<8} {run_id:<18} {r.elapsed / 60.0:>8.1f}  {r.log_path}')
+        failed = [r for r in results if r.status != 'ok']
+        print(f'{len(results) - len(failed)} succeeded, {len(failed)} failed')
+        for r in failed:
+            print(f'  {r.basin_id}: {r.error}')
+
+    def _run_basin(self,
+            basin_id: str,
+            host_experiments_dir: pathlib.Path,
+            log_dir: pathlib.Path,
+            epochs: int|None) -> BasinResult:
+        """Runs train & test for one basin in its own container."""
+        log_path = log_dir / f'{basin_id}.log'
+        log_path.unlink(missing_ok=True)
+
+        # Container names must be unique on the host, including across sweeps
+        container_name = f'{CONTAINER_NAME}.{os.getpid()}.{basin_id}'
+        runner = DemoRun(
+            self.image_name,
+            self.data_dir,
+            engine=self.engine,
+            verbose=self.verbose,
+            container_name=container_name,
+            log_path=log_path,
+            bind_experiments=self.bind_experiments,
+            artifacts=self.artifacts,
+            cache_dir=self.cache_dir,
+            device=self.device,
+            cpus=self.cpus,
+            metrics_path=self.metrics_path,
+            zarr_results=self.zarr_results,
+            )
+
+        start = time.perf_counter()
+        try:
+            run_id = runner.execute(basin_id, host_experiments_dir, epochs=epochs)
+        except Exception as e:
+            elapsed = time.perf_counter() - start
+            return BasinResult(basin_id, 'failed', None, elapsed, log_path, error=str(e))
+
+        elapsed = time.perf_counter() - start
+        status = 'ok' if run_id is not None else 'failed'
+        error = '' if run_id is not None else 'no run_id'
+        return BasinResult(basin_id, status, run_id, elapsed, log_path, error=error)
+
+    def _warm_result(self,
+            basin_id: str,
+            job_result: dict,
+            runners: dict,
+            host_experiments_dir: pathlib.Path) -> BasinResult:
+        """Copies run directory from the worker that ran the job and returns BasinResult."""
+        worker = job_result.get('worker')
+        log_path = f'{self.engine} logs {worker}'
+        elapsed = job_result.get('elapsed', 0.0)
+        run_id = job_result.get('run_id')
+        if worker in runners:
+            # The worker writes its own phase records in its experiments directory
+            runners[worker].instrument.record(dict(phase='job', source='worker', basin_id=basin_id,
+                run_id=run_id, status=job_result.get('status'), wall_s=elapsed,
+                phases=job_result.get('phases')))
+        if job_result.get('status') != 'ok':
+            return BasinResult(basin_id, 'failed', None, elapsed, log_path,
+                error=job_result.get('error', ''))
+
+        try:
+            runners[worker].copy_run_directory(basin_id, run_id, host_experiments_dir,
+                epochs=job_result.get('epochs'))
+        except Exception as e:
+            return BasinResult(basin_id, 'failed', None, elapsed, log_path, error=str(e))
+        return BasinResult(basin_id, 'ok', run_id, elapsed, log_path)
+
+    def _write_manifest(self,
+            results: list[BasinResult],
+            manifest_path: pathlib.Path,
+            epochs: int|None) -> None:
+        """Writes batch manifest with run id for each basin."""
+        runs = dict()
+        for r in results:
+            run_dir = None if r.run_id is None else f'{r.basin_id}/runs/{r.run_id}'
+            runs[r.basin_id] = dict(run_id=r.run_id, run_dir=run_dir)
+        manifest = dict(mode='per_basin', training_epochs=epochs, runs=runs)
+        with open(manifest_path, 'w') as fp:
+            json.dump(manifest, fp, indent=2)
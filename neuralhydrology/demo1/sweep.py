@@ -0,0 +1,407 @@
+"""
+This script runs a hyperparameter sweep over the settings in template.basin.yml.
+
+The sweep spec (yaml or json) lists the parameters to vary and how to search them:
+
+    method: random          # grid or random
+    trials: 16              # number of random trials (grid runs every combination)
+    epochs: 30              # maximum training epochs per trial
+    parameters:
+      hidden_size: [20, 64, 128]                 # list: each value (grid) or choice (random)
+      learning_rate: {log_uniform: [1e-4, 1e-2]} # random only: uniform, log_uniform, int_uniform
+      output_dropout: {uniform: [0.0, 0.5]}
+      batch_size: [128, 256]
+      seq_length: [180, 365]
+    pruning:
+      warmup_epochs: 6      # never prune before this epoch
+      min_trials: 3         # trials that must have reported an epoch before pruning at it
+
+Each trial trains one model for the selected basins (a regional model for a
+basin list) with the parameters overriding the template. Trials are jobs on a
+JobQueue, run by worker.py processes: --workers N starts N local workers, each
+restricted to its share of the cores (which device_profile.py sizes torch
+threads from). With --workers 0 the jobs are left for other workers, e.g. warm
+worker containers sharing the queue directory.
+
+Trials are pruned with the median rule: before each epoch, a trial's best
+validation NSE so far (validate_every epochs, see checkpoints.py) is compared
+with the other trials' best NSE up to the same epoch, and training stops if it
+is below their median. Trial reports are files in the sweep directory, so
+workers sharing the experiments directory prune against each other.
+
+Results are written to experiments_dir/sweeps/<name>/results.csv, best first.
+If the sweep is interrupted or fails, its pending trials are removed from the
+queue and the local workers are stopped. Jobs still left on the sweep's own
+queue (e.g. after the sweep was killed) are removed when it is rerun.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import pathlib
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from args_utils import ARGS_FILENAME, add_standard_arguments, validate_inputs
+from checkpoints import DEFAULT_KEEP_LAST, DEFAULT_METRIC, MINIMIZED_METRICS, CheckpointRetention
+from device_profile import available_cpus
+from job_queue import JobQueue
+
+SWEEPS_DIRNAME = 'sweeps'
+TRIALS_DIRNAME = 'trials'
+RESULTS_FILENAME = 'results.csv'
+SEARCH_METHODS = ['grid', 'random']
+DISTRIBUTIONS = ['uniform', 'log_uniform', 'int_uniform']
+DEFAULT_WARMUP_EPOCHS = 6
+DEFAULT_MIN_TRIALS = 3
+STOP_TIMEOUT = 30  # seconds to wait for terminated workers
+
+# Trial status values
+COMPLETED = 'completed'
+PRUNED = 'pruned'
+FAILED = 'failed'
+
+
+def read_spec(spec_path: pathlib.Path) -> dict:
+    """Reads sweep spec from yaml or json file."""
+    with open(spec_path) as fp:
+        if spec_path.suffix == '.json':
+            spec = json.load(fp)
+        else:
+            from ruamel.yaml import YAML
+            spec = YAML(typ='safe').load(fp)
+    method = spec.get('method', 'grid')
+    if method not in SEARCH_METHODS:
+        raise ValueError(f'Unrecognized sweep method {method} (must be one of {SEARCH_METHODS})')
+    if not spec.get('parameters'):
+        raise ValueError(f'No parameters in sweep spec {spec_path}')
+    for name, values in spec['parameters'].items():
+        if isinstance(values, dict):
+            if method == 'grid':
+                raise ValueError(f'Parameter {name}: grid sweeps need a list of values')
+            if len(values) != 1 or next(iter(values)) not in DISTRIBUTIONS:
+                raise ValueError(f'Parameter {name}: distribution must be one of {DISTRIBUTIONS}')
+        elif not isinstance(values, list) or not values:
+            raise ValueError(f'Parameter {name}: must be a list of values or a distribution')
+    return spec
+
+
+def expand_trials(spec: dict, seed: int|None = None) -> list[dict]:
+    """Returns list of parameter dictionaries, one per trial."""
+    parameters = spec['parameters']
+    if spec.get('method', 'grid') == 'grid':
+        names = list(parameters)
+        return [dict(zip(names, values)) for values in itertools.product(*parameters.values())]
+
+    rng = random.Random(seed)
+    trials = list()
+    for _ in range(int(spec.get('trials', 10))):
+        trials.append({name: sample(rng, values) for name, values in parameters.items()})
+    return trials
+
+
+def sample(rng: random.Random, values: list|dict):
+    """Returns one random value from a list or distribution."""
+    if isinstance(values, list):
+        return rng.choice(values)
+    (kind, (low, high)), = values.items()
+    if kind == 'uniform':
+        return rng.uniform(low, high)
+    if kind == 'log_uniform':
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    return rng.randint(int(low), int(high))
+
+
+def config_overrides(params: dict) -> dict:
+    """Returns nh config settings for trial parameters.
+
+    learning_rate may be a float or an epoch => rate dictionary, whose keys
+    are strings after passing through the json job queue.
+    """
+    overrides = dict(params)
+    learning_rate = overrides.get('learning_rate')
+    if isinstance(learning_rate, dict):
+        overrides['learning_rate'] = {int(epoch): float(rate) for epoch, rate in learning_rate.items()}
+    elif learning_rate is not None:
+        overrides['learning_rate'] = float(learning_rate)
+    return overrides
+
+
+class MedianPruner:
+    """Median-rule pruning of trials, from validation scores reported in a shared directory.
+    """
+    def __init__(self,
+            trials_dir: pathlib.Path,
+            trial_id: str,
+            metric: str = DEFAULT_METRIC,
+            warmup_epochs: int = DEFAULT_WARMUP_EPOCHS,
+            min_trials: int = DEFAULT_MIN_TRIALS):
+        self.trials_dir = trials_dir
+        self.trial_id = trial_id
+        self.metric = metric
+        self.warmup_epochs = warmup_epochs
+        self.min_trials = min_trials
+        self.trials_dir.mkdir(parents=True, exist_ok=True)
+
+    def report(self, scores: dict[int, float]) -> None:
+        """Writes this trial's epoch => validation score (atomically)."""
+        path = self.trials_dir / f'{self.trial_id}.json'
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        with open(tmp_path, 'w') as fp:
+            json.dump({str(epoch): score for epoch, score in sorted(scores.items())}, fp)
+        os.replace(tmp_path, path)
+
+    def should_prune(self, scores: dict[int, float]) -> bool:
+        """Checks if this trial's best score is worse than the median of the other trials' at its latest epoch."""
+        if not scores:
+            return False
+        epoch = max(scores)
+        if epoch < self.warmup_epochs:
+            return False
+        others = [best for best in (self._best_by(s, epoch) for s in self._other_scores()) if best is not None]
+        if len(others) < self.min_trials:
+            return False
+        median = statistics.median(others)
+        best = self._best_by(scores, epoch)
+        return best > median if self.metric in MINIMIZED_METRICS else best < median
+
+    def _best_by(self, scores: dict[int, float], epoch: int) -> float|None:
+        """Returns best score up to epoch, or None if the trial has not reached epoch."""
+        if not scores or max(scores) < epoch:
+            return None
+        values = [score for e, score in scores.items() if e <= epoch]
+        return min(values) if self.metric in MINIMIZED_METRICS else max(values)
+
+    def _other_scores(self) -> list[dict[int, float]]:
+        """Returns reported scores of the other trials."""
+        reports = list()
+        for path in self.trials_dir.glob('*.json'):
+            if path.stem == self.trial_id:
+                continue
+            try:
+                with open(path) as fp:
+                    reports.append({int(epoch): score for epoch, score in json.load(fp).items()})
+            except (OSError, ValueError):
+                continue  # being replaced
+        return reports
+
+
+def run_trial(nh, job: dict, experiments_dir: str|pathlib.Path) -> dict:
+    """Trains (and optionally tests) one trial with a BasinNH object, pruning it if it falls behind.
+
+    Returns result dictionary
+    """
+    from basin_nh import StopTraining
+
+    sweep_dir = pathlib.Path(experiments_dir) / job['sweep_dir']
+    trial_id = job['trial_id']
+    pruning = job.get('pruning') or dict()
+    pruner = MedianPruner(sweep_dir / TRIALS_DIRNAME, trial_id,
+        warmup_epochs=pruning.get('warmup_epochs', DEFAULT_WARMUP_EPOCHS),
+        min_trials=pruning.get('min_trials', DEFAULT_MIN_TRIALS))
+
+    pruned = dict()
+
+    def prune_hook(epoch: int, run_dir: pathlib.Path):
+        scores = CheckpointRetention(run_dir).validation_scores()
+        pruner.report(scores)
+        if pruner.should_prune(scores):
+            pruned['epoch'] = epoch
+            raise StopTraining(f'validation {pruner.metric} below the median of other trials', epoch)
+
+    basin_ids = job['basin_ids']
+    trial_dir = sweep_dir / trial_id
+    run_id = nh.run_trial(basin_ids, trial_dir, config_overrides(job['params']), epoch_hook=prune_hook)
+    if run_id is None:
+        raise RuntimeError('Training did not create a run directory')
+    run_dir = trial_dir / 'runs' / run_id
+    run_rel = str(run_dir.relative_to(experiments_dir))
+
+    retention = CheckpointRetention(run_dir)
+    scores = retention.validation_scores()
+    pruner.report(scores)
+    best_epoch = retention.best_epoch()
+    result = dict(
+        trial_id=trial_id,
+        trial_status=PRUNED if pruned else COMPLETED,
+        run_dir=run_rel,
+        best_epoch=best_epoch,
+        best_score=scores.get(best_epoch),
+        last_epoch=max(retention.weight_epochs(), default=None),
+    )
+    if job.get('test') and not pruned:
+        manifest = dict(runs={basin_id: dict(run_id=run_id, run_dir=run_rel) for basin_id in basin_ids})
+        results = nh.run_batch_testing(manifest, write_nc=False)
+        nses = [float(ds.attrs['NSE']) for ds in results.values() if ds is not None]
+        result['test_NSE'] = statistics.median(nses) if nses else None
+    return result
+
+
+def cpu_sets(workers: int) -> list[set[int]]:
+    """Returns the usable cores split into one set per worker."""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))[:available_cpus()]
+    else:
+        cpus = list(range(available_cpus()))
+    per_worker = max(1, len(cpus) // workers)
+    return [set(cpus[i * per_worker:(i + 1) * per_worker]) or set(cpus) for i in range(workers)]
+
+
+def start_workers(args: argparse.Namespace, queue_dir: pathlib.Path, log_dir: pathlib.Path) -> list:
+    """Starts local worker.py processes, each pinned to its share of the cores."""
+    worker_script = pathlib.Path(__file__).parent / 'worker.py'
+    processes = list()
+    for i, cpus in enumerate(cpu_sets(args.workers)):
+        command = [sys.executable, str(worker_script), '-q', str(queue_dir), '-d', args.data_dir,
+            '-e', args.experiments_dir, '-w', f'sweep.{i}', '--device', args.device,
+            '--keep_checkpoints', str(args.keep_checkpoints)]
+        if args.cache_dir:
+            command += ['-c', args.cache_dir]
+        log_fp = open(log_dir / f'worker.{i}.log', 'w')
+        preexec_fn = (lambda cpus=cpus: os.sched_setaffinity(0, cpus)) if hasattr(os, 'sched_setaffinity') else None
+        processes.append(subprocess.Popen(command, stdout=log_fp, stderr=subprocess.STDOUT, preexec_fn=preexec_fn))
+        print(f'Started worker sweep.{i} on {len(cpus)} cores, log {log_fp.name}')
+    return processes
+
+
+def stop_sweep(queue: JobQueue, job_ids: list[str], processes: list) -> None:
+    """Cancels pending trials and stops local workers, after an interrupt or error.
+
+    Shutdown jobs would queue behind the pending trials, so the local workers
+    are terminated instead, which also stops the trials they are running.
+    """
+    cancelled = sum(queue.cancel(job_id) for job_id in job_ids)
+    print(f'Cancelled {cancelled} pending trials')
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def write_results(results: list[dict], param_names: list[str], results_path: pathlib.Path) -> None:
+    """Writes results table as csv, best validation score first."""
+    columns = ['trial_id', 'status'] + param_names + \
+        ['best_epoch', 'best_score', 'last_epoch', 'test_NSE', 'elapsed', 'run_dir', 'error']
+    reverse = DEFAULT_METRIC not in MINIMIZED_METRICS
+    missing = -math.inf if reverse else math.inf
+    ordered = sorted(results, key=lambda r: missing if r.get('best_score') is None else r['best_score'],
+        reverse=reverse)
+    with open(results_path, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for r in ordered:
+            writer.writerow(dict(r, elapsed=round(r.get('elapsed', 0.0), 1), **r['params']))
+
+
+def print_results(results_path: pathlib.Path) -> None:
+    """Prints results table."""
+    with open(results_path, newline='') as fp:
+        rows = list(csv.reader(fp))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(text.ljust(width) for text, width in zip(row, widths)).rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        epilog=f'Note: You can also put arguments in {ARGS_FILENAME} file',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        fromfile_prefix_chars='@')
+    add_standard_arguments(parser, with_batch=True)
+    parser.add_argument('-p', '--spec', required=True, help='Sweep spec file (.yml or .json)')
+    parser.add_argument('--name', help='Sweep name [spec file name]')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+        help='Local worker processes; 0 leaves the jobs to other workers sharing the queue [1]')
+    parser.add_argument('-q', '--queue_dir', help='Job queue directory [experiments_dir/sweeps/<name>/.queue]')
+    parser.add_argument('--seed', type=int, help='Random seed for random sweeps')
+    parser.add_argument('--test', action='store_true', help='Also test trials that are not pruned')
+    parser.add_argument('--keep_checkpoints', type=int, default=DEFAULT_KEEP_LAST,
+        help=f'Number of most recent epochs to keep weights for, besides the best [{DEFAULT_KEEP_LAST}]')
+    parser.add_argument('--poll_interval', type=float, default=2.0, help='Seconds between result checks [2.0]')
+    args = parser.parse_args()
+
+    try:
+        validate_inputs(args)
+        spec_path = pathlib.Path(args.spec)
+        spec = read_spec(spec_path)
+    except Exception as e:
+        print(f'Error: {e}')
+        print('Exiting')
+        sys.exit(2)
+
+    trials = expand_trials(spec, seed=args.seed)
+    epochs = int(spec.get('epochs', args.training_epochs))
+    print(f'Sweep has {len(trials)} trials of up to {epochs} epochs')
+    if args.dry_run:
+        for params in trials:
+            print(f'  {params}')
+        print('Exiting (dry_run option specified)')
+        sys.exit(0)
+
+    name = args.name or spec_path.stem
+    sweep_rel = pathlib.Path(SWEEPS_DIRNAME) / name
+    sweep_dir = pathlib.Path(args.experiments_dir) / sweep_rel
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    queue = JobQueue(args.queue_dir or sweep_dir / '.queue')
+    if not args.queue_dir:
+        # Only this sweep uses its own queue, so jobs on it are from an interrupted run
+        cleared = queue.clear()
+        if cleared:
+            print(f'Removed {cleared} jobs left on {queue.queue_dir}')
+
+    job_ids = dict()
+    trial_params = dict()
+    for i, params in enumerate(trials):
+        trial_id = f'trial_{i:03d}'
+        trial_params[trial_id] = params
+        job = dict(step='trial', trial_id=trial_id, params=params, basin_ids=args.basin_ids,
+            sweep_dir=str(sweep_rel), training_epochs=epochs, pruning=spec.get('pruning'), test=args.test)
+        job_ids[trial_id] = queue.submit(job)
+    print(f'Submitted {len(job_ids)} trials to {queue.queue_dir}')
+
+    processes = start_workers(args, queue.queue_dir, sweep_dir) if args.workers > 0 else list()
+    results = list()
+    try:
+        while job_ids:
+            for trial_id, job_id in list(job_ids.items()):
+                job_result = queue.result(job_id)
+                if job_result is None:
+                    continue
+                del job_ids[trial_id]
+                result = dict(job_result, trial_id=trial_id, params=trial_params[trial_id])
+                result['status'] = job_result.get('trial_status') if job_result.get('status') == 'ok' else FAILED
+                results.append(result)
+                print(f'Finished {trial_id}: {result["status"]}, best {DEFAULT_METRIC} {result.get("best_score")}'
+                    f' ({len(results)}/{len(trials)})')
+            if processes and all(p.poll() is not None for p in processes):
+                raise RuntimeError('All worker processes exited')
+            if job_ids:
+                time.sleep(args.poll_interval)
+    finally:
+        if job_ids:
+            stop_sweep(queue, list(job_ids.values()), processes)
+        else:
+            for _ in processes:
+                queue.submit(dict(step='shutdown'))
+            for process in processes:
+                process.wait()
+
+    results_path = sweep_dir / RESULTS_FILENAME
+    write_results(results, list(spec['parameters']), results_path)
+    print(f'Wrote {results_path}')
+    print_results(results_path)
+
+
+if __name__ == '__main__':
+    main()
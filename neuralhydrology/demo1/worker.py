@@ -0,0 +1,142 @@
+"""
+This script runs a long-lived worker that trains and tests neuralhydrology models.
+
+The worker imports BasinNH (and torch) once, then runs jobs from a file-based
+JobQueue until it receives a shutdown job. Each job is a dictionary with:
+* step - one of train, test, train_test, trial, shutdown
+* basin_id - 8 digit id of one entry in CAMELS-US
+* run_id - run to test (test step only)
+* training_epochs - (optional) number of training epochs
+Trial jobs (submitted by sweep.py) have basin_ids, trial_id, params and sweep_dir instead.
+"""
+
+import argparse
+import pathlib
+import time
+import traceback
+
+from args_utils import DEFAULT_EPOCHS
+from checkpoints import DEFAULT_KEEP_LAST
+from instrument import METRICS_FILENAME, get_instrument
+from job_queue import JobQueue
+
+WORKER_STEPS = ['train', 'test', 'train_test', 'trial', 'shutdown']
+
+
+def run_job(nh_class, job: dict, args: argparse.Namespace) -> dict:
+    """Runs one job.
+
+    Returns result dictionary
+    """
+    step = job.get('step')
+    if step not in WORKER_STEPS:
+        raise ValueError(f'Unrecognized job step {step}')
+
+    basin_ids = job.get('basin_ids') or [job['basin_id']]
+    job_args = argparse.Namespace(
+        data_dir=args.data_dir,
+        experiments_dir=args.experiments_dir,
+        cache_dir=args.cache_dir,
+        basin_id=basin_ids[0],
+        basin_ids=basin_ids,
+        run_id=job.get('run_id'),
+        training_epochs=job.get('training_epochs') or DEFAULT_EPOCHS,
+        zarr_results=args.zarr_results,
+        device=args.device,
+        keep_checkpoints=args.keep_checkpoints,
+        dry_run=False,
+        verbose=args.verbose,
+    )
+    nh = nh_class(job_args)
+    if step == 'trial':
+        from sweep import run_trial
+        return dict(run_trial(nh, job, args.experiments_dir), worker=args.worker_name)
+
+    result = dict(worker=args.worker_name, basin_id=job_args.basin_id, run_id=job_args.run_id)
+    if step in ['train', 'train_test']:
+        result['run_id'] = job_args.run_id = nh.run_training()
+        if result['run_id'] is None:
+            raise RuntimeError('Training did not create a run directory')
+        result['epochs'] = job_args.training_epochs
+    if step in ['test', 'train_test']:
+        ds = nh.run_testing()
+        nse = None if ds is None else ds.attrs.get('NSE')
+        result['NSE'] = None if nse is None else float(nse)
+        result['epoch'] = None if ds is None else int(ds.attrs['epoch'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-q', '--queue_dir', required=True, help='Job queue directory')
+    parser.add_argument('-d', '--data_dir', required=True, help='Path to CAMELS-US dataset')
+    parser.add_argument('-e', '--experiments_dir', required=True,
+        help='Directory for saving results')
+    parser.add_argument('-c', '--cache_dir',
+        help='Columnar store built by camels_store.py [data_dir/nh_store, if present]')
+    parser.add_argument('-w', '--worker_name', default='worker',
+        help='Name reported in job results (the container name)')
+    parser.add_argument('-p', '--poll_interval', type=float, default=1.0,
+        help='Seconds between checks for new jobs [1.0]')
+    parser.add_argument('--device', default='auto',
+        help='Training device: auto, cpu, cuda:N or mps [auto]')
+    parser.add_argument('--keep_checkpoints', type=int, default=DEFAULT_KEEP_LAST,
+        help=f'Number of most recent epochs to keep weights for, besides the best [{DEFAULT_KEEP_LAST}]')
+    parser.add_argument('-z', '--zarr_results', action='store_true',
+        help='Also write test results to experiments_dir/results.zarr')
+    parser.add_argument('--metrics_file',
+        help=f'File to append timing and resource records to [experiments_dir/{METRICS_FILENAME}]')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='Print more info to stdout')
+    args = parser.parse_args()
+
+    instrument = get_instrument()
+    instrument.configure(path=args.metrics_file or pathlib.Path(args.experiments_dir) / METRICS_FILENAME,
+        worker=args.worker_name)
+
+    # Import once, which is the point of keeping the worker running
+    print('Importing BasinNH')
+    with instrument.phase('import'):
+        from basin_nh import BasinNH
+
+    queue = JobQueue(args.queue_dir)
+    print(f'Worker {args.worker_name} waiting for jobs in {args.queue_dir}')
+    while True:
+        job = queue.claim()
+        if job is None:
+            time.sleep(args.poll_interval)
+            continue
+
+        job_id = job['job_id']
+        if job.get('step') == 'shutdown':
+            queue.complete(job_id, None)
+            print(f'Worker {args.worker_name} shutting down')
+            break
+
+        print(f'Running job {job_id}: {job}', flush=True)
+        instrument.configure(job_id=job_id, step=job.get('step'), basin_id=job.get('basin_id'),
+            run_id=job.get('run_id'), trial_id=job.get('trial_id'))
+        # Keep only this job's records in memory
+        instrument.records.clear()
+        start = time.perf_counter()
+        try:
+            with instrument.phase('job'):
+                result = run_job(BasinNH, job, args)
+            result['status'] = 'ok'
+        except Exception as e:
+            traceback.print_exc()
+            result = dict(status='error', error=str(e), worker=args.worker_name,
+                basin_id=job.get('basin_id'), run_id=job.get('run_id'))
+        result['elapsed'] = time.perf_counter() - start
+        # Wall time by phase, e.g. to see whether a slow job is data load or training
+        phases = dict()
+        for record in instrument.records:
+            phases[record['phase']] = round(phases.get(record['phase'], 0.0) + record['wall_s'], 3)
+        result['phases'] = phases
+        queue.complete(job_id, result)
+        print(f'Finished job {job_id}: {result}', flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""
+Exports a trained nh cudalstm run for inference without neuralhydrology.
+
+Reads the weights, config and feature scalers from a run directory and writes
+an artifact folder with:
+* model.npz - weights, scalers and metadata (feature names, seq_length,
+  hidden size), read by nh_runtime.py with numpy only
+* model.ts - the same network as a TorchScript module, with the scalers and
+  metadata embedded, for runtimes with torch (but not neuralhydrology)
+
+Only single-frequency cudalstm models with a regression head and no static
+inputs (as in demo1/template.basin.yml) are supported.
+"""
+
+import argparse
+import json
+import pathlib
+import re
+import sys
+
+import numpy as np
+import torch
+import yaml
+
+from introspect import cudalstm_dimensions, load_state_dict
+
+ARTIFACT_DIRNAME = 'export'
+NPZ_FILENAME = 'model.npz'
+TORCHSCRIPT_FILENAME = 'model.ts'
+METADATA_FILENAME = 'metadata.json'
+FORMAT_VERSION = 1
+
+# Run directory files
+CHECKPOINTS_FILENAME = 'checkpoints.json'
+SCALER_PATH = 'train_data/train_data_scaler.yml'
+WEIGHTS_PATTERN = re.compile(r'model_epoch(\d+)\.pt$')
+
+OUTPUT_ACTIVATIONS = ['linear', 'relu', 'softplus']
+
+
+class ExportedLSTM(torch.nn.Module):
+    """Standalone cudalstm network, for TorchScript export.
+
+    forward() takes normalized inputs [batch, seq, features] and returns
+    normalized predictions for the last time step [batch, targets]. The
+    scalers are stored as buffers, so the module file is self-contained.
+    """
+    def __init__(self, input_size: int, hidden_size: int, output_size: int, output_activation: str):
+        super().__init__()
+        self.lstm = torch.nn.LSTM(input_size, hidden_size, batch_first=True)
+        self.head = torch.nn.Linear(hidden_size, output_size)
+        self.output_activation = output_activation
+        self.register_buffer('input_center', torch.zeros(input_size))
+        self.register_buffer('input_scale', torch.ones(input_size))
+        self.register_buffer('target_center', torch.zeros(output_size))
+        self.register_buffer('target_scale', torch.ones(output_size))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        output, _ = self.lstm(x)
+        y = self.head(output[:, -1, :])
+        if self.output_activation == 'relu':
+            y = torch.relu(y)
+        elif self.output_activation == 'softplus':
+            y = torch.nn.functional.softplus(y)
+        return y
+
+
+def read_yaml(path: pathlib.Path) -> dict:
+    with open(path) as fp:
+        return yaml.safe_load(fp)
+
+def select_epoch(run_dir: pathlib.Path) -> int:
+    """Returns the best epoch from checkpoints.json, otherwise the last saved epoch."""
+    path = run_dir / CHECKPOINTS_FILENAME
+    if path.exists():
+        with open(path) as fp:
+            best_epoch = json.load(fp).get('best_epoch')
+        if best_epoch is not None:
+            return best_epoch
+    epochs = [int(m.group(1)) for m in (WEIGHTS_PATTERN.match(p.name) for p in run_dir.iterdir()) if m]
+    if not epochs:
+        raise FileNotFoundError(f'No model weights in {run_dir}')
+    return max(epochs)
+
+def check_config(config: dict) -> None:
+    """Raises ValueError for model settings the export does not support."""
+    if config.get('model') != 'cudalstm':
+        raise ValueError(f'Only cudalstm models are supported, not {config.get("model")}')
+    if config.get('head') != 'regression':
+        raise ValueError(f'Only regression heads are supported, not {config.get("head")}')
+    if not isinstance(config.get('dynamic_inputs'), list) or isinstance(config['dynamic_inputs'][0], list):
+        raise ValueError('Only a single list of dynamic_inputs is supported')
+    for key in ['static_attributes', 'hydroatlas_attributes', 'evolving_attributes']:
+        if config.get(key):
+            raise ValueError(f'Static inputs ({key}) are not supported')
+    if config.get('use_basin_id_encoding'):
+        raise ValueError('Basin id encoding is not supported')
+    for key in ['statics_embedding', 'dynamics_embedding']:
+        if config.get(key):
+            raise ValueError(f'Embedding layers ({key}) are not supported')
+    if config.get('output_activation', 'linear') not in OUTPUT_ACTIVATIONS:
+        raise ValueError(f'Unsupported output activation {config.get("output_activation")}')
+
+def scaler_values(scaler: dict, kind: str, features: list[str]) -> np.ndarray:
+    """Returns scaler values ('center' or 'scale') for the features, from the nh scaler yml."""
+    data_vars = scaler[f'xarray_feature_{kind}']['data_vars']
+    missing = [f for f in features if f not in data_vars]
+    if missing:
+        raise ValueError(f'Scaler has no {kind} for {missing}')
+    return np.array([data_vars[f]['data'] for f in features], dtype=np.float32)
+
+def export_run(run_dir: str|pathlib.Path,
+        epoch: int|None = None,
+        output_dir: str|pathlib.Path|None = None,
+        torchscript: bool = True) -> pathlib.Path:
+    """Writes the export artifact for a run directory.
+
+    Returns path to artifact folder
+    """
+    run_dir = pathlib.Path(run_dir)
+    config = read_yaml(run_dir / 'config.yml')
+    check_config(config)
+    epoch = select_epoch(run_dir) if epoch is None else epoch
+
+    state_dict = load_state_dict(run_dir / f'model_epoch{epoch:03d}.pt')
+    dims = cudalstm_dimensions(state_dict)
+    input_names = list(config['dynamic_inputs'])
+    target_names = list(config['target_variables'])
+    if dims['input_size'] != len(input_names) or dims['output_size'] != len(target_names):
+        raise ValueError(f'Weights {dims} do not match config inputs and targets')
+
+    scaler = read_yaml(run_dir / SCALER_PATH)
+    # nh uses a scale of 1 for constant features, so there is no division by zero
+    arrays = dict(
+        input_center=scaler_values(scaler, 'center', input_names),
+        input_scale=scaler_values(scaler, 'scale', input_names),
+        target_center=scaler_values(scaler, 'center', target_names),
+        target_scale=scaler_values(scaler, 'scale', target_names),
+    )
+    arrays.update({key.replace('.', '_'): value.numpy() for key, value in state_dict.items()})
+
+    clip_targets = config.get('clip_targets_to_zero') or list()
+    metadata = dict(
+        format_version=FORMAT_VERSION,
+        run=run_dir.name,
+        epoch=epoch,
+        model=config['model'],
+        input_names=input_names,
+        target_names=target_names,
+        seq_length=config['seq_length'],
+        hidden_size=dims['hidden_size'],
+        output_activation=config.get('output_activation', 'linear'),
+        clip_targets_to_zero=[t for t in target_names if t in clip_targets],
+        frequency='1D',
+    )
+
+    output_dir = pathlib.Path(output_dir) if output_dir else run_dir / ARTIFACT_DIRNAME
+    output_dir.mkdir(parents=True, exist_ok=True)
+    np.savez(output_dir / NPZ_FILENAME, metadata=np.array(json.dumps(metadata)), **arrays)
+    with open(output_dir / METADATA_FILENAME, 'w') as fp:
+        json.dump(metadata, fp, indent=2)
+
+    if torchscript:
+        module = ExportedLSTM(dims['input_size'], dims['hidden_size'], dims['output_size'],
+            metadata['output_activation'])
+        module.load_state_dict({
+            'lstm.weight_ih_l0': state_dict['lstm.weight_ih_l0'],
+            'lstm.weight_hh_l0': state_dict['lstm.weight_hh_l0'],
+            'lstm.bias_ih_l0': state_dict['lstm.bias_ih_l0'],
+            'lstm.bias_hh_l0': state_dict['lstm.bias_hh_l0'],
+            'head.weight': state_dict['head.net.0.weight'],
+            'head.bias': state_dict['head.net.0.bias'],
+            'input_center': torch.from_numpy(arrays['input_center']),
+            'input_scale': torch.from_numpy(arrays['input_scale']),
+            'target_center': torch.from_numpy(arrays['target_center']),
+            'target_scale': torch.from_numpy(arrays['target_scale']),
+        })
+        module.eval()
+        scripted = torch.jit.script(module)
+        torch.jit.save(scripted, str(output_dir / TORCHSCRIPT_FILENAME),
+            _extra_files={METADATA_FILENAME: json.dumps(metadata)})
+
+    return output_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('run_dir', help='nh run directory')
+    parser.add_argument('-e', '--epoch', type=int,
+        help='epoch to export (default is best epoch in checkpoints.json, else last epoch)')
+    parser.add_argument('-o', '--output_dir', help=f'artifact folder (default is <run_dir>/{ARTIFACT_DIRNAME})')
+    parser.add_argument('-n', '--no_torchscript', action='store_true', help='only write the numpy artifact')
+    args = parser.parse_args()
+
+    try:
+        output_dir = export_run(args.run_dir, epoch=args.epoch, output_dir=args.output_dir,
+            torchscript=not args.no_torchscript)
+    except (FileNotFoundError, ValueError) as e:
+        print(f'Error: {e}')
+        sys.exit(1)
+    print(f'Wrote {output_dir}')
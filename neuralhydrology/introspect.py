@@ -1,19 +1,67 @@
-""""""
+"""
+Prints the tensors in a pytorch model file (.pt), such as the model_epochNNN.pt
+weights nh saves in a run directory.
+
+The functions are also used by export_model.py to read cudalstm weights.
+"""
 
 import argparse
 
 import torch
 
+# State dict keys of a single-layer nh cudalstm with regression head
+CUDALSTM_KEYS = [
+    'lstm.weight_ih_l0',
+    'lstm.weight_hh_l0',
+    'lstm.bias_ih_l0',
+    'lstm.bias_hh_l0',
+    'head.net.0.weight',
+    'head.net.0.bias',
+]
+
+
+def load_state_dict(pt_file: str) -> dict[str, torch.Tensor]:
+    """Returns the state dict in a model file, on the cpu."""
+    return torch.load(pt_file, map_location='cpu', weights_only=True)
+
+def describe_state_dict(state_dict: dict[str, torch.Tensor]) -> list[tuple[str, list[int]]]:
+    """Returns (key, shape) for each tensor in the state dict."""
+    return [(key, list(value.shape)) for key, value in state_dict.items()]
+
+def cudalstm_dimensions(state_dict: dict[str, torch.Tensor]) -> dict[str, int]:
+    """Returns input_size, hidden_size and output_size of a cudalstm state dict.
+
+    Raises ValueError if the state dict has other tensors, e.g. embedding
+    layers or more than one lstm layer.
+    """
+    keys = list(state_dict)
+    if sorted(keys) != sorted(CUDALSTM_KEYS):
+        extra = sorted(set(keys) - set(CUDALSTM_KEYS))
+        missing = sorted(set(CUDALSTM_KEYS) - set(keys))
+        raise ValueError(f'Not a single-layer cudalstm state dict (extra: {extra}, missing: {missing})')
+
+    gates, input_size = state_dict['lstm.weight_ih_l0'].shape
+    hidden_size = state_dict['lstm.weight_hh_l0'].shape[1]
+    if gates != 4 * hidden_size:
+        raise ValueError(f'Unexpected lstm weight shape {list(state_dict["lstm.weight_ih_l0"].shape)}')
+    output_size = state_dict['head.net.0.weight'].shape[0]
+    return dict(input_size=input_size, hidden_size=hidden_size, output_size=output_size)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Introspect pytorch model')
     parser.add_argument('pt_file', help='Pytorch model file (.pt)')
     args = parser.parse_args()
 
-    model = torch.load(args.pt_file, weights_only=True)
-    print(type(model))
-    # print(model)
+    state_dict = load_state_dict(args.pt_file)
+    print(type(state_dict))
     print()
 
-    for key, value in model.items():
-        print(key, value.shape)
+    for key, shape in describe_state_dict(state_dict):
+        print(key, shape)
     print()
+
+    try:
+        print(cudalstm_dimensions(state_dict))
+    except ValueError as e:
+        print(e)
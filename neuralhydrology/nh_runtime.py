@@ -0,0 +1,343 @@
+"""
+Minimal runtime for models exported with export_model.py.
+
+Loads the artifact folder, normalizes raw daily inputs with the training
+scalers and slices them into seq_length windows in numpy, runs the network,
+and returns predictions in data units. Predictions at time t use the inputs
+from t - seq_length + 1 to t, as nh does with predict_last_n = 1, so the first
+seq_length - 1 time steps (and windows with missing inputs) are NaN.
+
+Two engines run the network:
+* numpy - a vectorized numpy LSTM, which only needs numpy and starts in
+  milliseconds
+* torchscript - the exported TorchScript module, which needs torch
+
+The numpy engine also has a stateful mode, which runs each series once from
+the start and carries the LSTM state forward, instead of rerunning
+seq_length steps for every prediction. Its first seq_length - 1 steps are
+still NaN, as warmup. After warmup, stateful predictions differ from the
+windowed ones because the state also reflects inputs older than
+seq_length. Use --verify to compare the engines and modes on an input file.
+
+Input csv files have one column per model input (in any order), plus an
+optional date column that is copied to the output.
+"""
+
+import argparse
+import csv
+import json
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+NPZ_FILENAME = 'model.npz'
+TORCHSCRIPT_FILENAME = 'model.ts'
+DATE_COLUMN = 'date'
+DEFAULT_BATCH_SIZE = 1024
+
+ENGINES = ['numpy', 'torchscript']
+
+# Largest difference (normalized target units) accepted by --verify between engines
+VERIFY_TOLERANCE = 1e-4
+
+
+class ModelArtifact:
+    """Weights, scalers and metadata from an export artifact (model.npz).
+    """
+    def __init__(self, artifact_dir: str|pathlib.Path):
+        self.artifact_dir = pathlib.Path(artifact_dir)
+        with np.load(self.artifact_dir / NPZ_FILENAME, allow_pickle=False) as npz:
+            self.arrays = {key: npz[key] for key in npz.files if key != 'metadata'}
+            self.metadata = json.loads(str(npz['metadata']))
+
+        self.input_names = self.metadata['input_names']
+        self.target_names = self.metadata['target_names']
+        self.seq_length = self.metadata['seq_length']
+        self.hidden_size = self.metadata['hidden_size']
+        self.clip_mask = np.array([t in self.metadata['clip_targets_to_zero'] for t in self.target_names])
+
+    def normalize_inputs(self, x: np.ndarray) -> np.ndarray:
+        """Returns inputs [..., features] scaled with the training center and scale."""
+        return ((x - self.arrays['input_center']) / self.arrays['input_scale']).astype(np.float32)
+
+    def denormalize_targets(self, y: np.ndarray) -> np.ndarray:
+        """Returns normalized predictions [..., targets] in data units, clipped as in nh evaluation."""
+        y = y * self.arrays['target_scale'] + self.arrays['target_center']
+        if self.clip_mask.any():
+            y[..., self.clip_mask] = np.maximum(y[..., self.clip_mask], 0.0)
+        return y
+
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    # tanh form does not overflow for large negative x
+    return 0.5 * (1.0 + np.tanh(0.5 * x))
+
+
+class NumpyEngine:
+    """Runs the exported cudalstm weights with numpy.
+
+    All arrays are float32 and batched over the first dimension, so one
+    call processes many basins (or windows) per time step.
+    """
+    def __init__(self, artifact: ModelArtifact):
+        arrays = artifact.arrays
+        # Transposed for x @ w, with the two lstm biases combined
+        self.w_ih = np.ascontiguousarray(arrays['lstm_weight_ih_l0'].T)
+        self.w_hh = np.ascontiguousarray(arrays['lstm_weight_hh_l0'].T)
+        self.bias = arrays['lstm_bias_ih_l0'] + arrays['lstm_bias_hh_l0']
+        self.w_head = np.ascontiguousarray(arrays['head_net_0_weight'].T)
+        self.b_head = arrays['head_net_0_bias']
+        self.hidden_size = artifact.hidden_size
+        self.output_activation = artifact.metadata['output_activation']
+
+    def step(self, x_t: np.ndarray, h: np.ndarray, c: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Advances state (h, c) [batch, hidden] by one time step of inputs x_t [batch, features].
+
+        Returns new (h, c)
+        """
+        gates = x_t @ self.w_ih + h @ self.w_hh + self.bias
+        # torch gate order: input, forget, cell, output
+        i, f, g, o = np.split(gates, 4, axis=-1)
+        c = sigmoid(f) * c + sigmoid(i) * np.tanh(g)
+        h = sigmoid(o) * np.tanh(c)
+        return h, c
+
+    def head(self, h: np.ndarray) -> np.ndarray:
+        """Returns normalized predictions [..., targets] for hidden state h [..., hidden]."""
+        y = h @ self.w_head + self.b_head
+        if self.output_activation == 'relu':
+            y = np.maximum(y, 0.0)
+        elif self.output_activation == 'softplus':
+            y = np.logaddexp(y, 0.0)
+        return y
+
+    def zero_state(self, batch_size: int) -> tuple[np.ndarray, np.ndarray]:
+        h = np.zeros((batch_size, self.hidden_size), dtype=np.float32)
+        return h, h.copy()
+
+    def run(self, windows: np.ndarray) -> np.ndarray:
+        """Returns normalized predictions [batch, targets] for windows [batch, seq, features]."""
+        h, c = self.zero_state(windows.shape[0])
+        for t in range(windows.shape[1]):
+            h, c = self.step(windows[:, t], h, c)
+        return self.head(h)
+
+    def simulate(self, x: np.ndarray, seq_length: int) -> np.ndarray:
+        """Returns normalized predictions [batch, time, targets] for inputs [batch, time, features].
+
+        Runs each series once, carrying the state forward. A missing input
+        resets that series' state, and predictions are NaN until seq_length
+        consecutive steps have inputs, so NaN positions match the windowed
+        predictions.
+        """
+        batch_size, n_steps = x.shape[:2]
+        missing = np.isnan(x).any(axis=-1)
+        x = np.where(missing[..., None], 0.0, x).astype(np.float32)
+        h, c = self.zero_state(batch_size)
+        run_length = np.zeros(batch_size, dtype=np.int64)
+        y = np.full((batch_size, n_steps, self.b_head.shape[0]), np.nan, dtype=np.float32)
+        for t in range(n_steps):
+            h, c = self.step(x[:, t], h, c)
+            reset = missing[:, t]
+            h[reset] = 0.0
+            c[reset] = 0.0
+            run_length = np.where(reset, 0, run_length + 1)
+            ready = run_length >= seq_length
+            if ready.any():
+                y[ready, t] = self.head(h[ready])
+        return y
+
+
+class TorchScriptEngine:
+    """Runs the exported TorchScript module on normalized windows.
+    """
+    def __init__(self, artifact: ModelArtifact, threads: int|None = None):
+        import torch
+        self._torch = torch
+        if threads:
+            torch.set_num_threads(threads)
+        self.module = torch.jit.load(str(artifact.artifact_dir / TORCHSCRIPT_FILENAME), map_location='cpu')
+        self.module.eval()
+
+    def run(self, windows: np.ndarray) -> np.ndarray:
+        """Returns normalized predictions [batch, targets] for windows [batch, seq, features]."""
+        with self._torch.no_grad():
+            x = self._torch.from_numpy(np.ascontiguousarray(windows))
+            return self.module(x).numpy()
+
+
+class Runtime:
+    """Predicts targets from raw input time series with an exported model.
+    """
+    def __init__(self,
+            artifact_dir: str|pathlib.Path,
+            engine: str = 'numpy',
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            threads: int|None = None):
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown engine {engine}, use one of {ENGINES}')
+        self.artifact = ModelArtifact(artifact_dir)
+        self.batch_size = batch_size
+        if engine == 'numpy':
+            self.engine = NumpyEngine(self.artifact)
+        else:
+            self.engine = TorchScriptEngine(self.artifact, threads=threads)
+
+    @property
+    def input_names(self) -> list[str]:
+        return self.artifact.input_names
+
+    @property
+    def target_names(self) -> list[str]:
+        return self.artifact.target_names
+
+    def predict(self, x: np.ndarray, stateful: bool = False) -> np.ndarray:
+        """Returns predictions [..., time, targets] for raw inputs [..., time, features].
+
+        Leading dimensions (e.g. basins) are predicted independently, and
+        windows of all series share batches. Input features must be in the
+        order of input_names. Set stateful for the numpy engine's stateful mode.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        if x.shape[-1] != len(self.input_names):
+            raise ValueError(f'Expected {len(self.input_names)} input features, got {x.shape[-1]}')
+        series = self.artifact.normalize_inputs(x.reshape(-1, *x.shape[-2:]))
+        if stateful:
+            if not isinstance(self.engine, NumpyEngine):
+                raise ValueError('Stateful mode needs the numpy engine')
+            y = self.engine.simulate(series, self.artifact.seq_length)
+        else:
+            y = self._predict_windows(series)
+        return self.artifact.denormalize_targets(y).reshape(*x.shape[:-1], len(self.target_names))
+
+    def predict_columns(self, columns: dict[str, np.ndarray], stateful: bool = False) -> dict[str, np.ndarray]:
+        """Returns target name => predictions, for input name => time series."""
+        missing = [name for name in self.input_names if name not in columns]
+        if missing:
+            raise ValueError(f'Missing model inputs {missing}')
+        x = np.stack([np.asarray(columns[name], dtype=np.float32) for name in self.input_names], axis=-1)
+        y = self.predict(x, stateful=stateful)
+        return {name: y[..., i] for i, name in enumerate(self.target_names)}
+
+    def _predict_windows(self, x: np.ndarray) -> np.ndarray:
+        """Returns normalized predictions [series, time, targets] for normalized inputs [series, time, features]."""
+        seq_length = self.artifact.seq_length
+        n_series, n_steps = x.shape[:2]
+        y = np.full((n_series, n_steps, len(self.target_names)), np.nan, dtype=np.float32)
+        if n_steps < seq_length:
+            return y
+
+        # [series, window, seq, features] view; batches are gathered from it
+        windows = np.lib.stride_tricks.sliding_window_view(x, seq_length, axis=1).transpose(0, 1, 3, 2)
+        # nh drops samples with missing inputs anywhere in the window
+        missing = np.isnan(x).any(axis=-1).astype(np.int64)
+        window_missing = np.lib.stride_tricks.sliding_window_view(missing, seq_length, axis=1).sum(axis=-1)
+        series_idx, window_idx = np.nonzero(window_missing == 0)
+        for start in range(0, len(series_idx), self.batch_size):
+            s_idx = series_idx[start:start + self.batch_size]
+            w_idx = window_idx[start:start + self.batch_size]
+            y[s_idx, w_idx + seq_length - 1] = self.engine.run(windows[s_idx, w_idx])
+        return y
+
+
+def verify(artifact_dir: str|pathlib.Path, x: np.ndarray, batch_size: int = DEFAULT_BATCH_SIZE) -> bool:
+    """Compares the numpy and torchscript engines (and stateful mode) on raw inputs [..., time, features].
+
+    Prints differences and returns True if the engines agree within VERIFY_TOLERANCE.
+    """
+    numpy_runtime = Runtime(artifact_dir, engine='numpy', batch_size=batch_size)
+    torch_runtime = Runtime(artifact_dir, engine='torchscript', batch_size=batch_size)
+    series = numpy_runtime.artifact.normalize_inputs(x.reshape(-1, *x.shape[-2:]))
+
+    results = dict()
+    for name, func in [
+            ('torchscript', lambda: torch_runtime._predict_windows(series)),
+            ('numpy', lambda: numpy_runtime._predict_windows(series)),
+            ('stateful', lambda: numpy_runtime.engine.simulate(series, numpy_runtime.artifact.seq_length))]:
+        start = time.perf_counter()
+        results[name] = func()
+        print(f'{name:<12} {time.perf_counter() - start:8.3f} s')
+
+    reference = results['torchscript']
+    for name in ['numpy', 'stateful']:
+        if not np.array_equal(np.isnan(reference), np.isnan(results[name])):
+            print(f'{name}: missing predictions differ from torchscript')
+            return False
+        diff = np.nanmax(np.abs(results[name] - reference), initial=0.0)
+        print(f'{name:<12} max abs difference from torchscript (normalized units): {diff:.3g}')
+    diff = np.nanmax(np.abs(results['numpy'] - reference), initial=0.0)
+    return bool(diff <= VERIFY_TOLERANCE)
+
+
+def read_csv(path: str) -> tuple[list[str]|None, dict[str, np.ndarray]]:
+    """Returns (dates or None, column name => values) from a csv file."""
+    with open(path, newline='') as fp:
+        reader = csv.reader(fp)
+        header = next(reader)
+        rows = list(reader)
+    columns = dict()
+    dates = None
+    for i, name in enumerate(header):
+        values = [row[i] for row in rows]
+        if name == DATE_COLUMN:
+            dates = values
+        else:
+            columns[name] = np.array([float(v) if v else np.nan for v in values], dtype=np.float32)
+    return dates, columns
+
+def write_csv(fp, dates: list[str]|None, columns: dict[str, np.ndarray]) -> None:
+    """Writes columns (and dates, if not None) to an open text file."""
+    writer = csv.writer(fp)
+    names = list(columns)
+    writer.writerow(([DATE_COLUMN] if dates is not None else []) + names)
+    for i in range(len(next(iter(columns.values())))):
+        row = [f'{columns[name][i]:.6g}' for name in names]
+        writer.writerow(([dates[i]] if dates is not None else []) + row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('artifact_dir', help='folder written by export_model.py')
+    parser.add_argument('input_csv', help='csv file with one column per model input')
+    parser.add_argument('-o', '--output', help='csv file for predictions (default is stdout)')
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='numpy', help='inference engine [numpy]')
+    parser.add_argument('-s', '--stateful', action='store_true',
+        help='carry lstm state through each series instead of rerunning windows (numpy engine)')
+    parser.add_argument('--verify', action='store_true',
+        help='compare numpy and torchscript engines on the inputs, instead of writing predictions')
+    parser.add_argument('-b', '--batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+        help=f'windows per forward pass [{DEFAULT_BATCH_SIZE}]')
+    parser.add_argument('-t', '--threads', type=int, help='torch threads (default is torch default)')
+    args = parser.parse_args()
+
+    if args.verify:
+        _dates, columns = read_csv(args.input_csv)
+        names = ModelArtifact(args.artifact_dir).input_names
+        x = np.stack([columns[name] for name in names], axis=-1)
+        ok = verify(args.artifact_dir, x, batch_size=args.batch_size)
+        print('OK' if ok else f'FAILED (tolerance {VERIFY_TOLERANCE})')
+        sys.exit(0 if ok else 1)
+
+    start = time.perf_counter()
+    runtime = Runtime(args.artifact_dir, engine=args.engine, batch_size=args.batch_size, threads=args.threads)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    dates, columns = read_csv(args.input_csv)
+    try:
+        start = time.perf_counter()
+        predictions = runtime.predict_columns(columns, stateful=args.stateful)
+        predict_ms = (time.perf_counter() - start) * 1000
+    except ValueError as e:
+        print(f'Error: {e}')
+        sys.exit(1)
+
+    if args.output:
+        with open(args.output, 'w', newline='') as fp:
+            write_csv(fp, dates, predictions)
+    else:
+        write_csv(sys.stdout, dates, predictions)
+    steps = len(next(iter(columns.values())))
+    print(f'Loaded model in {load_ms:.1f} ms, predicted {steps} steps in {predict_ms:.1f} ms', file=sys.stderr)
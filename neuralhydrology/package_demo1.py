@@ -34,7 +34,9 @@ for filename in filenames:
 source_sub_dir = source_dir / 'demo1'
 app_sub_dir = app_dir / 'demo1'
 app_sub_dir.mkdir(parents=True, exist_ok=True)
-filenames = ['__init__.py', 'args_utils.py', 'constants.py', 'demo_run.py', 'template.basin.yml']
+filenames = ['__init__.py', 'args_utils.py', 'basin_catalog.py', 'camels_store.py', 'constants.py',
+    'demo_run.py', 'device_profile.py', 'instrument.py', 'job_queue.py', 'results_store.py',
+    'scheduler.py', 'template.basin.yml']
 for filename in filenames:
     from_path = source_sub_dir / filename
     shutil.copy2(from_path, app_sub_dir)
@@ -1,9 +1,10 @@
 """Plot model run results (observed & simulated)
 
-Requires matplotlib and xarray packages
+Requires matplotlib and xarray packages (and zarr, to read a results store)
 """
 
 import argparse
+import pathlib
 
 import matplotlib.pyplot as plt
 import xarray as xr
@@ -11,10 +12,20 @@ import xarray as xr
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Plot NueralHydrology results file. Requires xarray & matplotlib')
-    parser.add_argument('results_file', help='test_results.nc file for basin/model')
+    parser.add_argument('results_file',
+        help='test_results.nc file for basin/model, or results.zarr store')
+    parser.add_argument('-b', '--basin_id', help='Basin to plot from results.zarr store')
+    parser.add_argument('-r', '--run_id', help='Run to plot from results.zarr store [latest]')
     args = parser.parse_args()
 
-    ds = xr.open_dataset(args.results_file)
+    if pathlib.Path(args.results_file).suffix == '.zarr':
+        from demo1.results_store import ResultsStore
+        store = ResultsStore(args.results_file)
+        if args.basin_id is None:
+            parser.error(f'basin_id required for results store; basins are {" ".join(store.basin_ids())}')
+        ds = store.open(args.basin_id, args.run_id)
+    else:
+        ds = xr.open_dataset(args.results_file)
     print(ds)
 
     qobs = ds['QObs(mm/d)_obs']
@@ -0,0 +1,43 @@
+"""Checks that each nh run in one process logs to its own output.log
+
+Trains two basins of synthetic CAMELS-US data for one epoch each, in one
+process as batch training and the warm workers do.
+
+    python -m pytest neuralhydrology/tests
+"""
+
+import argparse
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'demo1'))
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'benchmarks'))
+from bench_pipeline import make_camels
+
+
+def test_each_run_logs_to_own_output_log(tmp_path):
+    from basin_nh import LOG_FILENAME, BasinNH
+
+    data_dir = tmp_path / 'camels'
+    exp_dir = tmp_path / 'experiments'
+    basin_ids = make_camels(data_dir, 2)
+    nh = BasinNH(argparse.Namespace(
+        data_dir=str(data_dir),
+        experiments_dir=str(exp_dir),
+        cache_dir=None,
+        basin_id=basin_ids[0],
+        basin_ids=basin_ids,
+        run_id=None,
+        training_epochs=1,
+        device='cpu',
+        keep_checkpoints=1,
+        verbose=False,
+    ))
+    manifest = nh.run_batch_training(basin_ids, manifest_path=exp_dir / 'manifest.json')
+
+    run_dirs = [exp_dir / manifest['runs'][basin_id]['run_dir'] for basin_id in basin_ids]
+    for run_dir, other_dir in [run_dirs, run_dirs[::-1]]:
+        log = (run_dir / LOG_FILENAME).read_text()
+        assert str(run_dir) in log
+        assert 'Epoch 1' in log
+        assert str(other_dir) not in log
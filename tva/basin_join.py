@@ -0,0 +1,158 @@
+"""Joins TVA dams to CAMELS basins, for dam-driven basin selection.
+
+Builds an STRtree spatial index (geopandas sindex) over the basins, either
+polygons (e.g. CAMELS basin_set_full_res/HCDN_nhru_final_671.shp) or gauge
+points (e.g. camels_topo.txt), and queries it with all dams at once. Each
+dam is paired with every basin within --max_km:
+  * relation 'inside': the dam lies in the basin polygon, so it is upstream
+    of the basin's gauge and regulates its flow
+  * relation 'near': the basin polygon or gauge is within max_km of the dam
+Without a flow network, 'inside' is the only upstream test.
+
+The pairs are written as a csv lookup table (dam, basin_id, relation,
+distance_km, rank), cached by the inputs and max_km, so selecting basins
+for a list of dams is a table lookup rather than a distance scan.
+"""
+
+import argparse
+import hashlib
+import pathlib
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+# CONUS Albers equal area, in meters
+PROJECTED_CRS = 'EPSG:5070'
+# CAMELS-US basin ids are 8 digits, but files often store them as integers
+BASIN_ID_WIDTH = 8
+DEFAULT_MAX_KM = 25.0
+DEFAULT_CACHE_DIR = 'cache'
+TABLE_COLUMNS = ['dam', 'basin_id', 'relation', 'distance_km', 'rank']
+
+
+def read_points(path: pathlib.Path, lat_column: str, lon_column: str) -> gpd.GeoDataFrame:
+    """Reads csv or txt table (comma or semicolon separated) as points in lat/lon."""
+    df = pd.read_csv(path, sep=None, engine='python', dtype=str)
+    df.columns = [c.strip() for c in df.columns]
+    geometry = gpd.points_from_xy(df[lon_column].astype(float), df[lat_column].astype(float))
+    return gpd.GeoDataFrame(df, geometry=geometry, crs='EPSG:4326')
+
+
+def read_features(path: pathlib.Path, lat_column: str, lon_column: str) -> gpd.GeoDataFrame:
+    """Reads vector file (geojson, shapefile, ...) or csv/txt points table."""
+    if path.suffix.lower() in ('.csv', '.txt'):
+        return read_points(path, lat_column, lon_column)
+    gdf = gpd.read_file(path)
+    if gdf.crs is None:
+        gdf = gdf.set_crs('EPSG:4326')
+    return gdf
+
+
+def load_dams(path: pathlib.Path, name_column: str = 'name') -> gpd.GeoDataFrame:
+    """Returns GeoDataFrame with dam and geometry columns, projected."""
+    gdf = read_features(path, 'latitude', 'longitude')
+    return gpd.GeoDataFrame(dict(dam=gdf[name_column].astype(str).values),
+        geometry=gdf.geometry.values, crs=gdf.crs).to_crs(PROJECTED_CRS)
+
+
+def load_basins(path: pathlib.Path, id_column: str, lat_column: str = 'gauge_lat',
+        lon_column: str = 'gauge_lon') -> gpd.GeoDataFrame:
+    """Returns GeoDataFrame with basin_id and geometry (polygons or gauges) columns, projected."""
+    gdf = read_features(path, lat_column, lon_column)
+    ids = gdf[id_column].astype(str).str.strip().str.split('.').str[0].str.zfill(BASIN_ID_WIDTH)
+    return gpd.GeoDataFrame(dict(basin_id=ids.values),
+        geometry=gdf.geometry.values, crs=gdf.crs).to_crs(PROJECTED_CRS)
+
+
+def join(dams: gpd.GeoDataFrame, basins: gpd.GeoDataFrame, max_km: float = DEFAULT_MAX_KM) -> pd.DataFrame:
+    """Returns lookup table of (dam, basin) pairs within max_km, nearest first for each dam."""
+    # One bulk query of the basins' STRtree; returns [2, n_pairs] indices
+    dam_index, basin_index = basins.sindex.query(dams.geometry, predicate='dwithin', distance=max_km * 1000.0)
+    dam_geometry = dams.geometry.values[dam_index]
+    basin_geometry = basins.geometry.values[basin_index]
+    distance_km = dam_geometry.distance(basin_geometry) / 1000.0
+    inside = basin_geometry.contains(dam_geometry)
+
+    table = pd.DataFrame(dict(
+        dam=dams['dam'].values[dam_index],
+        basin_id=basins['basin_id'].values[basin_index],
+        relation=np.where(inside, 'inside', 'near'),
+        distance_km=np.round(distance_km, 3),
+    ))
+    # Basins may have several polygons; keep the closest
+    table = table.sort_values(['dam', 'distance_km', 'basin_id']).drop_duplicates(['dam', 'basin_id'])
+    table['rank'] = table.groupby('dam').cumcount() + 1
+    return table[TABLE_COLUMNS].reset_index(drop=True)
+
+
+def cache_key(dams_path: pathlib.Path, basins_path: pathlib.Path, id_column: str, max_km: float) -> str:
+    """Returns key of the input files (path, size, mtime) and join parameters."""
+    digest = hashlib.sha1()
+    for path in (dams_path, basins_path):
+        stat = path.stat()
+        digest.update(f'{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    digest.update(f'{id_column}:{max_km}'.encode())
+    return digest.hexdigest()[:16]
+
+
+def get_table(dams_path: pathlib.Path, basins_path: pathlib.Path, id_column: str,
+        max_km: float = DEFAULT_MAX_KM, cache_dir: pathlib.Path = pathlib.Path(DEFAULT_CACHE_DIR)) -> pd.DataFrame:
+    """Returns lookup table from cache_dir, or joins dams to basins and caches the table."""
+    path = cache_dir / f'dam_basins_{cache_key(dams_path, basins_path, id_column, max_km)}.csv'
+    if path.exists():
+        print(f'Using cached {path}')
+        return pd.read_csv(path, dtype=dict(basin_id=str))
+
+    dams = load_dams(dams_path)
+    basins = load_basins(basins_path, id_column)
+    print(f'Joining {len(dams)} dams to {len(basins)} basins within {max_km} km')
+    table = join(dams, basins, max_km)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    table.to_csv(tmp_path, index=False)
+    tmp_path.replace(path)
+    print(f'Wrote {path}')
+    return table
+
+
+def select_basins(table: pd.DataFrame, dams: list[str]|None = None, inside_only: bool = False,
+        max_km: float|None = None) -> list[str]:
+    """Returns sorted basin ids related to the dams (all dams if None)."""
+    selected = table
+    if dams:
+        selected = selected[selected['dam'].isin(dams)]
+    if inside_only:
+        selected = selected[selected['relation'] == 'inside']
+    if max_km is not None:
+        selected = selected[selected['distance_km'] <= max_km]
+    return sorted(selected['basin_id'].unique())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Join TVA dams to CAMELS basins')
+    parser.add_argument('dams_file', help='dam points (tva_hydro.csv or .geojson)')
+    parser.add_argument('basins_file', help='basin polygons (.shp, .geojson) or gauges (camels_topo.txt)')
+    parser.add_argument('-i', '--id_column', help='basin id column [hru_id, or gauge_id for tables]')
+    parser.add_argument('-k', '--max_km', type=float, default=DEFAULT_MAX_KM,
+        help=f'max distance from dam to basin [{DEFAULT_MAX_KM}]')
+    parser.add_argument('-c', '--cache_dir', default=DEFAULT_CACHE_DIR,
+        help=f'directory for cached lookup tables [{DEFAULT_CACHE_DIR}]')
+    parser.add_argument('-d', '--dams', nargs='+', help='select basins for these dams (default all)')
+    parser.add_argument('--inside_only', action='store_true', help='select only basins containing the dams')
+    parser.add_argument('-o', '--basin_list', help='write selected basin ids to this file (for --basin_list)')
+    args = parser.parse_args()
+
+    dams_path, basins_path = pathlib.Path(args.dams_file), pathlib.Path(args.basins_file)
+    id_column = args.id_column
+    if id_column is None:
+        id_column = 'gauge_id' if basins_path.suffix.lower() in ('.csv', '.txt') else 'hru_id'
+    table = get_table(dams_path, basins_path, id_column, args.max_km, pathlib.Path(args.cache_dir))
+
+    print(table.to_string(index=False, max_rows=40))
+    basin_ids = select_basins(table, args.dams, args.inside_only)
+    print(f'{len(basin_ids)} basins selected')
+    if args.basin_list:
+        with open(args.basin_list, 'w') as fp:
+            fp.write('\n'.join(basin_ids) + '\n')
+        print(f'Wrote {args.basin_list}')
@@ -1,23 +1,161 @@
-"""Inputs csv file and generates geojson file."""
+"""Inputs csv file and generates geojson, geoparquet or flatgeobuf file.
+
+The output format is set by the output file suffix:
+  .geojson    GeoJSON
+  .fgb        FlatGeobuf, with a packed R-tree spatial index
+  .parquet    GeoParquet, with a bbox covering column so readers can skip
+              row groups outside a bounding box (gpd.read_parquet(bbox=...))
+
+With --chunksize, the csv is read and converted one chunk at a time
+(optionally in a pool of worker processes) and each chunk is written as it
+is converted, so memory is bounded for files with millions of rows. Since
+the output schema is fixed before later chunks are read, the coordinate
+columns are read as numbers and all other columns as text.
+"""
 
 import argparse
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import json
+import pathlib
 
 import pandas as pd
 import geopandas as gpd
+import pyarrow as pa
+import pyproj
+import shapely
+
+CRS = 'EPSG:4326'
+DRIVERS = {'.geojson': 'GeoJSON', '.json': 'GeoJSON', '.fgb': 'FlatGeobuf', '.parquet': 'Parquet'}
+
+
+def chunk_dtypes(lat_column: str, lon_column: str) -> defaultdict:
+    """Returns read_csv dtypes for chunked conversion: float coordinates, text for other columns."""
+    return defaultdict(lambda: str, {lat_column: float, lon_column: float})
+
+
+def chunk_to_arrow(df: pd.DataFrame, lat_column: str, lon_column: str, covering: bool) -> pa.RecordBatch:
+    """Returns record batch of df with WKB point geometry (and bbox covering) columns.
+
+    The schema depends only on the column names, so all chunks of a file match.
+    """
+    lon, lat = df[lon_column].to_numpy(dtype=float), df[lat_column].to_numpy(dtype=float)
+    schema = pa.schema([(column, pa.float64() if column in (lat_column, lon_column) else pa.string())
+        for column in df.columns])
+    batch = pa.RecordBatch.from_pandas(df, schema=schema, preserve_index=False)
+    batch = batch.append_column('geometry', pa.array(shapely.to_wkb(gpd.points_from_xy(lon, lat)), pa.binary()))
+    if covering:
+        bbox = pa.StructArray.from_arrays([lon, lat, lon, lat], names=['xmin', 'ymin', 'xmax', 'ymax'])
+        batch = batch.append_column('bbox', bbox)
+    return batch
+
+
+def iter_batches(input_file: str, chunksize: int, lat_column: str, lon_column: str,
+        covering: bool, workers: int):
+    """Yields converted record batches in file order, keeping at most 2 x workers chunks in flight."""
+    reader = pd.read_csv(input_file, chunksize=chunksize, dtype=chunk_dtypes(lat_column, lon_column))
+    if workers <= 1:
+        for df in reader:
+            yield chunk_to_arrow(df, lat_column, lon_column, covering)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for df in reader:
+            pending.append(executor.submit(chunk_to_arrow, df, lat_column, lon_column, covering))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def geoparquet_metadata(covering: bool) -> dict:
+    """Returns GeoParquet 1.1 'geo' metadata for the geometry column."""
+    column = dict(encoding='WKB', geometry_types=['Point'], crs=pyproj.CRS(CRS).to_json_dict())
+    if covering:
+        column['covering'] = dict(bbox={k: ['bbox', k] for k in ['xmin', 'ymin', 'xmax', 'ymax']})
+    geo = dict(version='1.1.0', primary_column='geometry', columns=dict(geometry=column))
+    return {b'geo': json.dumps(geo).encode()}
+
+
+def write_chunked(args: argparse.Namespace, driver: str) -> int:
+    """Converts csv one chunk at a time and writes output file. Returns number of rows."""
+    covering = driver == 'Parquet'
+    batches = iter_batches(args.input_file, args.chunksize, args.lat_column, args.lon_column,
+        covering, args.workers)
+    try:
+        first = next(batches)
+    except StopIteration:
+        # No data rows: write an empty file with the columns of the header
+        header = pd.read_csv(args.input_file, nrows=0, dtype=chunk_dtypes(args.lat_column, args.lon_column))
+        first = chunk_to_arrow(header, args.lat_column, args.lon_column, covering)
+    schema = first.schema
+
+    count = 0
+    if driver == 'Parquet':
+        import pyarrow.parquet as pq
+        schema = schema.with_metadata(geoparquet_metadata(covering))
+        with pq.ParquetWriter(args.output_file, schema) as writer:
+            # One row group per chunk
+            writer.write_batch(first.replace_schema_metadata(schema.metadata))
+            count += first.num_rows
+            for batch in batches:
+                batch = batch.replace_schema_metadata(schema.metadata)
+                writer.write_batch(batch)
+                count += batch.num_rows
+        return count
+
+    import pyogrio
+
+    def all_batches():
+        nonlocal count
+        count += first.num_rows
+        yield first
+        for batch in batches:
+            count += batch.num_rows
+            yield batch
+
+    stream = pa.RecordBatchReader.from_batches(schema, all_batches())
+    layer_options = dict(SPATIAL_INDEX='YES') if driver == 'FlatGeobuf' else None
+    pyogrio.write_arrow(stream, args.output_file, driver=driver, geometry_name='geometry',
+        geometry_type='Point', crs=CRS, layer_options=layer_options)
+    return count
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Load csv and generate geopandas dataframe')
     parser.add_argument('input_file', help='csv file with lat/lon coordinates')
     parser.add_argument('-l', '--lat_column', help='latitude column name', default='latitude')
     parser.add_argument('-m', '--lon_column', help='longitude column name', default='longitude')
-    parser.add_argument('-o', '--output_file', help='output filename (.geojson)')
+    parser.add_argument('-o', '--output_file', help='output filename (.geojson, .fgb or .parquet)')
+    parser.add_argument('-c', '--chunksize', type=int,
+        help='convert and write this many rows at a time (requires output_file)')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+        help='worker processes for converting chunks [1]')
     args = parser.parse_args()
 
-    df = pd.read_csv(args.input_file)
-    df['geometry'] = gpd.points_from_xy(df[args.lon_column], df[args.lat_column])
-    gdf = gpd.GeoDataFrame(df, crs="EPSG:4326")
-
-    print(gdf)
+    driver = None
     if args.output_file:
-        gdf.to_file(args.output_file, driver='GeoJSON')
-        print(f'Wrote {args.output_file}')
+        suffix = pathlib.Path(args.output_file).suffix.lower()
+        if suffix not in DRIVERS:
+            parser.error(f'unsupported output suffix {suffix} (use {", ".join(DRIVERS)})')
+        driver = DRIVERS[suffix]
+
+    if args.chunksize:
+        if driver is None:
+            parser.error('--chunksize requires --output_file')
+        count = write_chunked(args, driver)
+        print(f'Wrote {count} rows to {args.output_file}')
+    else:
+        df = pd.read_csv(args.input_file)
+        df['geometry'] = gpd.points_from_xy(df[args.lon_column], df[args.lat_column])
+        gdf = gpd.GeoDataFrame(df, crs=CRS)
+
+        print(gdf)
+        if driver == 'Parquet':
+            gdf.to_parquet(args.output_file, write_covering_bbox=True)
+            print(f'Wrote {args.output_file}')
+        elif driver is not None:
+            layer_options = dict(SPATIAL_INDEX='YES') if driver == 'FlatGeobuf' else None
+            gdf.to_file(args.output_file, driver=driver, layer_options=layer_options)
+            print(f'Wrote {args.output_file}')
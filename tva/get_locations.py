@@ -3,18 +3,32 @@
 Parses html file saved from public argis page, listing TVA dams
 https://www.arcgis.com/home/item.html?id=b7d45f7a0d1243e3ad10fef60f86e927&view=list&sortOrder=desc&sortField=defaultFSOrder&showFilters=true#data
 
-Uses Beautiful Soup library
+The html is parsed as a stream with lxml iterparse: each table row is
+converted when its closing tag is read, and the parsed elements before it
+are discarded, so memory stays bounded for exports with tens of thousands
+of rows. Several files (e.g. one per page of a multi-page export) can be
+given; rows repeated across files (same OBJECTID) are written once.
+If lxml is not installed, Beautiful Soup is used, restricted to the
+table elements with a SoupStrainer.
+
 On turtleland4, use ~/.py3-venv/misc
 """
 
+import argparse
 import csv
 from dataclasses import dataclass
 import pathlib
+from typing import Iterator
 from urllib.parse import parse_qs, urlparse
 
-from bs4 import BeautifulSoup
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
 
 CSV_HEADER = ['name', 'url', 'latitude', 'longitude']
+# Number of <td> elements in one row of the ArcGIS data table
+ROW_FIELDS = 6
 
 @dataclass
 class InputData:
@@ -37,37 +51,71 @@ class InputData:
         return [self.name, self.url, lat, lon]
 
 
-if __name__ == '__main__':
-    # Load html file
-    this_dir = pathlib.Path(__file__).parent
-    path = this_dir / 'TVA_Dams_Hosted - Data.html'
-    html_content = ''
+def _lxml_rows(path: pathlib.Path) -> Iterator[list[str]]:
+    """Yields the <td> texts of each table, streaming the file with lxml iterparse."""
+    for _, table in etree.iterparse(str(path), events=('end',), tag='table', html=True, recover=True):
+        yield [''.join(td.itertext()) for td in table.iter('td')]
+        # Discard the table and everything parsed before it
+        table.clear(keep_tail=True)
+        for ancestor in table.iterancestors():
+            if ancestor.getparent() is None:
+                break
+            while ancestor.getprevious() is not None:
+                del ancestor.getparent()[0]
+
+
+def _soup_rows(path: pathlib.Path) -> Iterator[list[str]]:
+    """Yields the <td> texts of each table, parsing only table elements with Beautiful Soup."""
+    from bs4 import BeautifulSoup, SoupStrainer
     with open(path) as fp:
-        html_content = fp.read()
+        soup = BeautifulSoup(fp, 'html.parser', parse_only=SoupStrainer('table'))
+    for table in soup.find_all('table'):
+        yield [td.get_text() for td in table.find_all('td')]
 
-    # Use list to store output csv data
-    csv_table = list()
 
-    # Use BeautifulSoup to parse html
-    soup = BeautifulSoup(html_content, 'html.parser')
-    tables = list(soup.find_all('table'))
-    # print(f'{len(tables)} tables')
-    for table in tables:
-        tds = list(table.find_all('td'))
-        if len(tds) == 6:
-            fields = [td.get_text() for td in tds]
+def iter_input_data(paths: list[pathlib.Path]) -> Iterator[InputData]:
+    """Yields InputData for each row of the data tables in the html files, skipping repeated rows."""
+    read_rows = _soup_rows if etree is None else _lxml_rows
+    seen_ids = set()
+    for path in paths:
+        for fields in read_rows(path):
+            if len(fields) != ROW_FIELDS:
+                continue
             input_data = InputData(*fields)
-            if input_data.hydro_type == 'Power':
-                csv_row = input_data.to_csv()
-                csv_table.append(csv_row)
+            if input_data.object_id in seen_ids:
+                continue
+            seen_ids.add(input_data.object_id)
+            yield input_data
 
-    # Sort csv_table by name
-    csv_table.sort(key=lambda row: row[0])
-    print(csv_table)
 
-    csv_filename = 'tva_hydro.csv'
-    with open(csv_filename, 'w') as fp:
+if __name__ == '__main__':
+    this_dir = pathlib.Path(__file__).parent
+    parser = argparse.ArgumentParser(description='Extract TVA hydro station locations from saved html')
+    parser.add_argument('html_files', nargs='*', default=[this_dir / 'TVA_Dams_Hosted - Data.html'],
+        help='html file(s) saved from the arcgis data page [TVA_Dams_Hosted - Data.html]')
+    parser.add_argument('-o', '--output_file', default='tva_hydro.csv', help='output csv file [tva_hydro.csv]')
+    parser.add_argument('-t', '--hydro_type', default='Power', help='HYDRO_TYPE to keep, or "all" [Power]')
+    parser.add_argument('-u', '--unsorted', action='store_true',
+        help='write rows in file order as they are parsed, instead of sorted by name')
+    args = parser.parse_args()
+
+    count = 0
+    csv_table = list()
+    with open(args.output_file, 'w') as fp:
         writer = csv.writer(fp)
         writer.writerow(CSV_HEADER)
+        for input_data in iter_input_data([pathlib.Path(p) for p in args.html_files]):
+            if args.hydro_type != 'all' and input_data.hydro_type != args.hydro_type:
+                continue
+            csv_row = input_data.to_csv()
+            count += 1
+            if args.unsorted:
+                writer.writerow(csv_row)
+            else:
+                # Only the csv rows are kept, not the parsed html
+                csv_table.append(csv_row)
+
+        # Sort csv_table by name
+        csv_table.sort(key=lambda row: row[0])
         writer.writerows(csv_table)
-        print(f'Wrote {csv_filename}')
+    print(f'Wrote {count} rows to {args.output_file}')